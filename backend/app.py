@@ -1,15 +1,29 @@
-import io
+import json
 import logging
 import mimetypes
 import os
+import tempfile
+import time
+from datetime import datetime
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Optional,
+)
 
 import aiohttp
 import openai
 from azure.identity.aio import DefaultAzureCredential
 from azure.core.credentials import AzureKeyCredential
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
-from azure.storage.blob.aio import BlobServiceClient
+from azure.storage.blob import BlobProperties
+from azure.storage.blob.aio import BlobClient, BlobServiceClient
 from opentelemetry.instrumentation.aiohttp_client import (
     AioHttpClientInstrumentor,
 )
@@ -17,18 +31,58 @@ from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 from quart import (
     Blueprint,
     Quart,
+    Response,
     abort,
     current_app,
     jsonify,
     request,
-    send_file,
     send_from_directory,
 )
+from werkzeug.http import http_date, unquote_etag
 
+from approaches.cachedapproach import CachedAskApproach, CachedChatApproach
+from approaches.coalescedapproach import CoalescedAskApproach, CoalescedChatApproach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.readdecomposeask import ReadDecomposeAsk
 from approaches.readretrieveread import ReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
+from config import (
+    API_VERSION,
+    AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+    AZURE_OPENAI_CHATGPT_MODEL,
+    AZURE_OPENAI_EMB_DEPLOYMENT,
+    AZURE_OPENAI_GPT4_DEPLOYMENT,
+    AZURE_OPENAI_GPT4_MODEL,
+    AZURE_OPENAI_SERVICE,
+    AZURE_SEARCH_INDEX,
+    AZURE_SEARCH_SERVICE,
+    COGNITIVE_SEARCH_API_KEY,
+    OPENAI_API_KEY,
+    OPENAI_API_TYPE,
+    OPENAI_MAX_RETRIES,
+    OPENAI_RATE_LIMIT_DIR,
+    OPENAI_RATE_LIMITS,
+    SEARCH_INDEX_GENERATION_PATH,
+)
+from core.answercache import (
+    AnswerCache,
+    InMemoryCacheBackend,
+    RedisCacheBackend,
+)
+from core.blobcache import BlobDiskCache
+from core.coalescing import RequestCoalescer
+from core.localsearch import (
+    FallbackSearchClient,
+    LocalIndex,
+    LocalSearchClient,
+)
+from core.ratelimit import OpenAIScheduler, parse_rate_limits
+from core.retrieval import HybridRetriever
+from core.searchcache import CachedSearchClient, IndexGeneration
+from core.sourceclassifier import SourceClassifier
+from core.validation import ResponseValidator
+from core import tracing
+from core.embeddings import EmbeddingService
 
 # Azure Storage configuration
 AZURE_STORAGE_ACCOUNT = os.getenv(
@@ -36,44 +90,112 @@ AZURE_STORAGE_ACCOUNT = os.getenv(
 )
 AZURE_STORAGE_CONTAINER = os.getenv("AZURE_STORAGE_CONTAINER", "previews")
 
-# Azure Cognitive Search configuration
-AZURE_SEARCH_SERVICE = os.getenv("AZURE_SEARCH_SERVICE", "ai-assistant-search")
-AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX", "ai-assistant-idx")
-# UPDATE THE VALUE BELOW TO YOUR COGNITIVE SEARCH ADMIN KEY
-COGNITIVE_SEARCH_API_KEY = os.getenv(
-    "COGNITIVE_SEARCH_API_KEY",
-    "<FILL_IN_YOUR_COGNITIVE_SEARCH_API_KEY>",
+# Local disk cache for content files (BLOB_CACHE_MAX_BYTES=0 disables it)
+BLOB_CACHE_DIR = os.getenv(
+    "BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "blob-cache")
 )
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", str(1024**3)))
+# Times a content file is read again when it changes while being served
+CONTENT_MAX_ATTEMPTS = 3
+
+# Azure Cognitive Search configuration (see config.py for the service and index)
 KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "Content")
 KB_FIELDS_CATEGORY = os.getenv("KB_FIELDS_CATEGORY", "Storage")
 KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "LocationURL")
+# Directory of a local copy of the index (see ingestion/__main__.py), used according to
+# LOCAL_SEARCH_MODE: "local" searches it instead of Cognitive Search, "fallback" when
+# Cognitive Search fails or takes longer than SEARCH_FALLBACK_TIMEOUT_MS, and "text" for
+# the BM25 leg of the chat approach's hybrid retrieval
+LOCAL_SEARCH_INDEX = os.getenv("LOCAL_SEARCH_INDEX", "")
+LOCAL_SEARCH_MODE = os.getenv("LOCAL_SEARCH_MODE", "local")
+SEARCH_FALLBACK_TIMEOUT_MS = float(os.getenv("SEARCH_FALLBACK_TIMEOUT_MS", "2000"))
 
-# Azure OpenAI configuration
-AZURE_OPENAI_SERVICE = os.getenv(
-    "AZURE_OPENAI_SERVICE", "ai-assistant-openai"
+# Search result cache shared by all approaches (SEARCH_CACHE_TTL=0 disables it). It is
+# cleared when ingestion writes a new generation to SEARCH_INDEX_GENERATION_PATH, which
+# is checked at most every SEARCH_GENERATION_CHECK_INTERVAL seconds
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "512"))
+SEARCH_GENERATION_CHECK_INTERVAL = float(
+    os.getenv("SEARCH_GENERATION_CHECK_INTERVAL", "5")
 )
-# UPDATE THE VALUE BELOW TO YOUR OPENAI API KEY
-OPENAI_API_KEY = os.getenv(
-    "OPENAI_API_KEY", "<FILL_IN_YOUR_OPENAI_API_KEY>"
-)
-AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv(
-    "AZURE_OPENAI_CHATGPT_DEPLOYMENT", "ai-assistant-gpt-35-16k"
+
+# Connection pool used for all Azure OpenAI calls
+OPENAI_POOL_LIMIT = int(os.getenv("OPENAI_POOL_LIMIT", "100"))
+OPENAI_POOL_LIMIT_PER_HOST = int(os.getenv("OPENAI_POOL_LIMIT_PER_HOST", "50"))
+OPENAI_POOL_KEEPALIVE_TIMEOUT = float(
+    os.getenv("OPENAI_POOL_KEEPALIVE_TIMEOUT", "30")
 )
-AZURE_OPENAI_CHATGPT_MODEL = os.getenv(
-    "AZURE_OPENAI_CHATGPT_MODEL", "gpt-35-turbo-16k"
+OPENAI_DNS_CACHE_TTL = int(os.getenv("OPENAI_DNS_CACHE_TTL", "300"))
+
+# Query embedding cache and micro-batching configuration
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "16"))
+
+# Answer cache configuration ("memory", "redis" or "none")
+ANSWER_CACHE_BACKEND = os.getenv("ANSWER_CACHE_BACKEND", "memory")
+ANSWER_CACHE_REDIS_URL = os.getenv(
+    "ANSWER_CACHE_REDIS_URL", "redis://localhost:6379/0"
 )
-AZURE_OPENAI_GPT4_DEPLOYMENT = os.getenv(
-    "AZURE_OPENAI_GPT4_DEPLOYMENT", "ai-assistant-gpt-4"
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1024"))
+# Cosine similarity of query embeddings above which a question is answered like a cached
+# one (chat first questions and rtr asks)
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.97"))
+
+# Concurrent identical /ask and /chat requests share one run of the approach
+REQUEST_COALESCING = os.getenv("REQUEST_COALESCING", "true").lower() == "true"
+
+# Fraction of requests whose prompts, search results and answers are attached to
+# their trace spans, and the maximum size of each attached payload
+TRACE_PAYLOAD_SAMPLE_RATE = float(
+    os.getenv("TRACE_PAYLOAD_SAMPLE_RATE", "0.01")
 )
-AZURE_OPENAI_GPT4_MODEL = os.getenv(
-    "AZURE_OPENAI_GPT4_MODEL",
-    "gpt-4-32k",
+TRACE_PAYLOAD_MAX_CHARS = int(os.getenv("TRACE_PAYLOAD_MAX_CHARS", "4096"))
+
+# Budget of the ReadDecomposeAsk agent loop, after which it returns a partial answer
+RDA_MAX_ITERATIONS = int(os.getenv("RDA_MAX_ITERATIONS", "8"))
+RDA_MAX_EXECUTION_TIME = float(os.getenv("RDA_MAX_EXECUTION_TIME", "60"))
+# "react" runs one LLM round trip per search or lookup hop, "decomposed" searches all
+# sub-questions at once between a decomposition and a synthesis call
+RDA_MODE = os.getenv("RDA_MODE", "react")
+RDA_LOOKUP_CACHE_TTL = float(os.getenv("RDA_LOOKUP_CACHE_TTL", "300"))
+
+# Hybrid retrieval of the chat approach: candidates fetched per query, reciprocal rank
+# fusion constant and per-query weights ("text=1,title_embedding=0.5,..."), chunks kept
+# per parent document, the MMR relevance/diversity trade-off (1 disables MMR) and the
+# number of best fused chunks MMR picks from
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))
+RETRIEVAL_RRF_K = int(os.getenv("RETRIEVAL_RRF_K", "60"))
+RETRIEVAL_RRF_WEIGHTS = os.getenv("RETRIEVAL_RRF_WEIGHTS", "")
+RETRIEVAL_MAX_CHUNKS_PER_DOC = int(
+    os.getenv("RETRIEVAL_MAX_CHUNKS_PER_DOC", "1")
 )
-AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv(
-    "AZURE_OPENAI_EMB_DEPLOYMENT", "ai-assistant-ada"
+RETRIEVAL_MMR_LAMBDA = float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.7"))
+RETRIEVAL_MMR_CANDIDATES = int(os.getenv("RETRIEVAL_MMR_CANDIDATES", "10"))
+
+# Token budget of the chat answer prompt (0 for the model's whole context window) and
+# the share of it the sources may take; the chat history gets the rest
+ANSWER_PROMPT_TOKENS = int(os.getenv("ANSWER_PROMPT_TOKENS", "8000"))
+ANSWER_SOURCES_SHARE = float(os.getenv("ANSWER_SOURCES_SHARE", "0.75"))
+
+# Default validation of chat answers ("full", "local" or "sampled", see
+# core/validation.py) and the fraction of locally passed answers the LLM re-checks
+VALIDATION_MODE = os.getenv("VALIDATION_MODE", "sampled")
+VALIDATION_SAMPLE_RATE = float(os.getenv("VALIDATION_SAMPLE_RATE", "0.05"))
+
+# Local data source classification: per-Storage centroids of the document embeddings,
+# built from the index on start and saved to SOURCE_CENTROIDS_PATH (rebuilt when the
+# index generation changes), the confidence the nearest centroid needs to be used, and
+# the keywords that break ties between centroids within the margin, as a JSON object of
+# Storage values to word lists (empty for the defaults in core/sourceclassifier.py)
+SOURCE_CENTROIDS_PATH = os.getenv(
+    "SOURCE_CENTROIDS_PATH",
+    os.path.join(tempfile.gettempdir(), "source-centroids.npz"),
 )
-API_VERSION = "2023-05-15"
-OPENAI_API_TYPE = "azure"
+SOURCE_CLF_MIN_SIMILARITY = float(os.getenv("SOURCE_CLF_MIN_SIMILARITY", "0.75"))
+SOURCE_CLF_MIN_MARGIN = float(os.getenv("SOURCE_CLF_MIN_MARGIN", "0.02"))
+SOURCE_CLF_KEYWORDS = os.getenv("SOURCE_CLF_KEYWORDS", "")
 
 # Configuration keys
 CONFIG_OPENAI_TOKEN = "openai_token"
@@ -81,6 +203,15 @@ CONFIG_CREDENTIAL = "azure_credential"
 CONFIG_ASK_APPROACHES = "ask_approaches"
 CONFIG_CHAT_APPROACHES = "chat_approaches"
 CONFIG_BLOB_CLIENT = "blob_client"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_EMBEDDINGS = "embeddings"
+CONFIG_OPENAI_SESSION = "openai_session"
+CONFIG_BLOB_CACHE = "blob_cache"
+CONFIG_VALIDATOR = "validator"
+CONFIG_SOURCE_CLASSIFIER = "source_classifier"
+CONFIG_SEARCH_CLIENT = "search_client"
+CONFIG_COALESCER = "coalescer"
+CONFIG_OPENAI_SCHEDULER = "openai_scheduler"
 
 APPLICATIONINSIGHTS_CONNECTION_STRING = os.getenv(
     "APPLICATIONINSIGHTS_CONNECTION_STRING"
@@ -106,27 +237,190 @@ async def assets(path):
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Blobs are streamed in chunks, so memory use doesn't depend on the blob size,
+# and kept in a local disk cache so popular files are served without going back to Blob Storage.
 @bp.route("/content/<path>")
 async def content_file(path):
-    blob_container = current_app.config[
-        CONFIG_BLOB_CLIENT
-    ].get_container_client(AZURE_STORAGE_CONTAINER)
-    blob = await blob_container.get_blob_client(path).download_blob()
-    if not blob.properties or not blob.properties.has_key("content_settings"):
-        abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
+    blob_client = (
+        current_app.config[CONFIG_BLOB_CLIENT]
+        .get_container_client(AZURE_STORAGE_CONTAINER)
+        .get_blob_client(path)
+    )
+    # The response headers come from the blob's properties, so the download only
+    # succeeds while the blob still has their ETag. If it was replaced in between (412),
+    # the properties are read again.
+    for _ in range(CONTENT_MAX_ATTEMPTS):
+        try:
+            properties = await blob_client.get_blob_properties()
+            return await blob_response(path, blob_client, properties)
+        except ResourceNotFoundError:
+            abort(404)
+        except ResourceModifiedError:
+            logging.info("Content file %s changed while it was read, retrying", path)
+    abort(503)
+
+
+async def blob_response(
+    path: str, blob_client: BlobClient, properties: BlobProperties
+) -> Response:
+    mime_type = properties.content_settings.content_type
+    if not mime_type or mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(
-        blob_file,
+
+    async def open_blob(offset: int, length: int) -> AsyncIterator[bytes]:
+        if length <= 0:
+            return empty_chunks()
+        downloader = await blob_client.download_blob(
+            offset=offset,
+            length=length,
+            etag=properties.etag,
+            match_condition=MatchConditions.IfNotModified,
+        )
+        return downloader.chunks()
+
+    async def read_blob() -> AsyncIterator[bytes]:
+        async for chunk in await open_blob(0, properties.size):
+            yield chunk
+
+    blob_cache = current_app.config[CONFIG_BLOB_CACHE]
+    if not blob_cache or properties.size > blob_cache.max_bytes:
+        return await content_response(
+            properties.etag,
+            properties.last_modified,
+            properties.size,
+            mime_type,
+            open_blob,
+        )
+
+    cached_path = await blob_cache.fetch(path, properties.etag, read_blob)
+
+    async def open_cached(offset: int, length: int) -> AsyncIterator[bytes]:
+        try:
+            return await blob_cache.open(cached_path, offset, length)
+        except FileNotFoundError:
+            # Evicted by another worker before we opened it
+            return await open_blob(offset, length)
+
+    return await content_response(
+        properties.etag,
+        properties.last_modified,
+        properties.size,
+        mime_type,
+        open_cached,
+    )
+
+
+async def empty_chunks() -> AsyncIterator[bytes]:
+    return
+    yield
+
+
+async def content_response(
+    etag: str,
+    last_modified: datetime,
+    size: int,
+    mime_type: str,
+    open_range: Callable[[int, int], Awaitable[AsyncIterator[bytes]]],
+) -> Response:
+    """
+    Builds a streamed response for a stored file, answering conditional requests
+    (If-None-Match, If-Modified-Since) with 304 and single byte-range requests with 206,
+    honoring If-Range.
+    `open_range(offset, length)` starts reading the requested bytes before the response
+    is sent, so that errors can still change it, and returns their chunks.
+    """
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Accept-Ranges": "bytes",
+    }
+    unquoted_etag = unquote_etag(etag)[0]
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(unquoted_etag)
+    else:
+        not_modified = bool(
+            request.if_modified_since
+            and last_modified.replace(microsecond=0)
+            <= request.if_modified_since
+        )
+    if not_modified:
+        return Response("", status=304, headers=headers)
+
+    status, offset, length = 200, 0, size
+    # A Range request is only honored if If-Range, when sent, still matches the file
+    # (its ETag, or its Last-Modified date exactly). Requests for several ranges get
+    # the whole file, which RFC 9110 allows instead of a multipart response.
+    if request.if_range.etag:
+        if_range_matches = request.if_range.etag == unquoted_etag
+    elif request.if_range.date:
+        if_range_matches = (
+            request.if_range.date == last_modified.replace(microsecond=0)
+        )
+    else:
+        if_range_matches = True
+    if request.range and len(request.range.ranges) == 1 and if_range_matches:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response("", status=416, headers=headers)
+        start, stop = byte_range
+        status, offset, length = 206, start, stop - start
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    headers["Content-Length"] = str(length)
+
+    response = Response(
+        await open_range(offset, length),
+        status=status,
+        headers=headers,
         mimetype=mime_type,
-        as_attachment=False,
-        attachment_filename=path,
     )
+    response.timeout = None
+    return response
+
+
+@bp.before_request
+async def bind_openai_session():
+    # openai.aiosession is a ContextVar, so it has to be set in every request's own
+    # context. The request handler (including streamed bodies) runs in this context.
+    # Workaround for: https://github.com/openai/openai-python/issues/371
+    openai.aiosession.set(current_app.config[CONFIG_OPENAI_SESSION])
+
+
+def ndjson_response(
+    frames: AsyncGenerator[dict[str, Any], None], route: str
+) -> Response:
+    """
+    Stream approach frames to the client as newline-delimited JSON. Frames are
+    "data_points" (search results), "delta" (answer tokens), "correction" (the
+    validated answer, if it differs from the streamed one), "result" (the full
+    non-streaming response) and "error".
+    """
+    started = time.perf_counter()
+
+    async def generate():
+        first_frame = True
+        try:
+            async for frame in frames:
+                if first_frame:
+                    first_frame = False
+                    logging.info(
+                        "%s time to first byte: %.0f ms",
+                        route,
+                        (time.perf_counter() - started) * 1000,
+                    )
+                yield json.dumps(frame) + "\n"
+        except Exception as e:
+            logging.exception("Exception in %s stream", route)
+            yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+        finally:
+            # Stops the approach (or detaches from a coalesced one) when the client
+            # disconnects
+            await frames.aclose()
+
+    response = Response(generate(), mimetype="application/x-ndjson")
+    # Don't cut long answers off at Quart's RESPONSE_TIMEOUT, gunicorn's timeout applies
+    response.timeout = None
+    return response
 
 
 @bp.route("/ask", methods=["POST"])
@@ -139,12 +433,17 @@ async def ask():
         impl = current_app.config[CONFIG_ASK_APPROACHES].get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        # Workaround for: https://github.com/openai/openai-python/issues/371
-        async with aiohttp.ClientSession() as s:
-            openai.aiosession.set(s)
-            r = await impl.run(
-                request_json["question"], request_json.get("overrides") or {}
+        if request_json.get("stream"):
+            return ndjson_response(
+                impl.run_stream(
+                    request_json["question"],
+                    request_json.get("overrides") or {},
+                ),
+                "/ask",
             )
+        r = await impl.run(
+            request_json["question"], request_json.get("overrides") or {}
+        )
         return jsonify(r)
     except Exception as e:
         logging.exception("Exception in /ask")
@@ -161,18 +460,94 @@ async def chat():
         impl = current_app.config[CONFIG_CHAT_APPROACHES].get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        # Workaround for: https://github.com/openai/openai-python/issues/371
-        async with aiohttp.ClientSession() as s:
-            openai.aiosession.set(s)
-            r = await impl.run(
-                request_json["history"], request_json.get("overrides") or {}
+        if request_json.get("stream"):
+            return ndjson_response(
+                impl.run_stream(
+                    request_json["history"],
+                    request_json.get("overrides") or {},
+                ),
+                "/chat",
             )
+        r = await impl.run(
+            request_json["history"], request_json.get("overrides") or {}
+        )
         return jsonify(r)
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/metrics", methods=["GET"])
+async def metrics():
+    answer_cache = current_app.config[CONFIG_ANSWER_CACHE]
+    blob_cache = current_app.config[CONFIG_BLOB_CACHE]
+    coalescer = current_app.config[CONFIG_COALESCER]
+    search_client = current_app.config[CONFIG_SEARCH_CLIENT]
+    search_cache = (
+        search_client if isinstance(search_client, CachedSearchClient) else None
+    )
+    if search_cache:
+        search_client = search_cache.search_client
+    return jsonify(
+        {
+            "answer_cache": answer_cache.stats() if answer_cache else None,
+            "embeddings": current_app.config[CONFIG_EMBEDDINGS].stats(),
+            "blob_cache": blob_cache.stats() if blob_cache else None,
+            "validation": current_app.config[CONFIG_VALIDATOR].stats(),
+            "source_classifier": current_app.config[
+                CONFIG_SOURCE_CLASSIFIER
+            ].stats(),
+            "search_cache": search_cache.stats() if search_cache else None,
+            "search_fallback": search_client.stats()
+            if isinstance(search_client, FallbackSearchClient)
+            else None,
+            "coalescing": coalescer.stats() if coalescer else None,
+            "openai": current_app.config[CONFIG_OPENAI_SCHEDULER].stats(),
+        }
+    )
+
+
+def create_answer_cache() -> Optional[AnswerCache]:
+    if ANSWER_CACHE_BACKEND == "none":
+        return None
+    if ANSWER_CACHE_BACKEND == "redis":
+        backend = RedisCacheBackend(ANSWER_CACHE_REDIS_URL, ANSWER_CACHE_TTL)
+    else:
+        backend = InMemoryCacheBackend(
+            ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL
+        )
+    return AnswerCache(
+        backend,
+        similarity_threshold=ANSWER_CACHE_SIMILARITY,
+        max_vectors=ANSWER_CACHE_MAX_ENTRIES,
+        ttl=ANSWER_CACHE_TTL,
+    )
+
+
+def create_retriever(
+    search_client: SearchClient, text_client: Optional[LocalSearchClient] = None
+) -> HybridRetriever:
+    weights = {}
+    for item in RETRIEVAL_RRF_WEIGHTS.split(","):
+        if item.strip():
+            leg, weight = item.split("=")
+            weights[leg.strip()] = float(weight)
+    return HybridRetriever(
+        search_client,
+        select=ChatReadRetrieveReadApproach.SELECT_FIELDS
+        + [KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT],
+        vector_fields=ChatReadRetrieveReadApproach.VECTOR_FIELDS,
+        mmr_field="content_embedding",
+        weights=weights,
+        rrf_k=RETRIEVAL_RRF_K,
+        candidates=RETRIEVAL_CANDIDATES,
+        mmr_lambda=RETRIEVAL_MMR_LAMBDA,
+        max_chunks_per_doc=RETRIEVAL_MAX_CHUNKS_PER_DOC,
+        mmr_candidates=RETRIEVAL_MMR_CANDIDATES,
+        text_client=text_client,
+    )
+
+
 @bp.before_app_serving
 async def setup_clients():
     # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
@@ -192,21 +567,102 @@ async def setup_clients():
         index_name=AZURE_SEARCH_INDEX,
         credential=azure_cognitive_search_key_credential,
     )
+    if LOCAL_SEARCH_MODE not in ("local", "fallback", "text"):
+        raise ValueError(f"Unknown local search mode: {LOCAL_SEARCH_MODE}")
+    local_search_client = (
+        LocalSearchClient(LocalIndex(LOCAL_SEARCH_INDEX))
+        if LOCAL_SEARCH_INDEX
+        else None
+    )
+    if local_search_client and LOCAL_SEARCH_MODE == "local":
+        search_client = local_search_client
+    elif local_search_client and LOCAL_SEARCH_MODE == "fallback":
+        search_client = FallbackSearchClient(
+            search_client,
+            local_search_client,
+            timeout=SEARCH_FALLBACK_TIMEOUT_MS / 1000,
+        )
     blob_client = BlobServiceClient(
         account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
         credential=azure_credential,
     )
 
+    blob_cache = (
+        BlobDiskCache(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES)
+        if BLOB_CACHE_MAX_BYTES > 0
+        else None
+    )
+
+    # One keep-alive connection pool for the lifetime of the app, so LLM calls from all
+    # requests reuse connections instead of doing a TCP and TLS handshake each time
+    openai_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=OPENAI_POOL_LIMIT,
+            limit_per_host=OPENAI_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=OPENAI_POOL_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=OPENAI_DNS_CACHE_TTL,
+        )
+    )
+
     # Used by the OpenAI SDK
     openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
     openai.api_version = API_VERSION
     openai.api_type = OPENAI_API_TYPE
     openai.api_key = OPENAI_API_KEY
 
+    # All OpenAI calls go through it, at the interactive priority
+    openai_scheduler = OpenAIScheduler(
+        parse_rate_limits(OPENAI_RATE_LIMITS),
+        shared_dir=OPENAI_RATE_LIMIT_DIR or None,
+        max_retries=OPENAI_MAX_RETRIES,
+    )
+    # Shared by all approaches so that identical queries and concurrent requests
+    # share embedding calls
+    embeddings = EmbeddingService(
+        AZURE_OPENAI_EMB_DEPLOYMENT,
+        cache_size=EMBEDDING_CACHE_SIZE,
+        batch_window=EMBEDDING_BATCH_WINDOW_MS / 1000,
+        max_batch_size=EMBEDDING_MAX_BATCH_SIZE,
+        scheduler=openai_scheduler,
+    )
+    answer_cache = create_answer_cache()
+    validator = ResponseValidator(VALIDATION_MODE, VALIDATION_SAMPLE_RATE)
+    index_generation = IndexGeneration(
+        SEARCH_INDEX_GENERATION_PATH, SEARCH_GENERATION_CHECK_INTERVAL
+    )
+    source_classifier = await SourceClassifier.load_or_build(
+        SOURCE_CENTROIDS_PATH,
+        search_client,
+        [
+            source
+            for source in ChatReadRetrieveReadApproach.id_to_data_source.values()
+            if source != "Unknown"
+        ],
+        generation=index_generation.current(),
+        keywords=json.loads(SOURCE_CLF_KEYWORDS) if SOURCE_CLF_KEYWORDS else None,
+        min_similarity=SOURCE_CLF_MIN_SIMILARITY,
+        min_margin=SOURCE_CLF_MIN_MARGIN,
+    )
+    if SEARCH_CACHE_TTL > 0:
+        search_client = CachedSearchClient(
+            search_client,
+            maxsize=SEARCH_CACHE_MAX_ENTRIES,
+            ttl=SEARCH_CACHE_TTL,
+            generation=index_generation,
+        )
+
     # Store on app.config for later use inside requests
     # current_app.config[CONFIG_OPENAI_TOKEN] = openai_token
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
+    current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_BLOB_CLIENT] = blob_client
+    current_app.config[CONFIG_BLOB_CACHE] = blob_cache
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+    current_app.config[CONFIG_VALIDATOR] = validator
+    current_app.config[CONFIG_SOURCE_CLASSIFIER] = source_classifier
+    current_app.config[CONFIG_EMBEDDINGS] = embeddings
+    current_app.config[CONFIG_OPENAI_SESSION] = openai_session
+    current_app.config[CONFIG_OPENAI_SCHEDULER] = openai_scheduler
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
     current_app.config[CONFIG_ASK_APPROACHES] = {
@@ -214,23 +670,31 @@ async def setup_clients():
             search_client,
             AZURE_OPENAI_CHATGPT_DEPLOYMENT,
             AZURE_OPENAI_CHATGPT_MODEL,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
+            embeddings,
             KB_FIELDS_SOURCEPAGE,
             KB_FIELDS_CONTENT,
+            answer_cache=answer_cache,
+            openai_scheduler=openai_scheduler,
         ),
         "rrr": ReadRetrieveReadApproach(
             search_client,
             AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
+            embeddings,
             KB_FIELDS_SOURCEPAGE,
             KB_FIELDS_CONTENT,
+            openai_scheduler=openai_scheduler,
         ),
         "rda": ReadDecomposeAsk(
             search_client,
             AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
+            embeddings,
             KB_FIELDS_SOURCEPAGE,
             KB_FIELDS_CONTENT,
+            max_iterations=RDA_MAX_ITERATIONS,
+            max_execution_time=RDA_MAX_EXECUTION_TIME,
+            mode=RDA_MODE,
+            lookup_cache_ttl=RDA_LOOKUP_CACHE_TTL,
+            openai_scheduler=openai_scheduler,
         ),
     }
     current_app.config[CONFIG_CHAT_APPROACHES] = {
@@ -240,17 +704,60 @@ async def setup_clients():
             AZURE_OPENAI_CHATGPT_MODEL,
             AZURE_OPENAI_GPT4_DEPLOYMENT,
             AZURE_OPENAI_GPT4_MODEL,
-            AZURE_OPENAI_EMB_DEPLOYMENT,
+            embeddings,
             KB_FIELDS_SOURCEPAGE,
             KB_FIELDS_CONTENT,
+            answer_cache,
+            create_retriever(
+                search_client,
+                local_search_client if LOCAL_SEARCH_MODE == "text" else None,
+            ),
+            answer_prompt_tokens=ANSWER_PROMPT_TOKENS,
+            sources_share=ANSWER_SOURCES_SHARE,
+            validator=validator,
+            source_classifier=source_classifier,
+            openai_scheduler=openai_scheduler,
         )
     }
+    for impl in current_app.config[CONFIG_CHAT_APPROACHES].values():
+        impl.warm_up()
+
+    # Repeated questions are answered from the cache without running the approach
+    if answer_cache:
+        for name, impl in current_app.config[CONFIG_ASK_APPROACHES].items():
+            current_app.config[CONFIG_ASK_APPROACHES][
+                name
+            ] = CachedAskApproach(name, impl, answer_cache)
+        for name, impl in current_app.config[CONFIG_CHAT_APPROACHES].items():
+            current_app.config[CONFIG_CHAT_APPROACHES][
+                name
+            ] = CachedChatApproach(name, impl, answer_cache)
+
+    # Identical requests in flight at the same time, e.g. the first question of a
+    # shared link, are answered by a single run (and then from the answer cache)
+    coalescer = RequestCoalescer() if REQUEST_COALESCING else None
+    current_app.config[CONFIG_COALESCER] = coalescer
+    if coalescer:
+        for name, impl in current_app.config[CONFIG_ASK_APPROACHES].items():
+            current_app.config[CONFIG_ASK_APPROACHES][
+                name
+            ] = CoalescedAskApproach(name, impl, coalescer)
+        for name, impl in current_app.config[CONFIG_CHAT_APPROACHES].items():
+            current_app.config[CONFIG_CHAT_APPROACHES][
+                name
+            ] = CoalescedChatApproach(name, impl, coalescer)
+
+
+@bp.after_app_serving
+async def close_clients():
+    await current_app.config[CONFIG_OPENAI_SESSION].close()
 
 
 def create_app():
     if APPLICATIONINSIGHTS_CONNECTION_STRING:
         configure_azure_monitor()
         AioHttpClientInstrumentor().instrument()
+    tracing.configure(TRACE_PAYLOAD_SAMPLE_RATE, TRACE_PAYLOAD_MAX_CHARS)
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.asgi_app = OpenTelemetryMiddleware(app.asgi_app)
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
-from typing import Any
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Optional
 
 
 class ChatApproach(ABC):
@@ -7,8 +8,33 @@ class ChatApproach(ABC):
     async def run(self, history: list[dict], overrides: dict[str, Any]) -> Any:
         ...
 
+    async def run_stream(
+        self, history: list[dict], overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        # Approaches that cannot stream send the whole answer as a single frame
+        yield {"type": "result", "result": await self.run(history, overrides)}
+
 
 class AskApproach(ABC):
     @abstractmethod
     async def run(self, q: str, overrides: dict[str, Any]) -> Any:
         ...
+
+    async def run_stream(
+        self, q: str, overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        yield {"type": "result", "result": await self.run(q, overrides)}
+
+
+class RequestState:
+    """
+    The state of one run that an approach's shared pipeline (agent, tools) needs to see,
+    set in `request_state` for the duration of the run.
+    """
+
+    def __init__(self, overrides: dict[str, Any]):
+        self.overrides = overrides
+        self.results: Optional[list[str]] = None
+
+
+request_state: ContextVar[RequestState] = ContextVar("request_state")
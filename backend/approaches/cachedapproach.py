@@ -0,0 +1,64 @@
+from typing import Any, AsyncGenerator
+
+from approaches.approach import AskApproach, ChatApproach
+from core.answercache import AnswerCache
+
+
+class CachedChatApproach(ChatApproach):
+    """
+    Serves repeated questions from an AnswerCache instead of running the wrapped approach.
+    """
+
+    def __init__(self, name: str, approach: ChatApproach, cache: AnswerCache):
+        self.name = name
+        self.approach = approach
+        self.cache = cache
+
+    async def run(
+        self, history: list[dict[str, str]], overrides: dict[str, Any]
+    ) -> Any:
+        key = self.cache.make_chat_key(self.name, history, overrides)
+        if (result := await self.cache.get(key)) is not None:
+            return result
+        result = await self.approach.run(history, overrides)
+        await self.cache.set(key, result)
+        return result
+
+    async def run_stream(
+        self, history: list[dict[str, str]], overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        key = self.cache.make_chat_key(self.name, history, overrides)
+        if (result := await self.cache.get(key)) is not None:
+            yield {"type": "result", "result": result}
+            return
+        async for frame in self.approach.run_stream(history, overrides):
+            if frame["type"] == "result":
+                await self.cache.set(key, frame["result"])
+            yield frame
+
+
+class CachedAskApproach(AskApproach):
+    def __init__(self, name: str, approach: AskApproach, cache: AnswerCache):
+        self.name = name
+        self.approach = approach
+        self.cache = cache
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        key = self.cache.make_ask_key(self.name, q, overrides)
+        if (result := await self.cache.get(key)) is not None:
+            return result
+        result = await self.approach.run(q, overrides)
+        await self.cache.set(key, result)
+        return result
+
+    async def run_stream(
+        self, q: str, overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        key = self.cache.make_ask_key(self.name, q, overrides)
+        if (result := await self.cache.get(key)) is not None:
+            yield {"type": "result", "result": result}
+            return
+        async for frame in self.approach.run_stream(q, overrides):
+            if frame["type"] == "result":
+                await self.cache.set(key, frame["result"])
+            yield frame
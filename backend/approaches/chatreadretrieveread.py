@@ -1,17 +1,25 @@
+import asyncio
 import re
 import json
-from typing import Any
+from typing import Any, AsyncGenerator, Optional
 
-import openai
+import numpy as np
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import QueryType
-from azure.search.documents.models import Vector
 
 from approaches.approach import ChatApproach
+from core.answercache import AnswerCache
+from core.contextpacker import ContextPacker
+from core.embeddings import EmbeddingService
 from core.messagebuilder import MessageBuilder
-from core.modelhelper import get_token_limit
+from core.modelhelper import get_token_limit, warm_token_counts
+from core.ratelimit import OpenAIScheduler
+from core.retrieval import HybridRetriever
+from core.sourceclassifier import SourceClassifier
+from core.tracing import RequestTrace
+from core.validation import ResponseValidator
 from text import nonewlines
 from approaches.prompt_data import (
+    SYSTEM,
     USER,
     ASSISTANT,
     ai_response_prompt_template,
@@ -26,6 +34,10 @@ from approaches.prompt_data import (
 class ChatReadRetrieveReadApproach(ChatApproach):
     RESPONSE_TEMP = 0.1
     VALIDATION_TEMP = 0.1
+    NEWLINES = re.compile(r"\n|\\n")
+    ANSWER_COMPLETION_TOKENS = 1024
+    SELECT_FIELDS = ["Id", "FileName", "Summary"]
+    VECTOR_FIELDS = ["title_embedding", "content_embedding", "summary_embedding"]
     id_to_data_source = {
         "1": "SoftServe Website",
         "2": "Wikipedia",
@@ -45,173 +57,417 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         chatgpt_model: str,
         gpt4_deployment: str,
         gpt4_model: str,
-        embedding_deployment: str,
+        embeddings: EmbeddingService,
         sourcepage_field: str,
         content_field: str,
+        answer_cache: Optional[AnswerCache] = None,
+        retriever: Optional[HybridRetriever] = None,
+        answer_prompt_tokens: Optional[int] = None,
+        sources_share: float = 0.75,
+        validator: Optional[ResponseValidator] = None,
+        source_classifier: Optional[SourceClassifier] = None,
+        openai_scheduler: Optional[OpenAIScheduler] = None,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
         self.gpt4_deployment = gpt4_deployment
         self.gpt4_model = gpt4_model
-        self.embedding_deployment = embedding_deployment
+        self.embeddings = embeddings
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.answer_cache = answer_cache
+        self.retriever = retriever or HybridRetriever(
+            search_client,
+            select=self.SELECT_FIELDS + [sourcepage_field, content_field],
+            vector_fields=self.VECTOR_FIELDS,
+            mmr_field="content_embedding",
+        )
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
         self.gpt4_token_limit = get_token_limit(gpt4_model)
+        self.answer_prompt_tokens = answer_prompt_tokens
+        self.sources_share = sources_share
+        self.context_packer = ContextPacker(gpt4_model)
+        self.validator = validator or ResponseValidator()
+        self.source_classifier = source_classifier or SourceClassifier({})
+        self.openai_scheduler = openai_scheduler or OpenAIScheduler()
+
+    def warm_up(self):
+        # Pre-tokenize the static prompts and few-shot examples
+        warm_token_counts(
+            [
+                USER,
+                ASSISTANT,
+                SYSTEM,
+                search_query_prompt,
+                source_clf_prompt,
+                response_val_prompt,
+            ]
+            + [shot["content"] for shot in search_query_prompt_few_shots],
+            [self.chatgpt_model],
+        )
+        warm_token_counts(
+            [
+                ai_response_prompt_template.format(
+                    injected_prompt="",
+                    follow_up_questions_prompt=follow_up_questions_prompt,
+                )
+                for follow_up_questions_prompt in [
+                    "",
+                    follow_up_questions_prompt_content,
+                ]
+            ],
+            [self.gpt4_model],
+        )
 
     async def run(
         self, history: list[dict[str, str]], overrides: dict[str, Any]
     ) -> Any:
+        request_trace = RequestTrace()
+        (
+            search_query,
+            query_vector,
+            data_sources,
+            semantic_cache_scope,
+            cached,
+        ) = await self.prepare_search(history, overrides, request_trace)
+        if cached:
+            return cached
+
+        search_query, results_formatted = await self.retrieve(
+            overrides, search_query, query_vector, data_sources, request_trace
+        )
+
+        ai_response_messages, token_usage = self.get_ai_response_messages(
+            history, overrides, results_formatted, request_trace
+        )
+
+        with request_trace.stage("ai_response"):
+            ai_response_completion = await self.openai_scheduler.chat_completion(
+                prompt_tokens=token_usage["total"],
+                deployment_id=self.gpt4_deployment,
+                model=self.gpt4_model,
+                messages=ai_response_messages,
+                temperature=overrides.get("temperature")
+                or self.RESPONSE_TEMP,
+                max_tokens=self.ANSWER_COMPLETION_TOKENS,
+                n=1,
+            )
+
+        ai_response = ai_response_completion.choices[0].message.content
+        request_trace.payload("original_response", ai_response)
+
+        with request_trace.stage("validation"):
+            validated_response = await self.validate(
+                ai_response, results_formatted, overrides, request_trace
+            )
+
+        result = self.make_result(
+            search_query,
+            results_formatted,
+            ai_response_messages,
+            validated_response,
+            overrides,
+            token_usage,
+            request_trace,
+        )
+        if semantic_cache_scope:
+            await self.answer_cache.set_similar(
+                semantic_cache_scope, query_vector, result
+            )
+        return result
+
+    async def run_stream(
+        self, history: list[dict[str, str]], overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        request_trace = RequestTrace()
+        (
+            search_query,
+            query_vector,
+            data_sources,
+            semantic_cache_scope,
+            cached,
+        ) = await self.prepare_search(history, overrides, request_trace)
+        if cached:
+            yield {"type": "result", "result": cached}
+            return
+
+        search_query, results_formatted = await self.retrieve(
+            overrides, search_query, query_vector, data_sources, request_trace
+        )
+
+        yield {
+            "type": "data_points",
+            "data_points": self.get_data_points(results_formatted),
+            "results_formatted": results_formatted,
+        }
+
+        ai_response_messages, token_usage = self.get_ai_response_messages(
+            history, overrides, results_formatted, request_trace
+        )
+
+        with request_trace.stage("ai_response"):
+            ai_response_chunks = await self.openai_scheduler.chat_completion(
+                prompt_tokens=token_usage["total"],
+                deployment_id=self.gpt4_deployment,
+                model=self.gpt4_model,
+                messages=ai_response_messages,
+                temperature=overrides.get("temperature")
+                or self.RESPONSE_TEMP,
+                max_tokens=self.ANSWER_COMPLETION_TOKENS,
+                n=1,
+                stream=True,
+            )
+            ai_response_parts = []
+            async for chunk in ai_response_chunks:
+                # Azure sends a first chunk with content filter results only
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.get("content")
+                if delta:
+                    ai_response_parts.append(delta)
+                    yield {"type": "delta", "content": delta}
+
+        ai_response = "".join(ai_response_parts)
+        request_trace.payload("original_response", ai_response)
+
+        # The tokens are already on the client, so the validated answer is sent as a
+        # correction frame that replaces them, and only if the validation changed it
+        with request_trace.stage("validation"):
+            validated_response = await self.validate(
+                ai_response, results_formatted, overrides, request_trace
+            )
+        if validated_response != ai_response:
+            yield {"type": "correction", "answer": validated_response}
+
+        result = self.make_result(
+            search_query,
+            results_formatted,
+            ai_response_messages,
+            validated_response,
+            overrides,
+            token_usage,
+            request_trace,
+        )
+        if semantic_cache_scope:
+            await self.answer_cache.set_similar(
+                semantic_cache_scope, query_vector, result
+            )
+        yield {"type": "result", "result": result}
+
+    async def prepare_search(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        request_trace: RequestTrace,
+    ) -> tuple[str, Optional[np.ndarray], list[str], Optional[str], Optional[Any]]:
+        """
+        Generates the search query and its embedding while the data sources are
+        classified, then looks up the semantic answer cache. On a hit, the last item is
+        the cached result and the classification is cancelled.
+        """
+        data_sources = asyncio.ensure_future(
+            self.classify_data_sources(history[-1]["user"], request_trace)
+        )
+        try:
+            search_query, query_vector = await self.generate_search_query_and_vector(
+                history, overrides, request_trace
+            )
+            # A similar question was answered already, so neither search nor answer it
+            # again
+            semantic_cache_scope = self.get_semantic_cache_scope(
+                history, overrides, query_vector
+            )
+            if semantic_cache_scope and (
+                cached := await self.answer_cache.get_similar(
+                    semantic_cache_scope, query_vector
+                )
+            ):
+                return search_query, query_vector, [], semantic_cache_scope, cached
+            return (
+                search_query,
+                query_vector,
+                await data_sources,
+                semantic_cache_scope,
+                None,
+            )
+        finally:
+            data_sources.cancel()
+            # Waits for the classification to stop, so it doesn't outlive the request's
+            # search, and retrieves its outcome, which may be a failure nobody awaited
+            await asyncio.gather(data_sources, return_exceptions=True)
+
+    async def retrieve(
+        self,
+        overrides: dict[str, Any],
+        search_query: str,
+        query_vector: Optional[np.ndarray],
+        data_sources: list[str],
+        request_trace: RequestTrace,
+    ) -> tuple[Optional[str], list[dict[str, str]]]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
+        use_semantic_captions = (
+            True if overrides.get("semantic_captions") and has_text else False
+        )
+        top = overrides.get("top") or 3
+
+        # Only keep the text query if the retrieval mode uses text, otherwise drop it
+        if not has_text:
+            search_query = None
+
+        filter = (
+            f"search.in(Storage, '{','.join(data_sources)}', ',')"
+            if "Unknown" not in data_sources
+            else None
+        )
+        request_trace.attribute("search_filter", filter or "")
+
+        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query.
+        # The text and per-field vector queries run concurrently and are fused on our side.
+        # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
+        with request_trace.stage("search"):
+            docs = await self.retriever.search(
+                search_query,
+                query_vector,
+                top,
+                filter=filter,
+                semantic_ranker=bool(overrides.get("semantic_ranker"))
+                and has_text,
+                semantic_captions=use_semantic_captions,
+            )
+        results_formatted = [
+            {
+                "title": doc["FileName"],
+                "content": nonewlines(
+                    " . ".join([c.text for c in doc["@search.captions"]])
+                    if use_semantic_captions and doc.get("@search.captions")
+                    else doc[self.content_field]
+                ),
+                "summary": nonewlines(doc["Summary"]),
+                "url": doc[self.sourcepage_field],
+                "score": doc["@search.fused_score"],
+            }
+            for doc in docs
+        ]
+        request_trace.payload("results_formatted", results_formatted)
+        return search_query, results_formatted
+
+    def get_semantic_cache_scope(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        query_vector: Optional[np.ndarray],
+    ) -> Optional[str]:
+        # Only first questions can share an answer, follow-ups depend on the conversation
+        if (
+            self.answer_cache is None
+            or query_vector is None
+            or len(history) > 1
+        ):
+            return None
+        return AnswerCache.make_scope("chat", overrides)
+
+    async def generate_search_query_and_vector(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        request_trace: RequestTrace,
+    ) -> tuple[str, Optional[np.ndarray]]:
         has_vector = overrides.get("retrieval_mode") in [
             "vectors",
             "hybrid",
             None,
         ]
-        use_semantic_captions = (
-            True if overrides.get("semantic_captions") and has_text else False
-        )
-        top = overrides.get("top") or 3
         original_user_question = history[-1]["user"]
-        print(f">>>>>>>HISTORY:\n\n{json.dumps(history, indent=4)}\n\n")
+        request_trace.payload("history", history)
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        search_query_messages = self.get_messages_from_history(
+        search_query_message_builder = self.get_messages_from_history(
             search_query_prompt,
             self.chatgpt_model,
             history,
             "Generate search query for: " + original_user_question,
             search_query_prompt_few_shots,
-            max_tokens=self.chatgpt_token_limit - len(search_query_prompt),
+            completion_tokens=32,
         )
 
-        search_query_completion = await openai.ChatCompletion.acreate(
-            deployment_id=self.chatgpt_deployment,
-            model=self.chatgpt_model,
-            messages=search_query_messages,
-            temperature=0.0,
-            max_tokens=32,
-            n=1,
-        )
+        with request_trace.stage("search_query"):
+            search_query_completion = await self.openai_scheduler.chat_completion(
+                prompt_tokens=search_query_message_builder.token_length,
+                deployment_id=self.chatgpt_deployment,
+                model=self.chatgpt_model,
+                messages=search_query_message_builder.messages,
+                temperature=0.0,
+                max_tokens=32,
+                n=1,
+            )
 
         search_query = search_query_completion.choices[0].message.content
         if search_query.strip() == "0":
-            search_query = history[-1][
-                "user"
-            ]  # Use the last user input if we failed to generate a better query
-        print(f">>>>>>>SEARCH_QUERY: {search_query}\n\n")
+            search_query = original_user_question  # Use the last user input if we failed to generate a better query
+        request_trace.attribute("search_query", search_query)
 
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
         # If retrieval mode includes vectors, compute an embedding for the query
-        if has_vector:
-            query_vector = (
-                await openai.Embedding.acreate(
-                    engine=self.embedding_deployment, input=search_query
-                )
-            )["data"][0]["embedding"]
-            title_embedding = Vector(
-                value=query_vector, k=top, fields="title_embedding"
-            )
-            content_embedding = Vector(
-                value=query_vector, k=top, fields="content_embedding"
-            )
-            summary_embedding = Vector(
-                value=query_vector, k=top, fields="summary_embedding"
-            )
-        else:
-            query_vector = None
-
-        # Only keep the text query if the retrieval mode uses text, otherwise drop it
-        if not has_text:
-            search_query = None
-
-        # Classify the data source that is most likely to contain the answer
-        source_clf_messages = self.get_messages_from_history(
+        if not has_vector:
+            return search_query, None
+        with request_trace.stage("embedding"):
+            query_vector = await self.embeddings.embed(search_query)
+        return search_query, query_vector
+
+    async def classify_data_sources(
+        self, user_question: str, request_trace: RequestTrace
+    ) -> list[str]:
+        # Classify the data source that is most likely to answer the question, locally
+        # from the question's embedding, and with the LLM only if that isn't confident.
+        # It doesn't depend on the search query, so it runs while that is generated.
+        question_vector = None
+        if self.source_classifier.centroids is not None:
+            with request_trace.stage("source_clf_embedding"):
+                question_vector = await self.embeddings.embed(user_question)
+        data_sources = self.source_classifier.classify(user_question, question_vector)
+        request_trace.attribute("source_clf_local", data_sources is not None)
+        if data_sources is not None:
+            return data_sources
+
+        source_clf_message_builder = self.get_messages_from_history(
             source_clf_prompt,
             self.chatgpt_model,
-            # history,
             [],
-            # "User question: " + original_user_question,
-            "User Question: " + search_query,
-            max_tokens=self.chatgpt_token_limit - len(source_clf_prompt),
+            "User Question: " + user_question,
+            completion_tokens=32,
         )
 
-        source_clf_completion = await openai.ChatCompletion.acreate(
-            deployment_id=self.chatgpt_deployment,
-            model=self.chatgpt_model,
-            messages=source_clf_messages,
-            temperature=0.0,
-            max_tokens=32,
-            n=1,
-        )
+        with request_trace.stage("source_clf"):
+            source_clf_completion = await self.openai_scheduler.chat_completion(
+                prompt_tokens=source_clf_message_builder.token_length,
+                deployment_id=self.chatgpt_deployment,
+                model=self.chatgpt_model,
+                messages=source_clf_message_builder.messages,
+                temperature=0.0,
+                max_tokens=32,
+                n=1,
+            )
         data_source_ids = source_clf_completion.choices[0].message.content
-        data_sources = [
+        return [
             self.id_to_data_source.get(data_source_id.strip(), "Unknown")
             for data_source_id in data_source_ids.split(",")
         ]
 
-        filter = (
-            f"search.in(Storage, '{','.join(data_sources)}', ',')"
-            if "Unknown" not in data_sources
-            else None
-        )
-        print(f">>>>>>>SEARCH_FILTER: {filter}\n\n")
-
-        # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                search_query,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language="en-us",
-                query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=top,
-                query_caption=None,
-                vectors=[title_embedding, content_embedding, summary_embedding]
-                if query_vector
-                else None,
-            )
-        else:
-            r = await self.search_client.search(
-                search_query,
-                filter=filter,
-                top=top,
-                vectors=[title_embedding, content_embedding, summary_embedding]
-                if query_vector
-                else None,
-            )
-        if use_semantic_captions:
-            results_formatted = [
-                {
-                    "title": doc["FileName"],
-                    "content": nonewlines(
-                        " . ".join([c.text for c in doc["@search.captions"]])
-                    ),
-                    "summary": nonewlines(doc["Summary"]),
-                    "url": doc[self.sourcepage_field],
-                }
-                async for doc in r
-            ]
-        else:
-            results_formatted = [
-                {
-                    "title": doc["FileName"],
-                    "content": nonewlines(doc[self.content_field]),
-                    "summary": nonewlines(doc["Summary"]),
-                    "url": doc[self.sourcepage_field],
-                }
-                async for doc in r
-            ]
-        print(
-            f">>>>>>>RESULTS_FORMATTED:\n\n{json.dumps(results_formatted, indent=4)}\n\n"
-        )
-
-        results = [
+    def get_data_points(
+        self, results_formatted: list[dict[str, str]]
+    ) -> list[str]:
+        return [
             res["url"] + ": " + res["content"] for res in results_formatted
         ]
-        content = "\n".join(results)
+
+    def get_ai_response_messages(
+        self,
+        history: list[dict[str, str]],
+        overrides: dict[str, Any],
+        results_formatted: list[dict[str, str]],
+        request_trace: RequestTrace,
+    ) -> tuple[list, dict[str, int]]:
+        original_user_question = history[-1]["user"]
 
         follow_up_questions_prompt = (
             follow_up_questions_prompt_content
@@ -238,38 +494,69 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 follow_up_questions_prompt=follow_up_questions_prompt
             )
 
-        ai_response_messages = self.get_messages_from_history(
-            ai_response_prompt,
-            self.gpt4_model,
-            history,
-            "User Question:\n"
-            + original_user_question
-            + "\n\nSources:\n"
-            + content,  # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
-            max_tokens=self.gpt4_token_limit - len(ai_response_prompt),
+        # Sources and history share one token budget. The sources, best first, are packed
+        # into their share, and the history fills what is left, including the share the
+        # sources didn't use.
+        prompt_budget = self.gpt4_token_limit - self.ANSWER_COMPLETION_TOKENS
+        if self.answer_prompt_tokens:
+            prompt_budget = min(prompt_budget, self.answer_prompt_tokens)
+        message_builder = MessageBuilder(ai_response_prompt, self.gpt4_model)
+        system_tokens = message_builder.token_length
+        question = "User Question:\n" + original_user_question + "\n\nSources:\n"
+        message_builder.set_last_message(USER, question)
+        question_tokens = message_builder.token_length - system_tokens
+        sources_budget = int(
+            (prompt_budget - message_builder.token_length) * self.sources_share
         )
-        print(
-            f">>>>>>>AI_RESPONSE_MESSAGES:\n\n{json.dumps(ai_response_messages, indent=4)}\n\n"
+        sources, _ = self.context_packer.pack(results_formatted, sources_budget)
+        # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
+        message_builder.set_last_message(USER, question + "\n".join(sources))
+        sources_tokens = (
+            message_builder.token_length - system_tokens - question_tokens
         )
+        history_turns = message_builder.add_history(history[:-1], prompt_budget)
+
+        ai_response_messages = message_builder.messages
+        token_usage = {
+            "budget": prompt_budget,
+            "system": system_tokens,
+            "question": question_tokens,
+            "sources": sources_tokens,
+            "history": message_builder.token_length
+            - system_tokens
+            - question_tokens
+            - sources_tokens,
+            "total": message_builder.token_length,
+            "sources_packed": len(sources),
+            "sources_retrieved": len(results_formatted),
+            "history_turns": history_turns,
+        }
+        request_trace.payload("ai_response_messages", ai_response_messages)
+        request_trace.payload("token_usage", token_usage)
+        return ai_response_messages, token_usage
 
-        ai_response_completion = await openai.ChatCompletion.acreate(
-            deployment_id=self.gpt4_deployment,
-            model=self.gpt4_model,
-            messages=ai_response_messages,
-            temperature=overrides.get("temperature") or self.RESPONSE_TEMP,
-            max_tokens=1024,
-            n=1,
-        )
-
-        ai_response = ai_response_completion.choices[0].message.content
-        print(f">>>>>>>ORIGINAL_RESPONSE:\n\n{ai_response}\n\n")
-
-        msg_to_display = "\n\n".join(
-            [json.dumps(message, indent=4) for message in ai_response_messages]
+    async def validate(
+        self,
+        ai_response: str,
+        results_formatted: list[dict[str, str]],
+        overrides: dict[str, Any],
+        request_trace: RequestTrace,
+    ) -> str:
+        # STEP 4: Validate the response and make sure it complies with the rules. The LLM
+        # validator only runs when the validation mode asks for it.
+        validated_response = await self.validator.validate(
+            ai_response,
+            [res["url"] for res in results_formatted],
+            lambda response: self.validate_with_llm(response, results_formatted),
+            overrides.get("validation"),
         )
+        request_trace.payload("validated_response", validated_response)
+        return validated_response
 
-        # STEP 4: Validate the response and make sure it complies with the rules
-        response_val_messages = self.get_messages_from_history(
+    async def validate_with_llm(
+        self, ai_response: str, results_formatted: list[dict[str, str]]
+    ) -> str:
+        response_val_message_builder = self.get_messages_from_history(
             response_val_prompt,
             self.chatgpt_model,
             [],
@@ -277,29 +564,52 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             + ai_response
             + "\n\n\Source URLs:\n"
             + "\n".join([res["url"] for res in results_formatted]),
-            max_tokens=self.chatgpt_token_limit - len(response_val_prompt),
+            completion_tokens=1024,
         )
-        response_val_completion = await openai.ChatCompletion.acreate(
+        response_val_completion = await self.openai_scheduler.chat_completion(
+            prompt_tokens=response_val_message_builder.token_length,
             deployment_id=self.chatgpt_deployment,
             model=self.chatgpt_model,
-            messages=response_val_messages,
+            messages=response_val_message_builder.messages,
             temperature=self.VALIDATION_TEMP,
             max_tokens=1024,
             n=1,
         )
-        validated_response = response_val_completion.choices[0].message.content
-        print(f">>>>>>>VALIDATED_RESPONSE:\n\n{validated_response}\n\n")
+        return response_val_completion.choices[0].message.content
 
-        thoughts = (
-            f"Searched for:<br>{search_query}<br><br>Conversations:<br>"
-            + msg_to_display.replace("\n", "<br>").replace("\\n", "<br>")
-        )
+    def make_result(
+        self,
+        search_query: str,
+        results_formatted: list[dict[str, str]],
+        ai_response_messages: list,
+        answer: str,
+        overrides: dict[str, Any],
+        token_usage: dict[str, int],
+        request_trace: RequestTrace,
+    ) -> dict[str, Any]:
+        timings = request_trace.summary()
+
+        # The thoughts are only rendered for clients that display them
+        thoughts = None
+        if overrides.get("include_thoughts"):
+            msg_to_display = "\n\n".join(
+                [
+                    json.dumps(message, indent=4)
+                    for message in ai_response_messages
+                ]
+            )
+            thoughts = (
+                f"Searched for:<br>{search_query}<br><br>Conversations:<br>"
+                + self.NEWLINES.sub("<br>", msg_to_display)
+            )
 
         return {
-            "data_points": results,
+            "data_points": self.get_data_points(results_formatted),
             "results_formatted": results_formatted,
-            "answer": validated_response,
+            "answer": answer,
             "thoughts": thoughts,
+            "timings": timings,
+            "token_usage": token_usage,
         }
 
     def get_messages_from_history(
@@ -309,8 +619,8 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         history: list[dict[str, str]],
         user_conv: str,
         few_shots=[],
-        max_tokens: int = 4096,
-    ) -> list:
+        completion_tokens: int = 1024,
+    ) -> MessageBuilder:
         message_builder = MessageBuilder(system_prompt, model_id)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
@@ -319,22 +629,12 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 shot.get("role"), shot.get("content")
             )
 
-        user_content = user_conv
-        append_index = len(few_shots) + 1
+        message_builder.set_last_message(USER, user_conv)
 
-        message_builder.append_message(USER, user_content, index=append_index)
-
-        for h in reversed(history[:-1]):
-            if bot_msg := h.get("bot"):
-                message_builder.append_message(
-                    ASSISTANT, bot_msg, index=append_index
-                )
-            if user_msg := h.get("user"):
-                message_builder.append_message(
-                    USER, user_msg, index=append_index
-                )
-            if message_builder.token_length > max_tokens:
-                break
+        # Fill the rest of the context window, minus the tokens reserved for the completion,
+        # with as many of the previous turns as fit
+        message_builder.add_history(
+            history[:-1], get_token_limit(model_id) - completion_tokens
+        )
 
-        messages = message_builder.messages
-        return messages
+        return message_builder
@@ -0,0 +1,60 @@
+from typing import Any, AsyncGenerator
+
+from approaches.approach import AskApproach, ChatApproach
+from core.answercache import AnswerCache
+from core.coalescing import RequestCoalescer
+
+
+class CoalescedChatApproach(ChatApproach):
+    """
+    Runs concurrent identical requests (same normalized history and overrides) once,
+    see RequestCoalescer.
+    """
+
+    def __init__(
+        self, name: str, approach: ChatApproach, coalescer: RequestCoalescer
+    ):
+        self.name = name
+        self.approach = approach
+        self.coalescer = coalescer
+
+    async def run(
+        self, history: list[dict[str, str]], overrides: dict[str, Any]
+    ) -> Any:
+        key = AnswerCache.make_chat_key(self.name, history, overrides)
+        return await self.coalescer.run(
+            ("chat", key), lambda: self.approach.run(history, overrides)
+        )
+
+    def run_stream(
+        self, history: list[dict[str, str]], overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        # Returns the coalescer's stream itself, so that closing it on a disconnect
+        # detaches the client right away
+        key = AnswerCache.make_chat_key(self.name, history, overrides)
+        return self.coalescer.stream(
+            ("chat_stream", key), lambda: self.approach.run_stream(history, overrides)
+        )
+
+
+class CoalescedAskApproach(AskApproach):
+    def __init__(
+        self, name: str, approach: AskApproach, coalescer: RequestCoalescer
+    ):
+        self.name = name
+        self.approach = approach
+        self.coalescer = coalescer
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        key = AnswerCache.make_ask_key(self.name, q, overrides)
+        return await self.coalescer.run(
+            ("ask", key), lambda: self.approach.run(q, overrides)
+        )
+
+    def run_stream(
+        self, q: str, overrides: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        key = AnswerCache.make_ask_key(self.name, q, overrides)
+        return self.coalescer.stream(
+            ("ask_stream", key), lambda: self.approach.run_stream(q, overrides)
+        )
@@ -1,28 +1,52 @@
+import asyncio
 import re
-from typing import Any, Optional, Sequence
+from typing import Any, Optional
 
 import openai
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 from langchain.agents import AgentExecutor, Tool
 from langchain.agents.react.base import ReActDocstoreAgent
-from langchain.callbacks.manager import CallbackManager
+from langchain.chains import LLMChain
 from langchain.llms.openai import AzureOpenAI
-from langchain.prompts import BasePromptTemplate, PromptTemplate
-from langchain.tools.base import BaseTool
+from langchain.prompts import PromptTemplate
+from langchain.schema import AgentAction, AgentFinish
 
-from approaches.approach import AskApproach
-from langchainadapters import HtmlCallbackHandler
+from approaches.approach import AskApproach, RequestState, request_state
+from core.embeddings import EmbeddingService
+from core.ratelimit import OpenAIScheduler
+from core.singleflight import SingleFlight
+from core.tracing import RequestTrace
+from core.ttlcache import TTLCache
+from langchainadapters import HtmlCallbackHandler, ch
 from text import nonewlines
 
+MISSING = object()
+
 
 class ReadDecomposeAsk(AskApproach):
-    def __init__(self, search_client: SearchClient, openai_deployment: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, embeddings: EmbeddingService, sourcepage_field: str, content_field: str,
+                 max_iterations: int = 8, max_execution_time: Optional[float] = 60.0, mode: str = "react", max_subquestions: int = 4,
+                 lookup_cache_size: int = 1024, lookup_cache_ttl: float = 300, openai_scheduler: Optional[OpenAIScheduler] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
-        self.embedding_deployment = embedding_deployment
+        self.embeddings = embeddings
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.max_iterations = max_iterations
+        self.max_execution_time = max_execution_time
+        self.mode = mode
+        self.max_subquestions = max_subquestions
+        self.openai_scheduler = openai_scheduler or OpenAIScheduler()
+        self.tools = [
+            Tool(name="Search", func=lambda _: 'Not implemented', coroutine=self.search_and_store, description="useful for when you need to ask with search"),
+            Tool(name="Lookup", func=lambda _: 'Not implemented', coroutine=self.lookup, description="useful for when you need to ask with lookup")
+        ]
+        self.prompts = TTLCache(maxsize=32)
+        self.agent_executors = TTLCache(maxsize=32)
+        self.llms = TTLCache(maxsize=32)
+        self.lookup_cache = TTLCache(maxsize=lookup_cache_size, ttl=lookup_cache_ttl)
+        self.lookups = SingleFlight()
 
     async def search(self, query_text: str, overrides: dict[str, Any]) -> tuple[list[str], str]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
@@ -34,7 +58,7 @@ class ReadDecomposeAsk(AskApproach):
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=query_text))["data"][0]["embedding"]
+            query_vector = (await self.embeddings.embed(query_text)).tolist()
         else:
             query_vector = None
 
@@ -68,6 +92,16 @@ class ReadDecomposeAsk(AskApproach):
         return results, "\n".join(results)
 
     async def lookup(self, q: str) -> Optional[str]:
+        # Agents repeat the same Lookup terms across hops and across users, and the result doesn't
+        # depend on the request's overrides
+        key = " ".join(q.split()).casefold()
+        result = self.lookup_cache.get(key, MISSING)
+        if result is MISSING:
+            result = await self.lookups.do(key, lambda: self.lookup_uncached(q))
+            self.lookup_cache.set(key, result)
+        return result
+
+    async def lookup_uncached(self, q: str) -> Optional[str]:
         r = await self.search_client.search(q,
                                       top = 1,
                                       include_total_count=True,
@@ -78,49 +112,153 @@ class ReadDecomposeAsk(AskApproach):
                                       query_answer="extractive|count-1",
                                       query_caption="extractive|highlight-false")
 
+        # Read the top document first: answers and count then come from the same response, while
+        # asking for them first and iterating afterwards sends the search a second time
+        top_doc = None
+        async for doc in r:
+            top_doc = doc
+            break
         answers = await r.get_answers()
-        if answers and len(answers) > 0:
+        if answers:
             return answers[0].text
-        if await r.get_count() > 0:
-            return "\n".join([d['content'] async for d in r])
+        if top_doc is not None and await r.get_count() > 0:
+            return top_doc[self.content_field]
         return None
 
     async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        if (overrides.get("rda_mode") or self.mode) == "decomposed":
+            return await self.run_decomposed(q, overrides)
+        return await self.run_react(q, overrides)
 
-        search_results = None
-        async def search_and_store(q: str) -> Any:
-            nonlocal search_results
-            search_results, content = await self.search(q, overrides)
-            return content
+    async def run_react(self, q: str, overrides: dict[str, Any]) -> Any:
+        agent_exec = self.get_agent_executor(overrides.get("prompt_template"), overrides.get("temperature") or 0.3)
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
+        request = RequestState(overrides)
+        token = request_state.set(request)
+        try:
+            result = await agent_exec.arun(q, callbacks=[cb_handler])
+        finally:
+            request_state.reset(token)
 
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
-        tools = [
-            Tool(name="Search", func=lambda _: 'Not implemented', coroutine=search_and_store, description="useful for when you need to ask with search", callbacks=cb_manager),
-            Tool(name="Lookup", func=lambda _: 'Not implemented', coroutine=self.lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
-        ]
+        # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid
+        # generalizing too much and disrupt HTML snippets if present
+        result = re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", result)
+
+        return {"data_points": request.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log() if overrides.get("include_thoughts") else None}
+
+    async def run_decomposed(self, q: str, overrides: dict[str, Any]) -> Any:
+        """
+        Answers in a fixed number of round trips instead of one per ReAct hop: one completion splits
+        the question into sub-questions, the search and lookup for every sub-question run concurrently,
+        and one more completion writes the answer from all the observations.
+        """
+        request_trace = RequestTrace()
+        llm = self.get_llm(overrides.get("temperature") or 0.3)
+
+        with request_trace.stage("decompose"):
+            decomposition = await llm.apredict(DECOMPOSE_PROMPT.format(max_subquestions=self.max_subquestions, input=q))
+        sub_questions = self.parse_sub_questions(decomposition) or [q]
+        request_trace.payload("sub_questions", sub_questions)
+
+        # Lookups are speculative: ReAct only looks up when a search doesn't answer a sub-question,
+        # but running both at once costs no extra round trip
+        with request_trace.stage("retrieve"):
+            retrieved = await asyncio.gather(
+                *[self.search(sub_question, overrides) for sub_question in sub_questions],
+                *[self.lookup(sub_question) for sub_question in sub_questions])
+        searches, lookups = retrieved[:len(sub_questions)], retrieved[len(sub_questions):]
+
+        data_points = list(dict.fromkeys(result for results, _ in searches for result in results))
+        observations = "\n\n".join(
+            f"Sub-question: {sub_question}\n{content}" + (f"\nLookup: {answer}" if answer else "")
+            for sub_question, (_, content), answer in zip(sub_questions, searches, lookups))
 
         prompt_prefix = overrides.get("prompt_template")
-        prompt = PromptTemplate.from_examples(
-            EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
+        synthesis_prompt = SYNTHESIS_PROMPT.format(input=q, observations=observations)
+        if prompt_prefix:
+            synthesis_prompt = prompt_prefix + "\n\n" + synthesis_prompt
+        with request_trace.stage("synthesis"):
+            result = await llm.apredict(synthesis_prompt)
+        result = re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", result.strip())
 
-        class ReAct(ReActDocstoreAgent):
-            @classmethod
-            def create_prompt(cls, tools: Sequence[BaseTool]) -> BasePromptTemplate:
-                return prompt
+        thoughts = None
+        if overrides.get("include_thoughts"):
+            thoughts = "Sub-questions:<br>" + "<br>".join(ch(sub_question) for sub_question in sub_questions) + "<br><br>Prompt:<br>" + ch(synthesis_prompt)
+        return {"data_points": data_points, "answer": result, "thoughts": thoughts, "timings": request_trace.summary()}
 
-        agent = ReAct.from_llm_and_tools(llm, tools)
-        chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = await chain.arun(q)
+    def parse_sub_questions(self, decomposition: str) -> list[str]:
+        sub_questions = []
+        for line in decomposition.splitlines():
+            line = SUB_QUESTION_PREFIX.sub("", line).strip()
+            if line and line not in sub_questions:
+                sub_questions.append(line)
+        return sub_questions[:self.max_subquestions]
+
+    def get_llm(self, temperature: float) -> AzureOpenAI:
+        llm = self.llms.get(temperature)
+        if llm is None:
+            llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=temperature, openai_api_key=openai.api_key,
+                              request_timeout=self.max_execution_time, max_retries=1)
+            # The LLM's calls are scheduled against the deployment's quota like the others, and
+            # the scheduler retries rate limited ones, so langchain makes a single attempt
+            llm.client = self.openai_scheduler.completion_client()
+            self.llms.set(temperature, llm)
+        return llm
+
+    async def search_and_store(self, q: str) -> Any:
+        request = request_state.get()
+        request.results, content = await self.search(q, request.overrides)
+        return content
+
+    def get_agent_executor(self, prompt_prefix: Optional[str], temperature: float) -> AgentExecutor:
+        """
+        Returns the agent executor for the given prompt template and temperature overrides. Executors
+        hold no per-request state, so they are built once and shared by all requests.
+        """
+        key = (prompt_prefix, temperature)
+        agent_exec = self.agent_executors.get(key)
+        if agent_exec is None:
+            prompt = self.prompts.get(prompt_prefix)
+            if prompt is None:
+                prompt = PromptTemplate.from_examples(
+                    EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
+                self.prompts.set(prompt_prefix, prompt)
+            agent = ReAct(llm_chain=LLMChain(llm=self.get_llm(temperature), prompt=prompt), allowed_tools=[tool.name for tool in self.tools])
+            agent_exec = BudgetedAgentExecutor.from_agent_and_tools(agent, self.tools, verbose=True,
+                                                                    max_iterations=self.max_iterations,
+                                                                    time_budget=self.max_execution_time)
+            self.agent_executors.set(key, agent_exec)
+        return agent_exec
 
-        # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid
-        # generalizing too much and disrupt HTML snippets if present
-        result = re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", result)
 
-        return {"data_points": search_results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+class BudgetedAgentExecutor(AgentExecutor):
+    """
+    Stops the agent loop once `time_budget` seconds have passed. Unlike `max_execution_time`, which
+    cancels the step in flight and loses the steps taken so far on Python 3.11, the budget is checked
+    between steps, so the agent can still return a partial answer; each step is bounded by the LLM's
+    request timeout.
+    """
+    time_budget: Optional[float] = None
+
+    def _should_continue(self, iterations: int, time_elapsed: float) -> bool:
+        if self.time_budget is not None and time_elapsed >= self.time_budget:
+            return False
+        return super()._should_continue(iterations, time_elapsed)
+
+class ReAct(ReActDocstoreAgent):
+    def return_stopped_response(self, early_stopping_method: str, intermediate_steps: list[tuple[AgentAction, str]], **kwargs: Any) -> AgentFinish:
+        """
+        Called when the executor runs out of iterations or time. Instead of asking the model for a
+        final answer, which would take another (synchronous) completion call, return the observations
+        gathered so far, with their source names, as a partial answer.
+        """
+        observations = [observation for _, observation in intermediate_steps if observation]
+        if not observations:
+            return AgentFinish({"output": "I couldn't find the answer in time, please try rephrasing the question."}, "")
+        output = "I couldn't complete the answer in time, but this is what I found:\n" + "\n".join(observations)
+        return AgentFinish({"output": output}, output)
 
 
 
@@ -237,3 +375,18 @@ PREFIX = "Answer questions as shown in the following examples, by splitting the
 "Observations are prefixed by their source name in angled brackets, source names MUST be included with the actions in the answers." \
 "All questions must be answered from the results from search or look up actions, only facts resulting from those can be used in an answer. "
 "Answer questions as truthfully as possible, and ONLY answer the questions using the information from observations, do not speculate or your own knowledge."
+
+# Prompts of the decomposed mode
+DECOMPOSE_PROMPT = """Split the question below into the individual facts that need to be searched for to answer it. Write one short, self-contained search question per line, at most {max_subquestions}, and nothing else. If the question asks for a single fact, repeat it as the only line.
+
+Question: {input}
+Sub-questions:
+"""
+SYNTHESIS_PROMPT = """Answer the question using only the observations below. Observations are the results of searching for each sub-question; each search result starts with its source name followed by a colon. Include the source name in angled brackets after each fact you use, for example <info1.pdf>. If the observations don't contain the answer, say that you don't know, do not speculate or use your own knowledge.
+
+Observations:
+{observations}
+
+Question: {input}
+Answer:"""
+SUB_QUESTION_PREFIX = re.compile(r"^\s*(?:[-*\u2022]|\d+[.)])\s*")
@@ -1,14 +1,17 @@
-from typing import Any
+from typing import Any, Optional
 
 import openai
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 from langchain.agents import AgentExecutor, Tool, ZeroShotAgent
-from langchain.callbacks.manager import CallbackManager, Callbacks
+from langchain.callbacks.manager import Callbacks
 from langchain.chains import LLMChain
 from langchain.llms.openai import AzureOpenAI
 
-from approaches.approach import AskApproach
+from approaches.approach import AskApproach, RequestState, request_state
+from core.embeddings import EmbeddingService
+from core.ratelimit import OpenAIScheduler
+from core.ttlcache import TTLCache
 from langchainadapters import HtmlCallbackHandler
 from lookuptool import CsvLookupTool
 from text import nonewlines
@@ -47,12 +50,17 @@ Thought: {agent_scratchpad}"""
 
     CognitiveSearchToolDescription = "useful for searching the Microsoft employee benefits information such as healthcare plans, retirement plans, etc."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, embeddings: EmbeddingService, sourcepage_field: str, content_field: str,
+                 openai_scheduler: Optional[OpenAIScheduler] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
-        self.embedding_deployment = embedding_deployment
+        self.embeddings = embeddings
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.openai_scheduler = openai_scheduler or OpenAIScheduler()
+        self.tools: Optional[list[Tool]] = None
+        self.prompts = TTLCache(maxsize=32)
+        self.agent_executors = TTLCache(maxsize=32)
 
     async def retrieve(self, query_text: str, overrides: dict[str, Any]) -> Any:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
@@ -64,7 +72,7 @@ Thought: {agent_scratchpad}"""
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=query_text))["data"][0]["embedding"]
+            query_vector = (await self.embeddings.embed(query_text)).tolist()
         else:
             query_vector = None
 
@@ -100,43 +108,71 @@ Thought: {agent_scratchpad}"""
         return results, content
 
     async def run(self, q: str, overrides: dict[str, Any]) -> Any:
-
-        retrieve_results = None
-        async def retrieve_and_store(q: str) -> Any:
-            nonlocal retrieve_results
-            retrieve_results, content = await self.retrieve(q, overrides)
-            return content
+        agent_exec = self.get_agent_executor(
+            overrides.get("prompt_template_prefix") or self.template_prefix,
+            overrides.get("prompt_template_suffix") or self.template_suffix,
+            overrides.get("temperature") or 0.3)
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
-
-        acs_tool = Tool(name="CognitiveSearch",
-                        func=lambda _: 'Not implemented',
-                        coroutine=retrieve_and_store,
-                        description=self.CognitiveSearchToolDescription,
-                        callbacks=cb_manager)
-        employee_tool = EmployeeInfoTool("Employee1", callbacks=cb_manager)
-        tools = [acs_tool, employee_tool]
-
-        prompt = ZeroShotAgent.create_prompt(
-            tools=tools,
-            prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
-            suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
-            input_variables = ["input", "agent_scratchpad"])
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
-        chain = LLMChain(llm = llm, prompt = prompt)
-        agent_exec = AgentExecutor.from_agent_and_tools(
-            agent = ZeroShotAgent(llm_chain = chain),
-            tools = tools,
-            verbose = True,
-            callback_manager = cb_manager)
-        result = await agent_exec.arun(q)
+        request = RequestState(overrides)
+        token = request_state.set(request)
+        try:
+            result = await agent_exec.arun(q, callbacks=[cb_handler])
+        finally:
+            request_state.reset(token)
 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
 
-        return {"data_points": retrieve_results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": request.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log() if overrides.get("include_thoughts") else None}
+
+    async def retrieve_and_store(self, q: str) -> Any:
+        request = request_state.get()
+        request.results, content = await self.retrieve(q, request.overrides)
+        return content
+
+    def get_tools(self) -> list[Tool]:
+        # Built on first use rather than in __init__ so a missing employee file only fails this approach
+        if self.tools is None:
+            acs_tool = Tool(name="CognitiveSearch",
+                            func=lambda _: 'Not implemented',
+                            coroutine=self.retrieve_and_store,
+                            description=self.CognitiveSearchToolDescription)
+            employee_tool = EmployeeInfoTool("Employee1")
+            self.tools = [acs_tool, employee_tool]
+        return self.tools
+
+    def get_agent_executor(self, prefix: str, suffix: str, temperature: float) -> AgentExecutor:
+        """
+        Returns the agent executor for the given prompt and temperature overrides. Executors hold no
+        per-request state (callbacks are passed to each run and retrieved results travel through
+        `request_state`), so they are built once and shared by all requests.
+        """
+        key = (prefix, suffix, temperature)
+        agent_exec = self.agent_executors.get(key)
+        if agent_exec is None:
+            tools = self.get_tools()
+            prompt = self.prompts.get((prefix, suffix))
+            if prompt is None:
+                prompt = ZeroShotAgent.create_prompt(
+                    tools=tools,
+                    prefix=prefix,
+                    suffix=suffix,
+                    input_variables = ["input", "agent_scratchpad"])
+                self.prompts.set((prefix, suffix), prompt)
+            llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=temperature, openai_api_key=openai.api_key,
+                              max_retries=1)
+            # The LLM's calls are scheduled against the deployment's quota like the others, and
+            # the scheduler retries rate limited ones, so langchain makes a single attempt
+            llm.client = self.openai_scheduler.completion_client()
+            chain = LLMChain(llm = llm, prompt = prompt)
+            agent_exec = AgentExecutor.from_agent_and_tools(
+                agent = ZeroShotAgent(llm_chain = chain),
+                tools = tools,
+                verbose = True)
+            self.agent_executors.set(key, agent_exec)
+        return agent_exec
 
 class EmployeeInfoTool(CsvLookupTool):
     employee_name: str = ""
@@ -1,11 +1,13 @@
-from typing import Any
+from typing import Any, Optional
 
-import openai
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 
 from approaches.approach import AskApproach
+from core.answercache import AnswerCache
+from core.embeddings import EmbeddingService
 from core.messagebuilder import MessageBuilder
+from core.ratelimit import OpenAIScheduler
 from text import nonewlines
 
 
@@ -36,13 +38,16 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
 """
     answer = "In-network deductibles are $500 for employee and $1000 for family [info1.txt] and Overlake is in-network for the employee plan [info2.pdf][info4.pdf]."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, chatgpt_model: str, embeddings: EmbeddingService, sourcepage_field: str, content_field: str,
+                 answer_cache: Optional[AnswerCache] = None, openai_scheduler: Optional[OpenAIScheduler] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.chatgpt_model = chatgpt_model
-        self.embedding_deployment = embedding_deployment
+        self.embeddings = embeddings
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.answer_cache = answer_cache
+        self.openai_scheduler = openai_scheduler or OpenAIScheduler()
 
     async def run(self, q: str, overrides: dict[str, Any]) -> Any:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
@@ -53,8 +58,16 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
         # If retrieval mode includes vectors, compute an embedding for the query
+        semantic_cache_scope = None
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=q))["data"][0]["embedding"]
+            embedding = await self.embeddings.embed(q)
+            query_vector = embedding.tolist()
+            # A similar question was answered already, so neither search nor answer it again
+            if self.answer_cache:
+                semantic_cache_scope = AnswerCache.make_scope("rtr", overrides)
+                cached = await self.answer_cache.get_similar(semantic_cache_scope, embedding)
+                if cached is not None:
+                    return cached
         else:
             query_vector = None
 
@@ -89,16 +102,17 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
 
         message_builder = MessageBuilder(overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model)
 
-        # add user question
-        user_content = q + "\n" + f"Sources:\n {content}"
-        message_builder.append_message('user', user_content)
-
         # Add shots/samples. This helps model to mimic response and make sure they match rules laid out in system message.
-        message_builder.append_message('assistant', self.answer)
         message_builder.append_message('user', self.question)
+        message_builder.append_message('assistant', self.answer)
+
+        # add user question
+        user_content = q + "\n" + f"Sources:\n {content}"
+        message_builder.set_last_message('user', user_content)
 
         messages = message_builder.messages
-        chat_completion = await openai.ChatCompletion.acreate(
+        chat_completion = await self.openai_scheduler.chat_completion(
+            prompt_tokens=message_builder.token_length,
             deployment_id=self.openai_deployment,
             model=self.chatgpt_model,
             messages=messages,
@@ -106,4 +120,11 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
             max_tokens=1024,
             n=1)
 
-        return {"data_points": results, "answer": chat_completion.choices[0].message.content, "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])}
+        # The thoughts are only rendered for clients that display them
+        thoughts = None
+        if overrides.get("include_thoughts"):
+            thoughts = f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])
+        result = {"data_points": results, "answer": chat_completion.choices[0].message.content, "thoughts": thoughts}
+        if semantic_cache_scope:
+            await self.answer_cache.set_similar(semantic_cache_scope, embedding, result)
+        return result
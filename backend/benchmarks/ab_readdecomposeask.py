@@ -0,0 +1,107 @@
+"""
+A/B comparison of ReadDecomposeAsk's "react" and "decomposed" modes against the configured
+Azure OpenAI and Cognitive Search services. Every question is answered in both modes, and the
+latency, the answer similarity and the overlap of the retrieved sources are reported per question
+and on average.
+
+Run from the backend directory, with the same environment as the app:
+    python -m benchmarks.ab_readdecomposeask questions.txt [--runs 1] [--output results.jsonl]
+
+questions.txt has one question per line.
+"""
+import argparse
+import asyncio
+import difflib
+import json
+import re
+import time
+from statistics import mean, median
+from typing import Any
+
+import openai
+
+from app import CONFIG_ASK_APPROACHES, CONFIG_OPENAI_SESSION, create_app
+
+SOURCE = re.compile(r"\[([^\[\]]+)\]")
+
+
+def sources(data_points: list[str]) -> set[str]:
+    return {data_point.split(":", 1)[0] for data_point in data_points}
+
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+async def run_mode(approach: Any, question: str, mode: str) -> dict[str, Any]:
+    start = time.perf_counter()
+    try:
+        result = await approach.run(question, {"rda_mode": mode})
+    except Exception as e:
+        return {"ms": round((time.perf_counter() - start) * 1000, 1), "error": repr(e)}
+    return {
+        "ms": round((time.perf_counter() - start) * 1000, 1),
+        "answer": result["answer"],
+        "citations": sorted(set(SOURCE.findall(result["answer"]))),
+        "sources": sorted(sources(result["data_points"])),
+    }
+
+
+def compare(question: str, react: dict[str, Any], decomposed: dict[str, Any]) -> dict[str, Any]:
+    comparison = {"question": question, "react": react, "decomposed": decomposed}
+    if "error" not in react and "error" not in decomposed:
+        comparison["answer_similarity"] = round(difflib.SequenceMatcher(None, react["answer"], decomposed["answer"]).ratio(), 3)
+        comparison["citation_overlap"] = round(jaccard(set(react["citations"]), set(decomposed["citations"])), 3)
+        comparison["source_overlap"] = round(jaccard(set(react["sources"]), set(decomposed["sources"])), 3)
+    return comparison
+
+
+def report(comparisons: list[dict[str, Any]]) -> None:
+    for mode in ["react", "decomposed"]:
+        latencies = [c[mode]["ms"] for c in comparisons if "error" not in c[mode]]
+        errors = sum(1 for c in comparisons if "error" in c[mode])
+        if latencies:
+            print(f"{mode:<11} median {median(latencies):8.0f} ms  max {max(latencies):8.0f} ms  errors {errors}")
+        else:
+            print(f"{mode:<11} errors {errors}")
+    compared = [c for c in comparisons if "answer_similarity" in c]
+    if compared:
+        for metric in ["answer_similarity", "citation_overlap", "source_overlap"]:
+            print(f"{metric:<18} mean {mean(c[metric] for c in compared):.3f}")
+
+
+async def main(questions: list[str], runs: int, output: str) -> None:
+    app = create_app()
+    async with app.test_app():
+        approach = app.config[CONFIG_ASK_APPROACHES]["rda"]
+        # Bypass the answer cache, which would serve every run after the first
+        approach = getattr(approach, "approach", approach)
+        openai.aiosession.set(app.config[CONFIG_OPENAI_SESSION])
+        comparisons = []
+        for _ in range(runs):
+            for question in questions:
+                # Alternate the order so neither mode always benefits from warm caches
+                if len(comparisons) % 2:
+                    decomposed = await run_mode(approach, question, "decomposed")
+                    react = await run_mode(approach, question, "react")
+                else:
+                    react = await run_mode(approach, question, "react")
+                    decomposed = await run_mode(approach, question, "decomposed")
+                comparisons.append(compare(question, react, decomposed))
+                print(json.dumps({k: v for k, v in comparisons[-1].items() if k not in ["react", "decomposed"]}))
+    if output:
+        with open(output, "w") as f:
+            for comparison in comparisons:
+                f.write(json.dumps(comparison) + "\n")
+    report(comparisons)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ReadDecomposeAsk's react and decomposed modes")
+    parser.add_argument("questions", help="File with one question per line")
+    parser.add_argument("--runs", type=int, default=1, help="Number of passes over the questions")
+    parser.add_argument("--output", default="", help="JSONL file to write the full results to")
+    args = parser.parse_args()
+    with open(args.questions) as f:
+        questions = [line.strip() for line in f if line.strip()]
+    asyncio.run(main(questions, args.runs, args.output))
@@ -0,0 +1,73 @@
+"""
+Compares building chat prompts with the previous insert-based MessageBuilder against the
+deque-based one, over 50- and 500-turn histories.
+
+Run from the backend directory: python -m benchmarks.bench_messagebuilder
+"""
+import timeit
+
+from core.messagebuilder import MessageBuilder
+from core.modelhelper import num_tokens_from_messages
+
+MODEL = "gpt-35-turbo-16k"
+SYSTEM_PROMPT = "You're an assistant for SoftServe employees, answering their corporate inquiries."
+
+
+class InsertMessageBuilder:
+    """The previous implementation: every history message is inserted at a fixed index."""
+
+    def __init__(self, system_content: str, chatgpt_model: str):
+        self.messages = [{'role': 'system', 'content': system_content}]
+        self.model = chatgpt_model
+        self.token_length = num_tokens_from_messages(self.messages[-1], self.model)
+
+    def append_message(self, role: str, content: str, index: int = 1):
+        self.messages.insert(index, {'role': role, 'content': content})
+        self.token_length += num_tokens_from_messages(self.messages[index], self.model)
+
+
+def build_with_inserts(history: list[dict[str, str]], max_tokens: int) -> list:
+    message_builder = InsertMessageBuilder(SYSTEM_PROMPT, MODEL)
+    message_builder.append_message("user", history[-1]["user"], index=1)
+    for h in reversed(history[:-1]):
+        message_builder.append_message("assistant", h["bot"], index=1)
+        message_builder.append_message("user", h["user"], index=1)
+        if message_builder.token_length > max_tokens:
+            break
+    return message_builder.messages
+
+
+def build_with_deque(history: list[dict[str, str]], max_tokens: int) -> list:
+    message_builder = MessageBuilder(SYSTEM_PROMPT, MODEL)
+    message_builder.set_last_message("user", history[-1]["user"])
+    message_builder.add_history(history[:-1], max_tokens)
+    return message_builder.messages
+
+
+def make_history(turns: int) -> list[dict[str, str]]:
+    history = [
+        {
+            "user": f"Question {i}: what projects did SoftServe deliver in industry {i}?",
+            "bot": f"Answer {i}: SoftServe delivered several projects ((https://www.softserveinc.com/items/{i})).",
+        }
+        for i in range(turns)
+    ]
+    history.append({"user": "What AI services does SoftServe offer?"})
+    return history
+
+
+def main():
+    # A budget large enough for the whole history, so both builders do the full walk
+    max_tokens = 10**9
+    for turns in [50, 500]:
+        history = make_history(turns)
+        # Populate the token count cache so only the builders are measured
+        build_with_deque(history, max_tokens)
+        for name, build in [("insert", build_with_inserts), ("deque", build_with_deque)]:
+            runs = 200
+            seconds = timeit.timeit(lambda: build(history, max_tokens), number=runs)
+            print(f"{turns:>4} turns  {name:<7} {seconds / runs * 1e6:10.1f} us/prompt")
+
+
+if __name__ == "__main__":
+    main()
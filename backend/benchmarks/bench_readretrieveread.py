@@ -0,0 +1,86 @@
+"""
+Compares the per-request setup cost of ReadRetrieveReadApproach before and after the agent
+pipeline was made reusable: building the tools, prompt, LLM, chain and executor (and parsing
+the employee CSV) on every request, against fetching the shared executor and binding the
+request state. No model or search calls are made.
+
+Run from the backend directory: python -m benchmarks.bench_readretrieveread
+"""
+import csv
+import os
+import tempfile
+import timeit
+
+import openai
+from langchain.agents import AgentExecutor, Tool, ZeroShotAgent
+from langchain.callbacks.manager import CallbackManager
+from langchain.chains import LLMChain
+from langchain.llms.openai import AzureOpenAI
+
+from approaches.readretrieveread import EmployeeInfoTool, ReadRetrieveReadApproach, RequestState, request_state
+from langchainadapters import HtmlCallbackHandler
+
+DEPLOYMENT = "davinci"
+
+
+def setup_per_request(approach: ReadRetrieveReadApproach) -> AgentExecutor:
+    """The previous implementation: the whole pipeline is built for every request."""
+    cb_handler = HtmlCallbackHandler()
+    cb_manager = CallbackManager(handlers=[cb_handler])
+    acs_tool = Tool(name="CognitiveSearch",
+                    func=lambda _: 'Not implemented',
+                    coroutine=approach.retrieve_and_store,
+                    description=approach.CognitiveSearchToolDescription,
+                    callbacks=cb_manager)
+    employee_tool = EmployeeInfoTool("Employee1", callbacks=cb_manager)
+    tools = [acs_tool, employee_tool]
+    prompt = ZeroShotAgent.create_prompt(
+        tools=tools,
+        prefix=approach.template_prefix,
+        suffix=approach.template_suffix,
+        input_variables = ["input", "agent_scratchpad"])
+    llm = AzureOpenAI(deployment_name=DEPLOYMENT, temperature=0.3, openai_api_key=openai.api_key)
+    chain = LLMChain(llm = llm, prompt = prompt)
+    return AgentExecutor.from_agent_and_tools(
+        agent = ZeroShotAgent(llm_chain = chain),
+        tools = tools,
+        verbose = True,
+        callback_manager = cb_manager)
+
+
+def setup_shared(approach: ReadRetrieveReadApproach) -> AgentExecutor:
+    HtmlCallbackHandler()
+    agent_exec = approach.get_agent_executor(approach.template_prefix, approach.template_suffix, 0.3)
+    token = request_state.set(RequestState({}))
+    request_state.reset(token)
+    return agent_exec
+
+
+def write_employee_file(directory: str, rows: int) -> None:
+    os.makedirs(os.path.join(directory, "data"))
+    with open(os.path.join(directory, "data", "employeeinfo.csv"), "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "title", "insurance", "vacation_days"])
+        for i in range(rows):
+            writer.writerow([f"Employee{i}", "Engineer", "Northwind Standard", 10 + i % 20])
+
+
+def main():
+    openai.api_key = "benchmark"
+    approach = ReadRetrieveReadApproach(None, DEPLOYMENT, None, "sourcepage", "content")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        write_employee_file(directory, 1000)
+        # EmployeeInfoTool reads its file relative to the working directory
+        os.chdir(directory)
+        try:
+            for name, setup in [("per-request", setup_per_request), ("shared", setup_shared)]:
+                runs = 200
+                seconds = timeit.timeit(lambda: setup(approach), number=runs)
+                print(f"{name:<12} {seconds / runs * 1e6:10.1f} us/request")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
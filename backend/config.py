@@ -0,0 +1,68 @@
+"""
+Configuration shared by the app and ingestion (python -m ingestion), read from the
+environment. The app's own settings are in app.py.
+"""
+import os
+import tempfile
+
+# Azure Cognitive Search configuration
+AZURE_SEARCH_SERVICE = os.getenv("AZURE_SEARCH_SERVICE", "ai-assistant-search")
+AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX", "ai-assistant-idx")
+# UPDATE THE VALUE BELOW TO YOUR COGNITIVE SEARCH ADMIN KEY
+COGNITIVE_SEARCH_API_KEY = os.getenv(
+    "COGNITIVE_SEARCH_API_KEY",
+    "<FILL_IN_YOUR_COGNITIVE_SEARCH_API_KEY>",
+)
+# Marker file ingestion writes a new generation to after changing the index, which
+# clears the app's search cache (and rebuilds its source centroids on the next start).
+# Ingestion and every app instance must see the same file: the default, in the temp
+# directory, is only shared on one host, so set it to a path on shared storage (e.g. an
+# Azure Files mount of the App Service) when ingestion runs elsewhere. Without the
+# marker, cached search results only expire with SEARCH_CACHE_TTL.
+SEARCH_INDEX_GENERATION_PATH = os.getenv(
+    "SEARCH_INDEX_GENERATION_PATH",
+    os.path.join(tempfile.gettempdir(), "search-index.generation"),
+)
+
+# Azure OpenAI configuration
+AZURE_OPENAI_SERVICE = os.getenv(
+    "AZURE_OPENAI_SERVICE", "ai-assistant-openai"
+)
+# UPDATE THE VALUE BELOW TO YOUR OPENAI API KEY
+OPENAI_API_KEY = os.getenv(
+    "OPENAI_API_KEY", "<FILL_IN_YOUR_OPENAI_API_KEY>"
+)
+AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv(
+    "AZURE_OPENAI_CHATGPT_DEPLOYMENT", "ai-assistant-gpt-35-16k"
+)
+AZURE_OPENAI_CHATGPT_MODEL = os.getenv(
+    "AZURE_OPENAI_CHATGPT_MODEL", "gpt-35-turbo-16k"
+)
+AZURE_OPENAI_GPT4_DEPLOYMENT = os.getenv(
+    "AZURE_OPENAI_GPT4_DEPLOYMENT", "ai-assistant-gpt-4"
+)
+AZURE_OPENAI_GPT4_MODEL = os.getenv(
+    "AZURE_OPENAI_GPT4_MODEL",
+    "gpt-4-32k",
+)
+AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv(
+    "AZURE_OPENAI_EMB_DEPLOYMENT", "ai-assistant-ada"
+)
+API_VERSION = "2023-05-15"
+OPENAI_API_TYPE = "azure"
+
+# Quotas of the Azure OpenAI deployments, "deployment=tokens per minute[/requests per
+# minute],..." (requests default to Azure's 6 per 1000 tokens), that all OpenAI calls
+# are scheduled against, e.g. for the capacities in Deployment_instructions.md
+# "ai-assistant-gpt-35-16k=120000,ai-assistant-gpt-4=30000,ai-assistant-ada=120000".
+# Empty by default: calls are only throttled client-side once the deployments' real
+# quotas are configured, otherwise they are sent right away. The workers, and
+# ingestion, share the quotas through files in OPENAI_RATE_LIMIT_DIR (empty for a whole
+# quota per worker). Rate limited calls are retried up to OPENAI_MAX_RETRIES times,
+# after the Retry-After the service sent.
+OPENAI_RATE_LIMITS = os.getenv("OPENAI_RATE_LIMITS", "")
+OPENAI_RATE_LIMIT_DIR = os.getenv(
+    "OPENAI_RATE_LIMIT_DIR",
+    os.path.join(tempfile.gettempdir(), "openai-rate-limits"),
+)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import re
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+import numpy as np
+
+from .ttlcache import TTLCache
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # redis is only needed for RedisCacheBackend
+    redis = None
+
+
+class CacheBackend(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any) -> None:
+        ...
+
+
+class InMemoryCacheBackend(CacheBackend):
+    """Per-process cache with LRU eviction and a TTL."""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 3600):
+        self.entries = TTLCache(maxsize, ttl)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: Any) -> None:
+        self.entries.set(key, value)
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Cache shared by all workers, stored as JSON in Redis. Entries expire after `ttl`
+    seconds, LRU eviction is left to the server's maxmemory-policy.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        ttl: Optional[float] = 3600,
+        prefix: str = "answer-cache:",
+    ):
+        if redis is None:
+            raise ValueError("RedisCacheBackend requires the redis package")
+        self.client = redis.from_url(url)
+        self.ttl = int(ttl) if ttl else None
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value: Any) -> None:
+        await self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+
+def normalize_question(question: str) -> str:
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
+class AnswerCache:
+    """
+    Caches approach results. Exact hits are looked up by a hash of the normalized
+    question, the prior conversation and the overrides. Near-duplicate questions are
+    matched by cosine similarity of their query embeddings, within the same scope
+    (approach and overrides, see make_scope), against a per-process index of the
+    embeddings of cached answers. ada embeddings of related but different questions,
+    e.g. about the deductible for an employee and for a family, are close too, so the
+    threshold is kept high enough to only match rephrasings.
+    """
+
+    def __init__(
+        self,
+        backend: CacheBackend,
+        similarity_threshold: float = 0.97,
+        max_vectors: int = 1024,
+        ttl: Optional[float] = 3600,
+    ):
+        self.backend = backend
+        self.similarity_threshold = similarity_threshold
+        self.vectors = TTLCache(max_vectors, ttl)
+        self.lookups = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        payload = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @classmethod
+    def make_chat_key(
+        cls, approach: str, history: list[dict[str, str]], overrides: dict[str, Any]
+    ) -> str:
+        return cls.make_key(
+            approach,
+            history[:-1],
+            normalize_question(history[-1]["user"]),
+            overrides,
+        )
+
+    @classmethod
+    def make_ask_key(
+        cls, approach: str, q: str, overrides: dict[str, Any]
+    ) -> str:
+        return cls.make_key(approach, normalize_question(q), overrides)
+
+    @classmethod
+    def make_scope(cls, approach: str, overrides: dict[str, Any]) -> str:
+        """The scope of near-duplicate matches: the same approach, with the same overrides."""
+        return cls.make_key("semantic", approach, overrides)
+
+    async def get(self, key: str) -> Optional[Any]:
+        self.lookups += 1
+        value = await self.backend.get(key)
+        if value is not None:
+            self.exact_hits += 1
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        await self.backend.set(key, value)
+
+    async def get_similar(
+        self, scope: str, vector: np.ndarray
+    ) -> Optional[Any]:
+        candidates = [
+            (key, entry_vector)
+            for key, (entry_scope, entry_vector) in self.vectors.items()
+            if entry_scope == scope
+        ]
+        if not candidates:
+            return None
+        query = np.asarray(vector, dtype=np.float32)
+        matrix = np.stack([entry_vector for _, entry_vector in candidates])
+        similarities = matrix @ query / (
+            np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-9
+        )
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        key = candidates[best][0]
+        value = await self.backend.get(key)
+        if value is None:
+            self.vectors.pop(key)
+            return None
+        self.semantic_hits += 1
+        return value
+
+    async def set_similar(
+        self, scope: str, vector: np.ndarray, value: Any
+    ) -> None:
+        key = "semantic:" + uuid.uuid4().hex
+        await self.backend.set(key, value)
+        self.vectors.set(key, (scope, np.asarray(vector, dtype=np.float32)))
+
+    def stats(self) -> dict[str, Any]:
+        hits = self.exact_hits + self.semantic_hits
+        return {
+            "lookups": self.lookups,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": max(self.lookups - hits, 0),
+            "hit_rate": round(hits / self.lookups, 4) if self.lookups else 0.0,
+            "semantic_entries": len(self.vectors),
+        }
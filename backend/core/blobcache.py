@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import mmap
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Optional
+
+from .singleflight import SingleFlight
+
+
+class BlobDiskCache:
+    """
+    A size-bounded, read-through cache of blobs on local disk. Files are keyed by blob
+    name and ETag, so a changed blob is never served stale. Concurrent misses for the
+    same blob share a single download, and the least recently used files are evicted
+    once the cache grows over `max_bytes`.
+
+    Every worker process keeps its own LRU bookkeeping over the shared directory, seeded
+    from the files already on disk, so the quota is approximate with several workers.
+    """
+
+    def __init__(
+        self, directory: str, max_bytes: int, chunk_size: int = 1024 * 1024
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.total_bytes = 0
+        self.downloads = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if not entry.name.endswith(".tmp"):
+                files.append((stat.st_atime, entry.name, stat.st_size))
+            elif stat.st_mtime < time.time() - 3600:
+                # Left behind by a worker that died mid-download
+                os.remove(entry.path)
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+        self.evict()
+
+    def key(self, name: str, etag: str) -> str:
+        return hashlib.sha256(f"{name}\0{etag}".encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    async def fetch(
+        self,
+        name: str,
+        etag: str,
+        download: Callable[[], AsyncIterator[bytes]],
+    ) -> str:
+        """Returns the path of the cached file, downloading it on a miss."""
+        key = self.key(name, etag)
+        path = self.path(key)
+        if os.path.exists(path):
+            if key not in self.entries:
+                # Downloaded by another worker
+                self.entries[key] = os.path.getsize(path)
+                self.total_bytes += self.entries[key]
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return path
+        # Evicted by another worker
+        self.total_bytes -= self.entries.pop(key, 0)
+        self.misses += 1
+        return await self.downloads.do(key, lambda: self.store(key, download))
+
+    async def store(
+        self, key: str, download: Callable[[], AsyncIterator[bytes]]
+    ) -> str:
+        path = self.path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in download():
+                    await asyncio.to_thread(f.write, chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.total_bytes += size - self.entries.pop(key, 0)
+        self.entries[key] = size
+        self.evict()
+        return path
+
+    def evict(self) -> None:
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                # Requests still reading the file keep their open descriptor
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    async def open(
+        self, path: str, offset: int, length: int
+    ) -> AsyncIterator[memoryview]:
+        """
+        Opens a cached file and returns its `length` bytes from `offset` in chunks. The
+        file is memory mapped and the chunks are views of the map, so they are served
+        straight from the page cache without copies. Raises FileNotFoundError right away
+        if the file was evicted.
+        """
+        if length <= 0:
+            return self.chunks(None, offset, 0)
+        return self.chunks(await asyncio.to_thread(self.map, path), offset, length)
+
+    @staticmethod
+    def map(path: str) -> mmap.mmap:
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def chunks(
+        self, m: Optional[mmap.mmap], offset: int, length: int
+    ) -> AsyncIterator[memoryview]:
+        if m is None:
+            return
+        try:
+            with memoryview(m) as view:
+                end = offset + length
+                for start in range(offset, end, self.chunk_size):
+                    stop = min(start + self.chunk_size, end)
+                    # Pages that aren't in memory yet are read from disk on a worker
+                    # thread rather than by page faults on the event loop
+                    await asyncio.to_thread(self.load, m, start, stop)
+                    yield view[start:stop]
+        finally:
+            try:
+                m.close()
+            except BufferError:
+                # A chunk is still referenced, the map is closed when it's released
+                pass
+
+    @staticmethod
+    def load(m: mmap.mmap, start: int, stop: int) -> None:
+        page = mmap.PAGESIZE
+        first = start - start % page
+        if hasattr(mmap, "MADV_WILLNEED"):
+            m.madvise(mmap.MADV_WILLNEED, first, stop - first)
+        for i in range(first, stop, page):
+            m[i]
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "files": len(self.entries),
+            "bytes": self.total_bytes,
+            "downloads_in_flight": len(self.downloads),
+        }
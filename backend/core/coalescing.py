@@ -0,0 +1,114 @@
+import asyncio
+from typing import Any, AsyncGenerator, Awaitable, Callable, Hashable, Optional
+
+from .singleflight import SingleFlight
+
+
+class Broadcast:
+    """
+    An in-flight stream of frames. Its frames are kept until it ends, so a subscriber
+    that joins late gets the frames sent so far first, then the following ones.
+    """
+
+    def __init__(self, frames: AsyncGenerator[dict[str, Any], None]):
+        self.frames: list[dict[str, Any]] = []
+        self.error: Optional[Exception] = None
+        self.done = False
+        self.updated = asyncio.Event()
+        self.subscribers = 0
+        self.task = asyncio.ensure_future(self.pump(frames))
+
+    async def pump(self, frames: AsyncGenerator[dict[str, Any], None]) -> None:
+        try:
+            async for frame in frames:
+                self.frames.append(frame)
+                self.notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.notify()
+
+    def notify(self) -> None:
+        # Wakes the subscribers waiting for this update, later ones wait for the next
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    async def subscribe(self) -> AsyncGenerator[dict[str, Any], None]:
+        sent = 0
+        while True:
+            while sent < len(self.frames):
+                sent += 1
+                yield self.frames[sent - 1]
+            if self.done:
+                break
+            await self.updated.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class RequestCoalescer:
+    """
+    Coalesces concurrent identical requests: while a request is in flight, identical
+    ones attach to it instead of running the approach again, and all of them get its
+    result. Streamed requests attach to the stream, replaying the frames it has sent
+    so far. The computation runs in its own task, so the caller that started it can
+    disconnect without affecting the others; it is cancelled once every caller waiting
+    for it has gone.
+    """
+
+    def __init__(self):
+        self.calls = SingleFlight(cancel_abandoned=True)
+        self.streams: dict[Hashable, Broadcast] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.cancelled = 0
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if key in self.calls:
+            self.followers += 1
+        else:
+            self.leaders += 1
+        return await self.calls.do(key, fn)
+
+    async def stream(
+        self,
+        key: Hashable,
+        fn: Callable[[], AsyncGenerator[dict[str, Any], None]],
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        broadcast = self.streams.get(key)
+        if broadcast is None:
+            broadcast = Broadcast(fn())
+            self.streams[key] = broadcast
+            broadcast.task.add_done_callback(lambda _: self.forget(key, broadcast))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        broadcast.subscribers += 1
+        try:
+            async for frame in broadcast.subscribe():
+                yield frame
+        finally:
+            broadcast.subscribers -= 1
+            if not broadcast.subscribers and not broadcast.task.done():
+                self.cancel(key, broadcast)
+
+    def cancel(self, key: Hashable, broadcast: Broadcast) -> None:
+        # Forgotten right away, so that a new request doesn't attach to a cancelled one
+        self.forget(key, broadcast)
+        broadcast.task.cancel()
+        self.cancelled += 1
+
+    def forget(self, key: Hashable, broadcast: Broadcast) -> None:
+        if self.streams.get(key) is broadcast:
+            del self.streams[key]
+
+    def stats(self) -> dict[str, Any]:
+        requests = self.leaders + self.followers
+        return {
+            "requests": requests,
+            "coalesced": self.followers,
+            "coalesced_rate": round(self.followers / requests, 4) if requests else 0.0,
+            "cancelled": self.calls.cancelled + self.cancelled,
+            "in_flight": len(self.calls) + len(self.streams),
+        }
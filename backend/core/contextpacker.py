@@ -0,0 +1,66 @@
+import re
+
+from .modelhelper import get_encoding, num_tokens_from_text
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+class ContextPacker:
+    """
+    Packs retrieved chunks ({"url", "content", "summary"} dicts, optionally with a
+    retrieval "score") into a token budget as "url: content" lines, highest score first.
+    Chunks are counted sentence by sentence, with every sentence tokenized once (and
+    cached across requests), so a chunk that doesn't fit whole can be cut at a sentence
+    boundary. When too little of it would fit, its pre-computed summary is used instead,
+    and chunks that fit in neither form are skipped.
+    """
+
+    def __init__(self, model: str, min_trimmed_tokens: int = 32):
+        self.model = model
+        self.min_trimmed_tokens = min_trimmed_tokens
+
+    def pack(
+        self, results: list[dict[str, str]], budget: int
+    ) -> tuple[list[str], int]:
+        """Returns the packed lines and the number of tokens they take."""
+        encoding = get_encoding(self.model)
+        # sorted() is stable, so chunks without scores keep the retrieval order
+        ranked = sorted(
+            results, key=lambda res: res.get("score") or 0.0, reverse=True
+        )
+        lines = []
+        used = 0
+        for res in ranked:
+            # Lines are joined with a newline, roughly one token each
+            remaining = budget - used - 1
+            prefix = res["url"] + ": "
+            prefix_tokens = num_tokens_from_text(prefix, encoding)
+            if remaining <= prefix_tokens:
+                break
+            sentences = SENTENCE_END.split(res["content"])
+            sentence_tokens = [num_tokens_from_text(s, encoding) for s in sentences]
+            content_tokens = sum(sentence_tokens)
+            if prefix_tokens + content_tokens <= remaining:
+                lines.append(prefix + res["content"])
+                used += prefix_tokens + content_tokens + 1
+                continue
+
+            kept, kept_tokens = 0, 0
+            for tokens in sentence_tokens:
+                if prefix_tokens + kept_tokens + tokens > remaining:
+                    break
+                kept += 1
+                kept_tokens += tokens
+            summary = res.get("summary") or ""
+            summary_tokens = num_tokens_from_text(summary, encoding) if summary else 0
+            summary_fits = summary and prefix_tokens + summary_tokens <= remaining
+            # Prefer the summary over keeping less than half of the chunk
+            if kept_tokens >= self.min_trimmed_tokens and not (
+                summary_fits and kept_tokens < content_tokens / 2
+            ):
+                lines.append(prefix + " ".join(sentences[:kept]))
+                used += prefix_tokens + kept_tokens + 1
+            elif summary_fits:
+                lines.append(prefix + summary)
+                used += prefix_tokens + summary_tokens + 1
+        return lines, used
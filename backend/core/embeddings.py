@@ -0,0 +1,99 @@
+import asyncio
+from typing import Any, Optional
+
+import numpy as np
+
+from .ratelimit import OpenAIScheduler
+from .ttlcache import TTLCache
+
+
+class EmbeddingService:
+    """
+    Computes query embeddings for all approaches. Vectors are kept in a bounded LRU
+    cache as float32 arrays, and concurrent cache misses, across requests, are
+    coalesced into a single multi-input embedding call: the first miss opens a
+    `batch_window` seconds window, and the batch is sent when the window closes or
+    `max_batch_size` distinct inputs are waiting. Batches are sent through the
+    OpenAI scheduler.
+    """
+
+    def __init__(
+        self,
+        deployment: str,
+        cache_size: int = 4096,
+        batch_window: float = 0.005,
+        max_batch_size: int = 16,
+        scheduler: Optional[OpenAIScheduler] = None,
+    ):
+        self.deployment = deployment
+        self.cache = TTLCache(cache_size)
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.scheduler = scheduler or OpenAIScheduler()
+        self.pending: dict[str, asyncio.Future] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.batch_tasks: set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+
+    async def embed(self, text: str) -> np.ndarray:
+        vector = self.cache.get(text)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        self.misses += 1
+        future = self.pending.get(text)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.pending[text] = loop.create_future()
+            if len(self.pending) >= self.max_batch_size:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = loop.call_later(
+                    self.batch_window, self.flush
+                )
+        # A cancelled caller must not cancel the batch for everyone waiting on it
+        return await asyncio.shield(future)
+
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        task = asyncio.ensure_future(self.embed_batch(batch))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+
+    async def embed_batch(self, batch: dict[str, asyncio.Future]) -> None:
+        texts = list(batch)
+        self.batches += 1
+        try:
+            response = await self.scheduler.embedding(
+                engine=self.deployment, input=texts
+            )
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # Marks it retrieved, in case all its callers were cancelled
+                    future.exception()
+            return
+        for item in response["data"]:
+            text = texts[item["index"]]
+            vector = np.asarray(item["embedding"], dtype=np.float32)
+            self.cache.set(text, vector)
+            if not batch[text].done():
+                batch[text].set_result(vector)
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "batches": self.batches,
+            "cached_vectors": len(self.cache),
+        }
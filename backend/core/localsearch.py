@@ -0,0 +1,438 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+from typing import Any, Iterable, Optional
+
+import numpy as np
+from azure.core.exceptions import AzureError
+from azure.search.documents.aio import SearchClient
+
+from .textindex import TextIndex
+
+MANIFEST = "manifest.json"
+DOCUMENTS = "documents.json"
+# Fields that get a bitmask per value when the index is loaded
+MASKED_FIELDS = ["Storage", "Category", "FileType"]
+# The searchable fields of the index, which the text index is built from
+TEXT_FIELDS = ["FileName", "Summary", "Content"]
+# Azure Cognitive Search's reciprocal rank fusion constant for hybrid queries
+RRF_K = 60
+CAPTION_CHARS = 300
+# The service's page size: a search without `top` returns this many results here, and
+# is read up to this many from the service rather than paged through in full
+DEFAULT_TOP = 50
+
+FILTER_TOKEN = re.compile(
+    r"\s*(?:"
+    r"search\.in\(\s*(?P<in_field>\w+)\s*,\s*'(?P<in_values>(?:[^']|'')*)'"
+    r"\s*(?:,\s*'(?P<in_separators>(?:[^']|'')*)'\s*)?\)"
+    r"|(?P<field>\w+)\s+(?P<op>eq|ne)\s+'(?P<value>(?:[^']|'')*)'"
+    r"|(?P<conjunction>and|or)\b"
+    r")\s*"
+)
+
+
+class LocalIndex:
+    """
+    A read-only copy of the search index on disk: the documents' other fields in
+    documents.json, one float32 matrix per vector field in `{field}.npy`, with rows
+    L2-normalized so a dot product is the cosine similarity, and a BM25 TextIndex of the
+    searchable fields. The matrices are memory-mapped, so all workers on a machine share
+    the same pages of the OS page cache instead of each loading its own copy.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        with open(os.path.join(path, DOCUMENTS)) as f:
+            self.documents: list[dict[str, Any]] = json.load(f)
+        self.vectors = {
+            field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r")
+            for field in manifest["vector_fields"]
+        }
+        # Rows of documents without the field are zero, so they never match
+        self.has_vector = {
+            field: np.asarray(manifest["has_vector"][field], dtype=bool)
+            for field in manifest["vector_fields"]
+        }
+        self.text = TextIndex.load(path)
+        # Filters name fields case-insensitively (the approaches filter on "category")
+        self.fields = {
+            field.casefold(): field
+            for field in [*MASKED_FIELDS, *{f for doc in self.documents for f in doc}]
+        }
+        self.masks: dict[tuple[str, Any], np.ndarray] = {}
+        for field in MASKED_FIELDS:
+            for value in {doc.get(field) for doc in self.documents}:
+                self.mask(field, value)
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def mask(self, field: str, value: Any) -> np.ndarray:
+        """The documents whose `field` equals `value`, as a boolean mask."""
+        mask = self.masks.get((field, value))
+        if mask is None:
+            mask = np.fromiter(
+                (doc.get(field) == value for doc in self.documents),
+                dtype=bool,
+                count=len(self.documents),
+            )
+            self.masks[(field, value)] = mask
+        return mask
+
+    def filter_mask(self, filter: Optional[str]) -> Optional[np.ndarray]:
+        """
+        Evaluates an OData filter made of `search.in(field, 'values'[, 'separators'])`,
+        `field eq 'value'` and `field ne 'value'` clauses joined with `and`/`or`
+        (`and` binding tighter), the subset of the filter syntax the approaches use.
+        Field names are matched case-insensitively, and unknown ones raise ValueError.
+        """
+        if not filter:
+            return None
+        disjunction = []
+        conjunction: Optional[np.ndarray] = None
+        expect_clause = True
+        position = 0
+        while position < len(filter):
+            match = FILTER_TOKEN.match(filter, position)
+            if match is None or match.end() == position:
+                raise ValueError(f"Unsupported filter: {filter}")
+            position = match.end()
+            if match["conjunction"]:
+                if expect_clause:
+                    raise ValueError(f"Unsupported filter: {filter}")
+                if match["conjunction"] == "or":
+                    disjunction.append(conjunction)
+                    conjunction = None
+                expect_clause = True
+                continue
+            if not expect_clause:
+                raise ValueError(f"Unsupported filter: {filter}")
+            clause = self.clause_mask(match)
+            conjunction = clause if conjunction is None else conjunction & clause
+            expect_clause = False
+        if expect_clause:
+            raise ValueError(f"Unsupported filter: {filter}")
+        disjunction.append(conjunction)
+        return np.logical_or.reduce(disjunction)
+
+    def field_name(self, field: str) -> str:
+        name = self.fields.get(field.casefold())
+        if name is None:
+            raise ValueError(f"Unknown filter field: {field}")
+        return name
+
+    def clause_mask(self, match: re.Match) -> np.ndarray:
+        if match["in_field"]:
+            field = self.field_name(match["in_field"])
+            separators = (match["in_separators"] or " ,").replace("''", "'")
+            values = re.split(
+                "[" + re.escape(separators) + "]", match["in_values"].replace("''", "'")
+            )
+            return np.logical_or.reduce(
+                [self.mask(field, value) for value in values if value]
+                or [np.zeros(len(self.documents), dtype=bool)]
+            )
+        mask = self.mask(
+            self.field_name(match["field"]), match["value"].replace("''", "'")
+        )
+        return mask if match["op"] == "eq" else ~mask
+
+    def nearest(
+        self,
+        field: str,
+        vector: Iterable[float],
+        k: int,
+        mask: Optional[np.ndarray] = None,
+    ) -> list[tuple[int, float]]:
+        """The `k` rows most similar to `vector` among the masked ones, as (row, cosine)."""
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        similarities = self.vectors[field] @ query
+        eligible = self.has_vector[field] if mask is None else mask & self.has_vector[field]
+        similarities = np.where(eligible, similarities, -np.inf)
+        k = min(k, int(eligible.sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [(int(row), float(similarities[row])) for row in top]
+
+    @staticmethod
+    def save(
+        path: str, documents: list[dict[str, Any]], vector_fields: list[str]
+    ) -> None:
+        """Writes the documents as a LocalIndex, replacing the one at `path` if any."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        has_vector = {}
+        for field in vector_fields:
+            dimensions = next(
+                (len(doc[field]) for doc in documents if doc.get(field)), 0
+            )
+            matrix = np.zeros((len(documents), dimensions), dtype=np.float32)
+            for row, doc in enumerate(documents):
+                if doc.get(field):
+                    matrix[row] = doc[field]
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix /= np.where(norms > 0, norms, 1.0)
+            np.save(os.path.join(tmp_path, f"{field}.npy"), matrix)
+            has_vector[field] = [bool(doc.get(field)) for doc in documents]
+        with open(os.path.join(tmp_path, DOCUMENTS), "w") as f:
+            json.dump(
+                [
+                    {k: v for k, v in doc.items() if k not in vector_fields}
+                    for doc in documents
+                ],
+                f,
+            )
+        TextIndex.build(
+            [" ".join(doc.get(field) or "" for field in TEXT_FIELDS) for doc in documents]
+        ).save(tmp_path)
+        with open(os.path.join(tmp_path, MANIFEST), "w") as f:
+            json.dump({"vector_fields": vector_fields, "has_vector": has_vector}, f)
+        # Workers that still have the old files mapped keep reading them until they reload
+        old_path = f"{path}.{os.getpid()}.old"
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+class LocalCaption:
+    def __init__(self, text: str):
+        self.text = text
+        self.highlights = None
+
+
+class LocalSearchResults:
+    """
+    Async iterable of result documents, like the SDK's AsyncSearchItemPaged. Also holds
+    results read from the service in full (see FallbackSearchClient).
+    """
+
+    def __init__(
+        self,
+        results: list[dict[str, Any]],
+        count: Optional[int],
+        answers: Optional[list] = None,
+        degraded: bool = False,
+    ):
+        self.results = results
+        self.count = count
+        self.answers = answers
+        # Served by the local index in place of Cognitive Search
+        self.degraded = degraded
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for result in self.results:
+            yield result
+
+    async def get_answers(self) -> Optional[list]:
+        return self.answers
+
+    async def get_count(self) -> Optional[int]:
+        return self.count
+
+
+async def read_search(
+    search_client: Any, *args: Any, **kwargs: Any
+) -> LocalSearchResults:
+    """
+    Sends a search and reads its results in full, at most `top` of them (DEFAULT_TOP
+    without one).
+    """
+    if kwargs.get("top") is None:
+        kwargs["top"] = DEFAULT_TOP
+    r = await search_client.search(*args, **kwargs)
+    results = []
+    async for doc in r:
+        results.append(doc)
+        if len(results) >= kwargs["top"]:
+            break
+    # The count and answers come with the first page, which has been read already
+    return LocalSearchResults(
+        results,
+        await r.get_count(),
+        await r.get_answers(),
+        getattr(r, "degraded", False),
+    )
+
+
+class LocalSearchClient:
+    """
+    In-process stand-in for the Cognitive Search SearchClient, over a LocalIndex. Vector
+    queries rank documents by cosine similarity with a brute-force matrix-vector
+    product, which for an index of a few thousand chunks takes microseconds, text
+    queries are ranked by the index's BM25 TextIndex, and filters are applied as
+    precomputed per-value bitmasks. Several ranked lists (text and vector queries) are
+    fused with reciprocal rank fusion as the service does.
+
+    The semantic ranker isn't available locally: captions are the content's sentence
+    with the most query terms and there are no semantic answers. An index written
+    without a text index only matches text queries through their vector part.
+    """
+
+    def __init__(self, index: LocalIndex):
+        self.index = index
+        self.warned_text = False
+
+    async def search(
+        self,
+        search_text: Optional[str] = None,
+        *,
+        filter: Optional[str] = None,
+        top: Optional[int] = None,
+        skip: Optional[int] = None,
+        select: Optional[list[str]] = None,
+        vectors: Optional[list[Any]] = None,
+        vector: Optional[list[float]] = None,
+        top_k: Optional[int] = None,
+        vector_fields: Optional[str] = None,
+        query_caption: Optional[str] = None,
+        **kwargs: Any,
+    ) -> LocalSearchResults:
+        top = DEFAULT_TOP if top is None else top
+        skip = skip or 0
+        mask = self.index.filter_mask(filter)
+        queries = [(v.value, v.k or top, v.fields) for v in vectors or []]
+        if vector is not None and vector_fields:
+            # The argument names of older SDK previews, still used by some approaches
+            queries.append((vector, top_k or top, vector_fields))
+
+        vector_lists = []
+        for values, k, fields in queries:
+            for field in fields.split(","):
+                # Like the service, ignore vector queries on fields the index doesn't have
+                if field.strip() in self.index.vectors:
+                    vector_lists.append(
+                        self.index.nearest(field.strip(), values, k, mask)
+                    )
+        text_lists = []
+        has_text = bool(search_text) and search_text != "*"
+        if has_text and self.index.text is not None:
+            # Hybrid queries fuse the text leg's top 50, like the service
+            k = skip + top if not vector_lists else max(skip + top, 50)
+            text_lists.append(self.index.text.search(search_text, k, mask))
+        elif has_text and not self.warned_text:
+            logging.warning("The local search index has no text index, text queries are ignored")
+            self.warned_text = True
+        elif not has_text and not queries:
+            rows = np.flatnonzero(mask) if mask is not None else range(len(self.index))
+            text_lists.append([(int(row), 1.0) for row in rows])
+
+        if len(vector_lists) + len(text_lists) > 1:
+            ranked = self.fuse(vector_lists + text_lists)
+        elif vector_lists:
+            # A single vector query is scored like the service does for cosine
+            ranked = [(row, 1 / (2 - score)) for row, score in vector_lists[0]]
+        else:
+            ranked = text_lists[0] if text_lists else []
+        caption_query = search_text if has_text else None
+        results = [
+            self.result(row, score, select, query_caption, caption_query)
+            for row, score in ranked[skip : skip + top]
+        ]
+        return LocalSearchResults(results, len(ranked))
+
+    @staticmethod
+    def fuse(ranked_lists: list[list[tuple[int, float]]]) -> list[tuple[int, float]]:
+        scores: dict[int, float] = {}
+        for ranked in ranked_lists:
+            for rank, (row, _) in enumerate(ranked, start=1):
+                scores[row] = scores.get(row, 0.0) + 1 / (RRF_K + rank)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def result(
+        self,
+        row: int,
+        score: float,
+        select: Optional[list[str]],
+        query_caption: Optional[str],
+        caption_query: Optional[str],
+    ) -> dict[str, Any]:
+        doc = self.index.documents[row]
+        fields = select or [*doc, *self.index.vectors]
+        result = {}
+        for field in fields:
+            if field in self.index.vectors:
+                if self.index.has_vector[field][row]:
+                    result[field] = self.index.vectors[field][row].tolist()
+            else:
+                result[field] = doc.get(field)
+        result["@search.score"] = score
+        if query_caption:
+            content = doc.get("Content") or ""
+            if caption_query and self.index.text is not None:
+                caption = self.index.text.caption(caption_query, content, CAPTION_CHARS)
+            else:
+                caption = content[:CAPTION_CHARS]
+            result["@search.captions"] = [LocalCaption(caption)]
+        return result
+
+    async def close(self) -> None:
+        pass
+
+
+class FallbackSearchClient:
+    """
+    Sends searches to Cognitive Search, and serves them from a LocalSearchClient when
+    the service fails or doesn't return all the results within `timeout` seconds, so
+    a slow or unavailable service degrades the search (no semantic ranking) instead of
+    stalling the request. Results are read from the service in full within the timeout,
+    up to `top` (see read_search).
+    """
+
+    def __init__(
+        self,
+        primary: SearchClient,
+        fallback: LocalSearchClient,
+        timeout: float = 2.0,
+    ):
+        self.primary = primary
+        self.fallback = fallback
+        self.timeout = timeout
+        self.counts = {"primary": 0, "timeouts": 0, "errors": 0}
+
+    async def search(self, *args: Any, **kwargs: Any) -> LocalSearchResults:
+        try:
+            results = await asyncio.wait_for(
+                self.read_primary(*args, **kwargs), self.timeout
+            )
+            self.counts["primary"] += 1
+            return results
+        except asyncio.TimeoutError:
+            self.counts["timeouts"] += 1
+            logging.warning("Search timed out, using the local index")
+        except AzureError as e:
+            self.counts["errors"] += 1
+            logging.warning("Search failed, using the local index: %s", e)
+        results = await self.fallback.search(*args, **kwargs)
+        results.degraded = True
+        return results
+
+    async def read_primary(self, *args: Any, **kwargs: Any) -> LocalSearchResults:
+        return await read_search(self.primary, *args, **kwargs)
+
+    def stats(self) -> dict[str, Any]:
+        searches = sum(self.counts.values())
+        fallbacks = self.counts["timeouts"] + self.counts["errors"]
+        return {
+            **self.counts,
+            "fallback_rate": round(fallbacks / searches, 4) if searches else 0.0,
+            "timeout_ms": self.timeout * 1000,
+        }
+
+    async def close(self) -> None:
+        await self.primary.close()
@@ -1,25 +1,66 @@
+from collections import deque
+
 from .modelhelper import num_tokens_from_messages
 
 
 class MessageBuilder:
     """
       A class for building and managing messages in a chat conversation.
+      Messages are kept in three parts: the system message followed by few-shot examples,
+      the chat history, and the last (current) user message. The final list is only
+      assembled once, when `messages` is read.
       Attributes:
-          message (list): A list of dictionaries representing chat messages.
+          messages (list): A list of dictionaries representing chat messages.
           model (str): The name of the ChatGPT model.
-          token_count (int): The total number of tokens in the conversation.
+          token_length (int): The total number of tokens in the conversation.
       Methods:
           __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
-          append_message(self, role: str, content: str, index: int = 1): Appends a new message to the conversation.
+          append_message(self, role: str, content: str): Appends a message after the system message and previous few-shots.
+          set_last_message(self, role: str, content: str): Sets the message that follows the history.
+          add_history(self, history: list[dict[str, str]], max_tokens: int): Adds as many history turns, newest first, as fit in max_tokens.
       """
 
     def __init__(self, system_content: str, chatgpt_model: str):
-        self.messages = [{'role': 'system', 'content': system_content}]
         self.model = chatgpt_model
-        self.token_length = num_tokens_from_messages(
-            self.messages[-1], self.model)
+        self.head = [{'role': 'system', 'content': system_content}]
+        self.history = deque()
+        self.last = []
+        self.token_length = num_tokens_from_messages(self.head[0], self.model)
+
+    def append_message(self, role: str, content: str):
+        self.head.append({'role': role, 'content': content})
+        self.token_length += num_tokens_from_messages(self.head[-1], self.model)
+
+    def set_last_message(self, role: str, content: str):
+        if self.last:
+            self.token_length -= num_tokens_from_messages(self.last[0], self.model)
+        self.last = [{'role': role, 'content': content}]
+        self.token_length += num_tokens_from_messages(self.last[0], self.model)
+
+    def add_history(self, history: list[dict[str, str]], max_tokens: int) -> int:
+        """
+        Adds history turns ({"user": ..., "bot": ...}), newest first, stopping at the first
+        turn that would take token_length over max_tokens. Returns the number of turns added.
+        """
+        added = 0
+        for h in reversed(history):
+            turn_length = 0
+            if bot_msg := h.get("bot"):
+                bot_message = {'role': 'assistant', 'content': bot_msg}
+                turn_length += num_tokens_from_messages(bot_message, self.model)
+            if user_msg := h.get("user"):
+                user_message = {'role': 'user', 'content': user_msg}
+                turn_length += num_tokens_from_messages(user_message, self.model)
+            if self.token_length + turn_length > max_tokens:
+                break
+            if bot_msg:
+                self.history.appendleft(bot_message)
+            if user_msg:
+                self.history.appendleft(user_message)
+            self.token_length += turn_length
+            added += 1
+        return added
 
-    def append_message(self, role: str, content: str, index: int = 1):
-        self.messages.insert(index, {'role': role, 'content': content})
-        self.token_length += num_tokens_from_messages(
-            self.messages[index], self.model)
+    @property
+    def messages(self) -> list[dict[str, str]]:
+        return [*self.head, *self.history, *self.last]
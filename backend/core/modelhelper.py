@@ -1,7 +1,13 @@
 from __future__ import annotations
 
+import hashlib
+from functools import lru_cache
+from typing import Iterable
+
 import tiktoken
 
+from .ttlcache import TTLCache
+
 MODELS_2_TOKEN_LIMITS = {
     "gpt-35-turbo": 4000,
     "gpt-3.5-turbo": 4000,
@@ -37,13 +43,41 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         num_tokens_from_messages(message, model)
         output: 11
     """
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    encoding = get_encoding(model)
     num_tokens = 2  # For "role" and "content" keys
     for key, value in message.items():
-        num_tokens += len(encoding.encode(value))
+        num_tokens += num_tokens_from_text(value, encoding)
     return num_tokens
 
 
+# Token counts keyed on (encoding name, content digest), so repeated history turns and static
+# prompts are only tokenized once. The digest keeps long texts out of the cache, and unlike
+# hash() it doesn't collide between different texts in practice
+token_counts = TTLCache(maxsize=65536)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+def num_tokens_from_text(text: str, encoding: tiktoken.Encoding) -> int:
+    key = (encoding.name, hashlib.blake2b(text.encode(), digest_size=16).digest())
+    num_tokens = token_counts.get(key)
+    if num_tokens is None:
+        num_tokens = len(encoding.encode(text))
+        token_counts.set(key, num_tokens)
+    return num_tokens
+
+
+def warm_token_counts(texts: Iterable[str], models: Iterable[str]) -> None:
+    """Tokenize static prompts ahead of the first request."""
+    for model in set(models):
+        encoding = get_encoding(model)
+        for text in texts:
+            num_tokens_from_text(text, encoding)
+
+
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
@@ -0,0 +1,440 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import random
+import re
+import struct
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Iterator, Optional
+
+import openai
+
+from .modelhelper import get_encoding, num_tokens_from_messages, num_tokens_from_text
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the budgets can't be shared between processes
+    fcntl = None
+
+# All the deployments (gpt-35-turbo, gpt-4 and text-embedding-ada-002) use the same
+# encoding, so one tokenizer estimates the cost of every call
+TOKENIZER_MODEL = "gpt-35-turbo"
+# Azure estimates the completion of a call without max_tokens as this many tokens
+DEFAULT_COMPLETION_TOKENS = 256
+
+
+class Priority(IntEnum):
+    """Priority classes of OpenAI calls, a lower value goes first."""
+
+    INTERACTIVE = 0
+    BATCH = 1
+    INGESTION = 2
+
+
+def status_code(error: Exception) -> Optional[int]:
+    # openai errors carry http_status, azure-core errors status_code
+    return getattr(error, "http_status", None) or getattr(error, "status_code", None)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Returns the delay the service asked for in the error's headers, in seconds."""
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    headers = {k.lower(): v for k, v in headers.items()}
+    for name, scale in [
+        ("retry-after-ms", 0.001),
+        ("x-ms-retry-after-ms", 0.001),
+        ("retry-after", 1.0),
+    ]:
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, ValueError):
+            continue
+    return None
+
+
+class RateLimit:
+    """The quota of a deployment. Azure allows 6 requests per minute per 1000 tokens."""
+
+    def __init__(
+        self, tokens_per_minute: float, requests_per_minute: Optional[float] = None
+    ):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute or tokens_per_minute * 6 / 1000
+
+
+def parse_rate_limits(spec: str) -> dict[str, RateLimit]:
+    """Parses "deployment=tokens per minute[/requests per minute],..."."""
+    limits = {}
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        deployment, _, quota = item.partition("=")
+        tokens, _, requests = quota.partition("/")
+        limits[deployment.strip()] = RateLimit(
+            float(tokens), float(requests) if requests else None
+        )
+    return limits
+
+
+# Bucket state: tokens, requests, last refill, paused until, then per priority the time
+# until which calls of that priority are waiting
+TOKENS, REQUESTS, UPDATED, PAUSED_UNTIL, WAITING_UNTIL = range(5)
+STATE = struct.Struct("<" + "d" * (WAITING_UNTIL + len(Priority)))
+
+
+class BucketState:
+    """In-process bucket state. Zeros are a full bucket: the first refill fills it."""
+
+    def __init__(self):
+        self.values = [0.0] * (WAITING_UNTIL + len(Priority))
+
+    @contextmanager
+    def locked(self) -> Iterator[list[float]]:
+        yield self.values
+
+
+class SharedBucketState(BucketState):
+    """
+    Bucket state in a memory-mapped file, shared by every process that opens the same
+    file. Updates are serialized with an exclusive flock; they don't await, so they
+    are never held across a suspension of the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < STATE.size:
+            os.ftruncate(self.fd, STATE.size)
+        self.map = mmap.mmap(self.fd, STATE.size)
+
+    @contextmanager
+    def locked(self) -> Iterator[list[float]]:
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            values = list(STATE.unpack_from(self.map))
+            yield values
+            STATE.pack_into(self.map, 0, *values)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class TokenBucket:
+    """
+    The tokens and requests per minute budgets of a deployment, refilled continuously,
+    with `burst` seconds of quota as the capacity: the default, a full minute, fits the
+    largest call the deployment accepts, where a smaller capacity would delay calls
+    Azure takes. A call is charged its prompt tokens plus max_tokens up front, like
+    Azure does, and a call costing more than the capacity waits for a full bucket, then
+    takes it into debt. Calls of lower priority classes leave `reserve` of the capacity
+    to interactive calls, and wait while calls of a higher class wait, in any process
+    sharing the state. Without a limit, only pauses and priorities apply.
+    """
+
+    # How long a refused call announces that its priority class is waiting, beyond
+    # the time it was told to wait
+    ANNOUNCE_MARGIN = 0.05
+
+    def __init__(
+        self,
+        limit: Optional[RateLimit],
+        state: Optional[BucketState] = None,
+        burst: float = 60.0,
+        reserve: float = 0.2,
+    ):
+        self.limit = limit
+        self.state = state or BucketState()
+        if limit:
+            self.token_rate = limit.tokens_per_minute / 60
+            self.request_rate = limit.requests_per_minute / 60
+            self.token_capacity = self.token_rate * burst
+            self.request_capacity = max(self.request_rate * burst, 1.0)
+        self.reserve = reserve
+
+    def acquire(self, tokens: float, priority: Priority) -> float:
+        """Takes the budget of a call, or returns how many seconds to wait before trying again."""
+        with self.state.locked() as s:
+            now = time.time()
+            if s[PAUSED_UNTIL] > now:
+                return s[PAUSED_UNTIL] - now
+            higher = max(s[WAITING_UNTIL : WAITING_UNTIL + priority], default=0.0)
+            if higher > now:
+                return higher - now
+            wait = 0.0
+            if self.limit:
+                elapsed = max(now - s[UPDATED], 0.0)
+                s[TOKENS] = min(
+                    s[TOKENS] + elapsed * self.token_rate, self.token_capacity
+                )
+                s[REQUESTS] = min(
+                    s[REQUESTS] + elapsed * self.request_rate, self.request_capacity
+                )
+                s[UPDATED] = now
+                floor = self.token_capacity * self.reserve if priority else 0.0
+                needed = floor + min(tokens, self.token_capacity - floor)
+                wait = max(
+                    (needed - s[TOKENS]) / self.token_rate,
+                    (1.0 - s[REQUESTS]) / self.request_rate,
+                )
+            if wait <= 0:
+                if self.limit:
+                    s[TOKENS] -= tokens
+                    s[REQUESTS] -= 1.0
+                return 0.0
+            s[WAITING_UNTIL + priority] = max(
+                s[WAITING_UNTIL + priority], now + wait + self.ANNOUNCE_MARGIN
+            )
+            return wait
+
+    def pause(self, seconds: float) -> None:
+        """Stops all calls for `seconds`, after the service rate limited one."""
+        with self.state.locked() as s:
+            s[PAUSED_UNTIL] = max(s[PAUSED_UNTIL], time.time() + seconds)
+            # The service counted more than the estimates did
+            s[TOKENS] = min(s[TOKENS], 0.0)
+
+
+class DeploymentQueue:
+    """
+    Hands a deployment's budget to this process's waiting calls, in priority order and
+    first come first served within a class. A call waiting at the head holds back the
+    ones behind it, so large interactive calls aren't starved by small batch ones.
+    """
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.waiters: list[tuple[int, int, float, asyncio.Future]] = []
+        self.order = itertools.count()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.requests = 0
+        self.tokens = 0.0
+        self.queued = 0
+        self.wait_time = 0.0
+        self.rate_limited = 0
+
+    async def acquire(self, tokens: float, priority: Priority) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), tokens, future))
+        self.dispatch()
+        self.requests += 1
+        self.tokens += tokens
+        if future.done():
+            return
+        self.queued += 1
+        start = time.perf_counter()
+        try:
+            await future
+        finally:
+            self.wait_time += time.perf_counter() - start
+
+    def dispatch(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.waiters:
+            priority, _, tokens, future = self.waiters[0]
+            if future.done():  # Cancelled while waiting
+                heapq.heappop(self.waiters)
+                continue
+            wait = self.bucket.acquire(tokens, Priority(priority))
+            if wait > 0:
+                self.timer = asyncio.get_running_loop().call_later(wait, self.dispatch)
+                return
+            heapq.heappop(self.waiters)
+            future.set_result(None)
+
+    def pause(self, seconds: float) -> None:
+        self.rate_limited += 1
+        self.bucket.pause(seconds)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "estimated_tokens": int(self.tokens),
+            "queued": self.queued,
+            "wait_ms": round(self.wait_time * 1000, 1),
+            "rate_limited": self.rate_limited,
+            "waiting": len(self.waiters),
+        }
+
+
+class OpenAIScheduler:
+    """
+    Schedules the chat completion, completion and embedding calls of all approaches
+    and ingestion against the quota of each deployment (see TokenBucket), in priority
+    order. A rate limited call pauses its deployment for the Retry-After the service
+    sent, or an exponential backoff without one, and is retried up to `max_retries`
+    times. With `shared_dir`, the budgets live in files there that all the workers and
+    the ingestion process share, instead of each process getting the whole quota.
+
+    `openai_client` is the openai module, or anything with the same ChatCompletion,
+    Completion and Embedding `acreate` methods (see ingestion/fakes.py).
+    """
+
+    def __init__(
+        self,
+        limits: Optional[dict[str, RateLimit]] = None,
+        shared_dir: Optional[str] = None,
+        max_retries: int = 3,
+        burst: float = 60.0,
+        reserve: float = 0.2,
+        max_backoff: float = 60.0,
+        openai_client: Any = openai,
+    ):
+        self.limits = limits or {}
+        self.shared_dir = shared_dir if fcntl is not None else None
+        if self.shared_dir:
+            os.makedirs(self.shared_dir, exist_ok=True)
+        self.max_retries = max_retries
+        self.burst = burst
+        self.reserve = reserve
+        self.max_backoff = max_backoff
+        self.openai = openai_client
+        self.queues: dict[str, DeploymentQueue] = {}
+        self.retries = 0
+
+    def queue(self, deployment: str) -> DeploymentQueue:
+        queue = self.queues.get(deployment)
+        if queue is None:
+            state = None
+            if self.shared_dir:
+                name = re.sub(r"[^\w.-]", "_", deployment)
+                state = SharedBucketState(os.path.join(self.shared_dir, name))
+            bucket = TokenBucket(
+                self.limits.get(deployment), state, self.burst, self.reserve
+            )
+            queue = self.queues[deployment] = DeploymentQueue(bucket)
+        return queue
+
+    async def call(
+        self,
+        deployment: str,
+        priority: Priority,
+        estimate: Callable[[], float],
+        fn: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        queue = self.queue(deployment)
+        # Calls to deployments without a limit aren't tokenized
+        tokens = estimate() if queue.bucket.limit else 0.0
+        attempt = 0
+        while True:
+            await queue.acquire(tokens, priority)
+            try:
+                return await fn()
+            except openai.error.RateLimitError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_backoff, 2**attempt))
+                queue.pause(delay)
+                attempt += 1
+                self.retries += 1
+                logging.warning(
+                    "%s rate limited, retrying in %.1f s (attempt %d)",
+                    deployment,
+                    delay,
+                    attempt,
+                )
+
+    async def chat_completion(
+        self,
+        priority: Priority = Priority.INTERACTIVE,
+        prompt_tokens: Optional[int] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        openai.ChatCompletion.acreate, scheduled. `prompt_tokens` is the length of the
+        messages, when the caller knows it already (see MessageBuilder.token_length).
+        """
+
+        def estimate() -> float:
+            prompt = prompt_tokens
+            if prompt is None:
+                prompt = sum(
+                    num_tokens_from_messages(message, TOKENIZER_MODEL)
+                    for message in kwargs["messages"]
+                )
+            return prompt + self.completion_tokens(kwargs)
+
+        return await self.call(
+            kwargs.get("deployment_id") or kwargs["engine"],
+            priority,
+            estimate,
+            lambda: self.openai.ChatCompletion.acreate(**kwargs),
+        )
+
+    async def completion(
+        self, priority: Priority = Priority.INTERACTIVE, **kwargs: Any
+    ) -> Any:
+        prompts = kwargs["prompt"]
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        return await self.call(
+            kwargs.get("deployment_id") or kwargs["engine"],
+            priority,
+            lambda: self.num_tokens(prompts)
+            + self.completion_tokens(kwargs) * len(prompts),
+            lambda: self.openai.Completion.acreate(**kwargs),
+        )
+
+    async def embedding(
+        self, priority: Priority = Priority.INTERACTIVE, **kwargs: Any
+    ) -> Any:
+        texts = kwargs["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        return await self.call(
+            kwargs.get("deployment_id") or kwargs["engine"],
+            priority,
+            lambda: self.num_tokens(texts),
+            lambda: self.openai.Embedding.acreate(**kwargs),
+        )
+
+    @staticmethod
+    def num_tokens(texts: list[str]) -> int:
+        encoding = get_encoding(TOKENIZER_MODEL)
+        return sum(num_tokens_from_text(text, encoding) for text in texts)
+
+    @staticmethod
+    def completion_tokens(kwargs: dict[str, Any]) -> int:
+        max_tokens = kwargs.get("max_tokens")
+        if not max_tokens or max_tokens < 0:
+            max_tokens = DEFAULT_COMPLETION_TOKENS
+        return max_tokens * (kwargs.get("n") or 1)
+
+    def completion_client(
+        self, priority: Priority = Priority.INTERACTIVE
+    ) -> "CompletionClient":
+        return CompletionClient(self, priority)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "shared": bool(self.shared_dir),
+            "deployments": {
+                deployment: queue.stats() for deployment, queue in self.queues.items()
+            },
+        }
+
+
+class CompletionClient:
+    """
+    Stands in for openai.Completion as the `client` of langchain's OpenAI LLMs, so
+    their calls are scheduled like the others.
+    """
+
+    def __init__(self, scheduler: OpenAIScheduler, priority: Priority):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    async def acreate(self, **kwargs: Any) -> Any:
+        return await self.scheduler.completion(self.priority, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.scheduler.openai.Completion, name)
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+from typing import Any, Optional
+
+import numpy as np
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import QueryType, Vector
+
+TEXT_LEG = "text"
+
+
+def parent_id(doc_id: str) -> str:
+    """Chunks are indexed as `{doc}-page-{i}`; returns `{doc}`."""
+    return doc_id.rsplit("-page-", 1)[0]
+
+
+class HybridRetriever:
+    """
+    Runs the BM25 (or semantic) text query and one vector query per embedding field
+    concurrently, and fuses the ranked lists on our side with weighted reciprocal rank
+    fusion: a document scores sum(weight / (rrf_k + rank)) over the lists it appears in.
+    Chunks are then deduplicated by parent document, and the final `top` are picked with
+    maximal marginal relevance (MMR) over the chunks' embeddings, so near-duplicate
+    chunks don't crowd out other relevant documents. MMR picks from the best
+    `mmr_candidates` fused chunks, whose embeddings are fetched with one lookup by key
+    rather than returned by every query.
+
+    With a `text_client` (a LocalSearchClient), text queries that don't use the semantic
+    ranker are sent there instead, so the BM25 leg runs in-process.
+    """
+
+    def __init__(
+        self,
+        search_client: SearchClient,
+        select: list[str],
+        vector_fields: list[str],
+        mmr_field: Optional[str] = None,
+        weights: Optional[dict[str, float]] = None,
+        rrf_k: int = 60,
+        candidates: int = 20,
+        mmr_lambda: float = 0.7,
+        max_chunks_per_doc: int = 1,
+        mmr_candidates: int = 10,
+        id_field: str = "Id",
+        text_client: Optional[Any] = None,
+    ):
+        self.search_client = search_client
+        self.text_client = text_client
+        self.select = select
+        self.vector_fields = vector_fields
+        self.mmr_field = mmr_field
+        self.weights = weights or {}
+        self.rrf_k = rrf_k
+        self.candidates = candidates
+        self.mmr_lambda = mmr_lambda
+        self.max_chunks_per_doc = max_chunks_per_doc
+        self.mmr_candidates = mmr_candidates
+        self.id_field = id_field
+
+    async def search(
+        self,
+        search_text: Optional[str],
+        query_vector: Optional[np.ndarray],
+        top: int,
+        filter: Optional[str] = None,
+        semantic_ranker: bool = False,
+        semantic_captions: bool = False,
+    ) -> list[dict[str, Any]]:
+        legs = {}
+        if search_text:
+            legs[TEXT_LEG] = self.search_text(
+                search_text, filter, semantic_ranker, semantic_captions
+            )
+        if query_vector is not None:
+            query_values = query_vector.tolist()
+            for field in self.vector_fields:
+                legs[field] = self.search_vector(query_values, field, filter)
+        if not legs:
+            return []
+        ranked_lists = dict(zip(legs, await asyncio.gather(*legs.values())))
+        fused = self.fuse(ranked_lists)
+        fused = self.dedupe(fused)
+        if len(fused) <= top or not self.mmr_field or self.mmr_lambda >= 1:
+            return fused[:top]
+        candidates = await self.fetch_embeddings(
+            fused[: max(top, self.mmr_candidates)]
+        )
+        return self.mmr(candidates, top)
+
+    async def search_text(
+        self,
+        search_text: str,
+        filter: Optional[str],
+        semantic_ranker: bool,
+        semantic_captions: bool,
+    ) -> list[dict[str, Any]]:
+        if semantic_ranker:
+            r = await self.search_client.search(
+                search_text,
+                filter=filter,
+                query_type=QueryType.SEMANTIC,
+                query_language="en-us",
+                query_speller="lexicon",
+                semantic_configuration_name="default",
+                query_caption="extractive|highlight-false"
+                if semantic_captions
+                else None,
+                top=self.candidates,
+                select=self.select,
+            )
+        else:
+            r = await (self.text_client or self.search_client).search(
+                search_text,
+                filter=filter,
+                top=self.candidates,
+                select=self.select,
+            )
+        return [doc async for doc in r]
+
+    async def search_vector(
+        self, query_values: list[float], field: str, filter: Optional[str]
+    ) -> list[dict[str, Any]]:
+        r = await self.search_client.search(
+            None,
+            filter=filter,
+            top=self.candidates,
+            vectors=[Vector(value=query_values, k=self.candidates, fields=field)],
+            select=self.select,
+        )
+        return [doc async for doc in r]
+
+    async def fetch_embeddings(
+        self, docs: list[dict[str, Any]]
+    ) -> list[dict[str, Any]]:
+        """
+        Adds the MMR embedding to the documents that don't have it, with one lookup. The
+        key field must be filterable (see ingestion/index.py): when the lookup is
+        rejected, the documents are returned without embeddings and MMR keeps the fused
+        order.
+        """
+        keys = [doc[self.id_field] for doc in docs if doc.get(self.mmr_field) is None]
+        if not keys:
+            return docs
+        try:
+            # Document keys only contain letters, digits, "_", "-" and "="
+            r = await self.search_client.search(
+                "*",
+                filter=f"search.in({self.id_field}, '{','.join(keys)}', ',')",
+                top=len(keys),
+                select=[self.id_field, self.mmr_field],
+            )
+            embeddings = {
+                doc[self.id_field]: doc.get(self.mmr_field) async for doc in r
+            }
+        except HttpResponseError as e:
+            logging.warning("Skipping MMR, the embeddings lookup failed: %s", e)
+            return docs
+        return [
+            doc
+            if doc.get(self.mmr_field) is not None
+            else {**doc, self.mmr_field: embeddings.get(doc[self.id_field])}
+            for doc in docs
+        ]
+
+    def fuse(
+        self, ranked_lists: dict[str, list[dict[str, Any]]]
+    ) -> list[dict[str, Any]]:
+        """Returns the documents of all lists by descending weighted RRF score."""
+        scores: dict[str, float] = {}
+        docs: dict[str, dict[str, Any]] = {}
+        for leg, ranked in ranked_lists.items():
+            weight = self.weights.get(leg, 1.0)
+            for rank, doc in enumerate(ranked, start=1):
+                key = doc[self.id_field]
+                scores[key] = scores.get(key, 0.0) + weight / (self.rrf_k + rank)
+                if key in docs:
+                    # Keep the fields (captions) of the list that returned it first
+                    docs[key] = {**doc, **docs[key]}
+                else:
+                    docs[key] = doc
+        fused = sorted(docs, key=scores.__getitem__, reverse=True)
+        return [{**docs[key], "@search.fused_score": scores[key]} for key in fused]
+
+    def dedupe(self, docs: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Keeps the best `max_chunks_per_doc` chunks of each parent document."""
+        chunks: dict[str, int] = {}
+        deduped = []
+        for doc in docs:
+            parent = parent_id(doc[self.id_field])
+            if chunks.get(parent, 0) < self.max_chunks_per_doc:
+                chunks[parent] = chunks.get(parent, 0) + 1
+                deduped.append(doc)
+        return deduped
+
+    def mmr(self, docs: list[dict[str, Any]], top: int) -> list[dict[str, Any]]:
+        """
+        Greedily picks `top` documents maximizing
+        lambda * relevance - (1 - lambda) * max similarity to the documents picked so far,
+        where relevance is the fused score scaled to [0, 1] and similarity is the cosine
+        of the embeddings. Documents without an embedding are never penalized.
+        """
+        if len(docs) <= top or not self.mmr_field or self.mmr_lambda >= 1:
+            return docs[:top]
+        # Embeddings are lists, or float32 arrays when they come from the search cache
+        vectors = [doc.get(self.mmr_field) for doc in docs]
+        dimensions = next((len(v) for v in vectors if v is not None and len(v)), 0)
+        if not dimensions:
+            return docs[:top]
+        embeddings = np.zeros((len(docs), dimensions), dtype=np.float32)
+        for i, vector in enumerate(vectors):
+            if vector is not None and len(vector):
+                embeddings[i] = vector
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms > 0, norms, 1.0)
+        relevance = np.array([doc["@search.fused_score"] for doc in docs])
+        relevance /= relevance.max()
+
+        selected: list[int] = []
+        max_similarity = np.zeros(len(docs), dtype=np.float32)
+        available = np.ones(len(docs), dtype=bool)
+        for _ in range(top):
+            scores = (
+                self.mmr_lambda * relevance
+                - (1 - self.mmr_lambda) * max_similarity
+            )
+            scores[~available] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            available[best] = False
+            max_similarity = np.maximum(max_similarity, embeddings @ embeddings[best])
+        return [docs[i] for i in selected]
@@ -0,0 +1,215 @@
+import hashlib
+import logging
+import os
+import time
+import uuid
+from enum import Enum
+from typing import Any, Hashable, Optional
+
+import numpy as np
+from azure.search.documents.models import Vector
+
+from .localsearch import LocalSearchResults, read_search
+from .singleflight import SingleFlight
+from .ttlcache import TTLCache
+
+# Lists of floats at least this long are embeddings, kept as float32 arrays in the cache
+MIN_VECTOR_LENGTH = 64
+
+
+def bump_generation(path: str) -> str:
+    """Writes a new index generation marker, invalidating the search caches watching it."""
+    generation = uuid.uuid4().hex
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(generation)
+    os.replace(tmp_path, path)
+    return generation
+
+
+class IndexGeneration:
+    """
+    Reads the generation marker that ingestion writes after changing the index, at most
+    once every `check_interval` seconds. Without a marker file, the generation is "".
+    The marker only works if ingestion writes it where the app reads it, so a missing
+    marker is logged.
+    """
+
+    def __init__(self, path: Optional[str], check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.checked = 0.0
+        self.generation = ""
+        self.missing = False
+
+    def current(self) -> str:
+        now = time.monotonic()
+        if self.path and now - self.checked >= self.check_interval:
+            self.checked = now
+            try:
+                with open(self.path) as f:
+                    self.generation = f.read().strip()
+                self.missing = False
+            except FileNotFoundError:
+                if not self.missing:
+                    logging.warning(
+                        "No index generation marker at %s, so re-ingestion won't clear "
+                        "the search cache: ingestion must write it to a path this app "
+                        "reads (SEARCH_INDEX_GENERATION_PATH)",
+                        self.path,
+                    )
+                self.missing = True
+                self.generation = ""
+        return self.generation
+
+
+def vector_digest(values: Any) -> bytes:
+    return hashlib.blake2b(
+        np.asarray(values, dtype=np.float32).tobytes(), digest_size=16
+    ).digest()
+
+
+def freeze(value: Any) -> Hashable:
+    """A hashable form of a search argument. Vectors are replaced by a digest."""
+    if isinstance(value, Vector):
+        return ("vector", vector_digest(value.value), value.k, value.fields)
+    if isinstance(value, np.ndarray):
+        return ("vector", vector_digest(value))
+    if isinstance(value, (list, tuple)):
+        if len(value) >= MIN_VECTOR_LENGTH and isinstance(value[0], float):
+            return ("vector", vector_digest(value))
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+class CachedSearch:
+    """A materialized search response, with embeddings stored as float32 arrays."""
+
+    def __init__(self, results: list[dict[str, Any]], count, answers, latency: float):
+        self.results = [
+            {
+                k: np.asarray(v, dtype=np.float32) if self.is_vector(v) else v
+                for k, v in doc.items()
+            }
+            for doc in results
+        ]
+        self.count = count
+        self.answers = answers
+        self.latency = latency
+
+    @staticmethod
+    def is_vector(value: Any) -> bool:
+        return (
+            isinstance(value, list)
+            and len(value) >= MIN_VECTOR_LENGTH
+            and isinstance(value[0], float)
+        )
+
+    def response(self) -> LocalSearchResults:
+        # Every caller gets its own documents, as from a new search
+        return LocalSearchResults(
+            [
+                {
+                    k: v.tolist() if isinstance(v, np.ndarray) else v
+                    for k, v in doc.items()
+                }
+                for doc in self.results
+            ],
+            self.count,
+            self.answers,
+        )
+
+
+class CachedSearchClient:
+    """
+    Wraps the search client shared by all approaches and caches materialized search
+    responses (documents, count and answers) in a bounded LRU with a TTL. The key is the
+    full set of search arguments, with the whitespace and case of the search text
+    normalized and query vectors replaced by a digest, plus the index generation, so a
+    re-ingestion invalidates the cache. Concurrent identical searches are sent once.
+    Degraded responses (see FallbackSearchClient) aren't cached.
+    """
+
+    def __init__(
+        self,
+        search_client: Any,
+        maxsize: int = 512,
+        ttl: Optional[float] = 600,
+        generation: Optional[IndexGeneration] = None,
+    ):
+        self.search_client = search_client
+        self.cache = TTLCache(maxsize, ttl)
+        self.generation = generation or IndexGeneration(None)
+        self.cached_generation = self.generation.current()
+        self.searches = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        self.latency_saved = 0.0
+
+    def key(self, args: tuple, kwargs: dict[str, Any]) -> Hashable:
+        if args:
+            kwargs = {"search_text": args[0], **kwargs}
+            args = args[1:]
+        search_text = kwargs.get("search_text")
+        if isinstance(search_text, str):
+            kwargs["search_text"] = " ".join(search_text.split()).casefold()
+        return (
+            self.cached_generation,
+            freeze(args),
+            freeze({k: v for k, v in kwargs.items() if v is not None}),
+        )
+
+    async def search(self, *args: Any, **kwargs: Any) -> LocalSearchResults:
+        generation = self.generation.current()
+        if generation != self.cached_generation:
+            self.cache.clear()
+            self.cached_generation = generation
+            self.invalidations += 1
+        key = self.key(args, kwargs)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            self.latency_saved += cached.latency
+            return cached.response()
+        if key in self.searches:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        cached = await self.searches.do(
+            key, lambda: self.search_uncached(key, args, kwargs)
+        )
+        return cached.response()
+
+    async def search_uncached(
+        self, key: Hashable, args: tuple, kwargs: dict[str, Any]
+    ) -> CachedSearch:
+        start = time.perf_counter()
+        r = await read_search(self.search_client, *args, **kwargs)
+        cached = CachedSearch(
+            r.results, r.count, r.answers, time.perf_counter() - start
+        )
+        if not r.degraded:
+            self.cache.set(key, cached)
+        return cached
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "latency_saved_ms": round(self.latency_saved * 1000, 1),
+            "entries": len(self.cache),
+            "invalidations": self.invalidations,
+            "generation": self.cached_generation,
+        }
+
+    async def close(self) -> None:
+        await self.search_client.close()
@@ -0,0 +1,51 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls: while a call for a key is in flight, other callers
+    with the same key wait for its result instead of starting their own. With
+    `cancel_abandoned`, the call is cancelled once every caller waiting for it has
+    been cancelled, instead of running on for nobody.
+    """
+
+    def __init__(self, cancel_abandoned: bool = False):
+        self.calls: dict[Hashable, asyncio.Future] = {}
+        self.cancel_abandoned = cancel_abandoned
+        self.waiters: dict[asyncio.Future, int] = {}
+        self.cancelled = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.forget(key, f))
+        if not self.cancel_abandoned:
+            # A cancelled caller must not cancel the call for everyone waiting on it
+            return await asyncio.shield(future)
+        self.waiters[future] = self.waiters.get(future, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self.waiters[future] -= 1
+            if not self.waiters[future]:
+                del self.waiters[future]
+                if not future.done():
+                    # Forgotten right away, so that a new caller doesn't wait for it
+                    self.forget(key, future)
+                    future.cancel()
+                    self.cancelled += 1
+
+    def forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self.calls.get(key) is future:
+            del self.calls[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.calls
+
+    def __len__(self) -> int:
+        return len(self.calls)
@@ -0,0 +1,208 @@
+import logging
+import os
+import re
+from typing import Any, Optional
+
+import numpy as np
+from azure.search.documents.aio import SearchClient
+
+# Words that point at one data source. They only break near-ties between the nearest
+# centroids, when the question matches the keywords of a single one of them
+DEFAULT_KEYWORDS = {
+    "SoftServe Website": [
+        "blog",
+        "career",
+        "careers",
+        "case study",
+        "case studies",
+        "client",
+        "clients",
+        "contact",
+        "event",
+        "events",
+        "industries",
+        "industry",
+        "job",
+        "jobs",
+        "news",
+        "office",
+        "offices",
+        "partner",
+        "partners",
+        "project",
+        "projects",
+        "service",
+        "services",
+        "solution",
+        "solutions",
+        "vacancies",
+        "whitepaper",
+        "whitepapers",
+    ],
+    "Wikipedia": [
+        "acquired",
+        "acquisition",
+        "board",
+        "ceo",
+        "chairman",
+        "established",
+        "founded",
+        "founder",
+        "founders",
+        "headquarters",
+        "history",
+        "ipo",
+        "leadership",
+        "revenue",
+        "wikipedia",
+    ],
+}
+
+# Entry of the centroids file holding the index generation, not a source name
+GENERATION_KEY = "__generation__"
+
+
+class SourceClassifier:
+    """
+    Picks the data source (`Storage` value) most likely to answer a question without an
+    LLM call. The question's embedding is compared with one centroid per source, the
+    mean of the normalized embeddings of that source's documents: the nearest centroid
+    wins if it is similar enough and ahead of the runner-up by `min_margin`. If other
+    centroids are within the margin, a keyword match picks one of them if it points at a
+    single one. `classify` returns None when neither is confident, and the caller falls
+    back to the LLM classifier.
+    """
+
+    def __init__(
+        self,
+        centroids: dict[str, np.ndarray],
+        keywords: Optional[dict[str, list[str]]] = None,
+        min_similarity: float = 0.75,
+        min_margin: float = 0.02,
+    ):
+        self.sources = list(centroids)
+        self.centroids = (
+            np.stack([self.normalize(c) for c in centroids.values()])
+            if centroids
+            else None
+        )
+        keywords = DEFAULT_KEYWORDS if keywords is None else keywords
+        self.keywords = {
+            source: re.compile(
+                r"\b(" + "|".join(re.escape(w) for w in words) + r")\b",
+                re.IGNORECASE,
+            )
+            for source, words in keywords.items()
+            if words
+        }
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self.counts = {"centroid": 0, "keyword": 0, "low_confidence": 0}
+
+    @staticmethod
+    def normalize(vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def classify(
+        self, text: str, query_vector: Optional[np.ndarray]
+    ) -> Optional[list[str]]:
+        if self.centroids is None or query_vector is None:
+            self.counts["low_confidence"] += 1
+            return None
+        similarities = self.centroids @ self.normalize(query_vector)
+        best = similarities.max()
+        if best < self.min_similarity:
+            self.counts["low_confidence"] += 1
+            return None
+        close = [
+            source
+            for source, similarity in zip(self.sources, similarities)
+            if best - similarity < self.min_margin
+        ]
+        if len(close) == 1:
+            self.counts["centroid"] += 1
+            return close
+        matches = [
+            source
+            for source in close
+            if source in self.keywords and self.keywords[source].search(text)
+        ]
+        if len(matches) == 1:
+            self.counts["keyword"] += 1
+            return matches
+        self.counts["low_confidence"] += 1
+        return None
+
+    def stats(self) -> dict[str, Any]:
+        decisions = sum(self.counts.values())
+        return {
+            **self.counts,
+            "local_rate": round(1 - self.counts["low_confidence"] / decisions, 4)
+            if decisions
+            else 0.0,
+            "sources": self.sources,
+        }
+
+    @staticmethod
+    async def build_centroids(
+        search_client: SearchClient,
+        sources: list[str],
+        storage_field: str = "Storage",
+        vector_field: str = "content_embedding",
+        sample_size: int = 1000,
+    ) -> dict[str, np.ndarray]:
+        """Averages the normalized embeddings of up to `sample_size` documents per source."""
+        centroids = {}
+        for source in sources:
+            r = await search_client.search(
+                "*",
+                filter=f"{storage_field} eq '{source}'",
+                select=[vector_field],
+                top=sample_size,
+            )
+            vectors = [
+                SourceClassifier.normalize(doc[vector_field])
+                async for doc in r
+                if doc.get(vector_field)
+            ]
+            if vectors:
+                centroids[source] = np.mean(vectors, axis=0)
+        return centroids
+
+    @classmethod
+    async def load_or_build(
+        cls,
+        path: str,
+        search_client: SearchClient,
+        sources: list[str],
+        generation: str = "",
+        **kwargs,
+    ) -> "SourceClassifier":
+        """
+        Loads the centroids saved at `path` (an .npz file), or builds them from the index
+        and saves them there. The file records the index `generation` it was built from,
+        and is rebuilt once ingestion has moved the index to another one. Without
+        centroids, the LLM classifier is always used.
+        """
+        centroids = {}
+        try:
+            if path and os.path.exists(path):
+                with np.load(path) as saved:
+                    if str(saved.get(GENERATION_KEY, "")) == generation:
+                        centroids = {
+                            source: saved[source]
+                            for source in saved.files
+                            if source != GENERATION_KEY
+                        }
+            if not centroids:
+                centroids = await cls.build_centroids(search_client, sources)
+                if path and centroids:
+                    # Written under a temporary name so other workers never load a partial file
+                    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+                    np.savez(tmp_path, **centroids, **{GENERATION_KEY: generation})
+                    os.replace(tmp_path, path)
+        except Exception:
+            logging.exception("Failed to load the source centroids")
+        return cls(centroids, **kwargs)
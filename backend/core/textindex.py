@@ -0,0 +1,165 @@
+import json
+import os
+import re
+from array import array
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+TOKEN = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i if in into is it its of on "
+    "or our that the their there these they this to was we were what when where which "
+    "who why will with you your".split()
+)
+TERMS = "text_terms.json"
+ARRAYS = "text_index.npz"
+
+
+def stem(word: str) -> str:
+    # Harman's "S" stemmer: conflates plurals without an analyzer dependency
+    if len(word) > 3:
+        if word.endswith("ies") and not word.endswith(("eies", "aies")):
+            return word[:-3] + "y"
+        if word.endswith("es") and not word.endswith(("aes", "ees", "oes")):
+            return word[:-1]
+        if word.endswith("s") and not word.endswith(("us", "ss")):
+            return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> list[str]:
+    return [
+        stem(word)
+        for word in TOKEN.findall(text.lower())
+        if word not in STOPWORDS
+    ]
+
+
+class TextIndex:
+    """
+    BM25 keyword index over the documents of a LocalIndex. Postings are stored per term
+    as contiguous numpy slices (CSR layout: `offsets[t]:offsets[t + 1]` into `doc_ids`
+    and `impacts`), and each posting's BM25 contribution,
+    idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average length)),
+    is precomputed at build time, so scoring a query is one vectorized add per query
+    term. Rows match the LocalIndex's documents, so its filter bitmasks apply as is.
+    """
+
+    def __init__(
+        self,
+        terms: list[str],
+        offsets: np.ndarray,
+        doc_ids: np.ndarray,
+        impacts: np.ndarray,
+        idf: np.ndarray,
+        lengths: np.ndarray,
+    ):
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.impacts = impacts
+        self.idf = idf
+        self.lengths = lengths
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, texts: list[str], k1: float = 1.2, b: float = 0.75) -> "TextIndex":
+        vocabulary: dict[str, int] = {}
+        term_ids, doc_ids, tfs = array("i"), array("i"), array("f")
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_ids.append(doc)
+                tfs.append(tf)
+        term_ids_np = np.frombuffer(term_ids, dtype=np.int32)
+        order = np.argsort(term_ids_np, kind="stable")
+        df = np.bincount(term_ids_np, minlength=len(vocabulary))
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(df, out=offsets[1:])
+        # Lucene's BM25 idf, always positive
+        idf = np.log1p((len(texts) - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+        doc_ids_np = np.frombuffer(doc_ids, dtype=np.int32)[order]
+        tfs_np = np.frombuffer(tfs, dtype=np.float32)[order]
+        average_length = float(lengths.mean()) if len(texts) else 0.0
+        norms = k1 * (1 - b + b * lengths / (average_length or 1.0))
+        impacts = (
+            idf[term_ids_np[order]] * tfs_np * (k1 + 1) / (tfs_np + norms[doc_ids_np])
+        ).astype(np.float32)
+        terms = sorted(vocabulary, key=vocabulary.__getitem__)
+        return cls(terms, offsets, doc_ids_np, impacts, idf, lengths)
+
+    def save(self, path: str) -> None:
+        with open(os.path.join(path, TERMS), "w") as f:
+            json.dump(self.terms, f)
+        np.savez(
+            os.path.join(path, ARRAYS),
+            offsets=self.offsets,
+            doc_ids=self.doc_ids,
+            impacts=self.impacts,
+            idf=self.idf,
+            lengths=self.lengths,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> Optional["TextIndex"]:
+        """Loads the index saved in the directory `path`, or returns None if there is none."""
+        if not os.path.exists(os.path.join(path, ARRAYS)):
+            return None
+        with open(os.path.join(path, TERMS)) as f:
+            terms = json.load(f)
+        with np.load(os.path.join(path, ARRAYS)) as arrays:
+            return cls(
+                terms,
+                arrays["offsets"],
+                arrays["doc_ids"],
+                arrays["impacts"],
+                arrays["idf"],
+                arrays["lengths"],
+            )
+
+    def query_terms(self, query: str) -> list[int]:
+        return list(
+            dict.fromkeys(
+                self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary
+            )
+        )
+
+    def search(
+        self, query: str, k: int, mask: Optional[np.ndarray] = None
+    ) -> list[tuple[int, float]]:
+        """The `k` best matching rows among the masked ones, as (row, BM25 score)."""
+        term_ids = self.query_terms(query)
+        if not term_ids or k <= 0:
+            return []
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        for term in term_ids:
+            start, end = self.offsets[term], self.offsets[term + 1]
+            # A term's postings hold every document at most once
+            scores[self.doc_ids[start:end]] += self.impacts[start:end]
+        if mask is not None:
+            scores[~mask] = 0.0
+        matches = np.flatnonzero(scores)
+        if len(matches) > k:
+            matches = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+        matches = matches[np.argsort(-scores[matches], kind="stable")]
+        return [(int(row), float(scores[row])) for row in matches]
+
+    def caption(self, query: str, text: str, max_chars: int) -> str:
+        """The sentence of `text` with the most query terms, as an extractive caption."""
+        terms = {self.terms[t] for t in self.query_terms(query)}
+        sentences = re.split(r"(?<=[.!?])\s+|\n{2,}", text)
+        best = max(
+            sentences,
+            key=lambda s: len(terms.intersection(tokenize(s))),
+            default="",
+        )
+        return best.strip()[:max_chars]
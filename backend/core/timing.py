@@ -0,0 +1,34 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class StageTimer:
+    """
+    Records the wall-clock duration of named pipeline stages of a single request.
+    Stages may overlap when they run concurrently, so the sum of the stage durations
+    minus the elapsed time is the latency saved by running them in parallel.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    def elapsed(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def summary(self) -> dict[str, float]:
+        elapsed = self.elapsed()
+        return {
+            **self.timings,
+            "total": elapsed,
+            "saved": round(max(sum(self.timings.values()) - elapsed, 0.0), 1),
+        }
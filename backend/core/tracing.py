@@ -0,0 +1,80 @@
+import json
+import logging
+import random
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from opentelemetry import trace
+
+from .timing import StageTimer
+
+tracer = trace.get_tracer("approaches")
+logger = logging.getLogger("approaches")
+
+# Fraction of requests whose payloads (prompts, search results, answers) are attached
+# to their spans, and the maximum serialized size of each payload
+PAYLOAD_SAMPLE_RATE = 0.0
+PAYLOAD_MAX_CHARS = 4096
+
+
+def configure(payload_sample_rate: float, payload_max_chars: int) -> None:
+    global PAYLOAD_SAMPLE_RATE, PAYLOAD_MAX_CHARS
+    PAYLOAD_SAMPLE_RATE = payload_sample_rate
+    PAYLOAD_MAX_CHARS = payload_max_chars
+
+
+class Payload:
+    """Serializes a value to (truncated) JSON only when it is formatted."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __str__(self) -> str:
+        if isinstance(self.value, str):
+            text = self.value
+        else:
+            text = json.dumps(self.value, default=str)
+        if len(text) > PAYLOAD_MAX_CHARS:
+            return text[:PAYLOAD_MAX_CHARS] + f"...[{len(text)} chars]"
+        return text
+
+
+class RequestTrace(StageTimer):
+    """
+    Traces one approach run. Every stage becomes a child span of the current span (the
+    request span created by OpenTelemetryMiddleware), and payloads are attached as span
+    events for a sampled fraction of requests. Payloads are also logged at DEBUG level,
+    and in both cases only serialized if they are actually recorded.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sample_payloads = random.random() < PAYLOAD_SAMPLE_RATE
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        with tracer.start_as_current_span(name):
+            with super().stage(name):
+                yield
+
+    def attribute(self, name: str, value: Any) -> None:
+        span = trace.get_current_span()
+        if span.is_recording():
+            span.set_attribute(f"app.{name}", value)
+
+    def payload(self, name: str, value: Any) -> None:
+        if self.sample_payloads:
+            span = trace.get_current_span()
+            if span.is_recording():
+                span.add_event(name, {"payload": str(Payload(value))})
+        logger.debug("%s: %s", name, Payload(value))
+
+    def summary(self) -> dict[str, float]:
+        timings = super().summary()
+        span = trace.get_current_span()
+        if span.is_recording():
+            for name, value in timings.items():
+                span.set_attribute(f"app.timings.{name}", value)
+        return timings
@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterator, Optional
+
+
+class TTLCache:
+    """
+    A bounded mapping that evicts the least recently used entry when full and drops
+    entries older than `ttl` seconds on access. A `ttl` of None keeps entries until
+    they are evicted.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires and expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl else 0.0
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def items(self) -> Iterator[tuple[Hashable, Any]]:
+        """Iterate over live entries, oldest first, without refreshing their recency."""
+        now = time.monotonic()
+        for key, (expires, value) in list(self._data.items()):
+            if expires and expires < now:
+                del self._data[key]
+            else:
+                yield key, value
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and not (entry[0] and entry[0] < time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,164 @@
+import random
+import re
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+VALIDATION_MODES = ("full", "local", "sampled")
+
+PASS = "pass"
+FIXED = "fixed"
+INCONCLUSIVE = "inconclusive"
+
+CITATION = re.compile(r"\(\((.*?)\)\)")
+# (source: ((url))) -> ((url))
+WRAPPED_CITATION = re.compile(r"\(\s*source:\s*(\(\([^()]*\)\))\s*\)", re.IGNORECASE)
+URL = re.compile(r"https?://[^\s(),]+")
+MARKDOWN_TABLE = re.compile(r"^\s*\|?\s*:?-{3,}:?\s*\|", re.MULTILINE)
+EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+PHONE = re.compile(
+    r"\+\d[\d\s().-]{7,}\d|\(\d{3}\)\s*\d{3}-\d{4}|\b\d{3}[-.]\d{3}[-.]\d{4}\b"
+)
+# Employee names and titles can't be told apart from other capitalized phrases
+# locally, so anything that looks like one goes to the LLM: two or three capitalized
+# words in a row ("Jane Doe", "Mary-Ann O'Neil") or a job title
+PERSON_NAME = re.compile(
+    r"\b[A-Z][a-z]+(?:[-'][A-Z][a-z]+)?(?:\s+[A-Z]\.)?\s+[A-Z][a-z]+(?:[-'][A-Z][a-z]+)?\b"
+)
+JOB_TITLE = re.compile(
+    r"\b(?:CEO|CTO|CFO|COO|CIO|CMO|CHRO|S?VP|EVP|Chief\s+\w+\s+Officer|"
+    r"(?:Vice\s+)?President|Chair(?:man|woman|person)?|(?:Co-?)?[Ff]ounder|"
+    r"Director|Head\s+of|Managing\s+Partner)\b"
+)
+SENTENCE = re.compile(r"[^.!?\n]+")
+THEY = re.compile(r"\b(they|them|their)\b", re.IGNORECASE)
+
+
+class LocalCheck:
+    """The verdict of the local checks, the (possibly fixed) answer and the reasons."""
+
+    def __init__(self, verdict: str, answer: str, reasons: list[str]):
+        self.verdict = verdict
+        self.answer = answer
+        self.reasons = reasons
+
+
+def check_locally(answer: str, source_urls: list[str]) -> LocalCheck:
+    """
+    Applies the deterministic rules of the validation prompt. Citation formatting is
+    fixed in place: "source:" prefixes are dropped and combined citations are split into
+    one ((url)) per source. Anything that needs judgment (a cited URL that isn't one of
+    the sources, a citation without a URL, a Markdown table, contact details, what
+    looks like a person's name or job title, or "they" in a sentence about SoftServe)
+    makes the check inconclusive.
+    """
+    reasons = []
+    fixed = WRAPPED_CITATION.sub(r"\1", answer)
+    sources = set(source_urls)
+
+    def fix_citation(match: re.Match) -> str:
+        inner = match.group(1).strip()
+        urls = URL.findall(inner)
+        if not urls:
+            reasons.append(f"citation without a URL: {match.group(0)}")
+            return match.group(0)
+        for url in urls:
+            if url not in sources:
+                reasons.append(f"cited URL is not a source: {url}")
+        return " ".join(f"(({url}))" for url in urls)
+
+    fixed = CITATION.sub(fix_citation, fixed)
+    if MARKDOWN_TABLE.search(fixed):
+        reasons.append("Markdown table")
+    if EMAIL.search(fixed) or PHONE.search(fixed):
+        reasons.append("contact details")
+    text = CITATION.sub("", fixed)
+    if PERSON_NAME.search(text) or JOB_TITLE.search(text):
+        reasons.append("possible name or title")
+    if any(
+        "softserve" in sentence.lower() and THEY.search(sentence)
+        for sentence in SENTENCE.findall(text)
+    ):
+        reasons.append('"they" about SoftServe')
+
+    if reasons:
+        return LocalCheck(INCONCLUSIVE, fixed, reasons)
+    return LocalCheck(FIXED if fixed != answer else PASS, fixed, reasons)
+
+
+class ResponseValidator:
+    """
+    Validates answers against the response rules in one of three modes:
+    - "full": always asks the LLM validator, as before.
+    - "local": only runs the local checks and returns their (fixed) answer.
+    - "sampled": runs the local checks and asks the LLM only when they are
+      inconclusive, plus for a `sample_rate` fraction of the conclusive ones, to keep
+      measuring how often the LLM would have changed an answer they passed.
+    Keeps per-mode latency and answer change counters.
+    """
+
+    def __init__(self, default_mode: str = "sampled", sample_rate: float = 0.05):
+        if default_mode not in VALIDATION_MODES:
+            raise ValueError(f"Unknown validation mode: {default_mode}")
+        self.default_mode = default_mode
+        self.sample_rate = sample_rate
+        self.counters = {
+            mode: {
+                "requests": 0,
+                "llm_calls": 0,
+                "changed": 0,
+                "local_pass": 0,
+                "local_fixed": 0,
+                "local_inconclusive": 0,
+                "sampled_changed": 0,
+                "latency_ms": 0.0,
+            }
+            for mode in VALIDATION_MODES
+        }
+
+    async def validate(
+        self,
+        answer: str,
+        source_urls: list[str],
+        llm_validate: Callable[[str], Awaitable[str]],
+        mode: Optional[str] = None,
+    ) -> str:
+        mode = mode if mode in VALIDATION_MODES else self.default_mode
+        counters = self.counters[mode]
+        start = time.perf_counter()
+        try:
+            if mode == "full":
+                counters["llm_calls"] += 1
+                validated = await llm_validate(answer)
+            else:
+                check = check_locally(answer, source_urls)
+                counters[f"local_{check.verdict}"] += 1
+                validated = check.answer
+                if mode == "sampled" and (
+                    check.verdict == INCONCLUSIVE
+                    or random.random() < self.sample_rate
+                ):
+                    counters["llm_calls"] += 1
+                    validated = await llm_validate(check.answer)
+                    if check.verdict != INCONCLUSIVE and validated != check.answer:
+                        counters["sampled_changed"] += 1
+        finally:
+            counters["requests"] += 1
+            counters["latency_ms"] += (time.perf_counter() - start) * 1000
+        if validated != answer:
+            counters["changed"] += 1
+        return validated
+
+    def stats(self) -> dict[str, Any]:
+        stats = {}
+        for mode, counters in self.counters.items():
+            requests = counters["requests"]
+            stats[mode] = {
+                **{k: v for k, v in counters.items() if k != "latency_ms"},
+                "avg_latency_ms": round(counters["latency_ms"] / requests, 1)
+                if requests
+                else 0.0,
+                "change_rate": round(counters["changed"] / requests, 4)
+                if requests
+                else 0.0,
+            }
+        return {"default_mode": self.default_mode, "modes": stats}
@@ -0,0 +1,156 @@
+"""
+Indexes the crawled website (data/softserve.json) and the SoftServe Wikipedia page into
+Azure Cognitive Search, replacing the indexing cells of notebooks/Data_preparation.ipynb.
+
+Run from the backend directory, with the same environment as the app:
+    python -m ingestion [--create-index] [--no-wikipedia] [--checkpoint ingestion.ckpt]
+
+OpenAI calls are scheduled against the deployments' quotas (OPENAI_RATE_LIMITS in
+config.py), which a running app shares, giving way to its interactive calls.
+
+Progress is checkpointed after every uploaded batch: if a run fails, run the same
+command again and it resumes where it stopped. Delete the checkpoint file to re-index
+everything. With --fake, the pipeline runs against local fakes of the OpenAI and Search
+clients instead (see ingestion/fakes.py), e.g. to try the retry settings:
+    python -m ingestion --fake --fake-rate-limit 0.1 --fake-crash-after 2
+
+The app can also search a local copy of the index (see LOCAL_SEARCH_INDEX in app.py),
+written with --local-index DIR instead of uploading to Cognitive Search, or copied from
+the Cognitive Search index with --export-local DIR.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+import aiohttp
+import openai
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
+
+from config import (
+    API_VERSION,
+    AZURE_OPENAI_EMB_DEPLOYMENT,
+    AZURE_OPENAI_GPT4_DEPLOYMENT,
+    AZURE_OPENAI_SERVICE,
+    AZURE_SEARCH_INDEX,
+    AZURE_SEARCH_SERVICE,
+    COGNITIVE_SEARCH_API_KEY,
+    OPENAI_API_KEY,
+    OPENAI_API_TYPE,
+    OPENAI_RATE_LIMIT_DIR,
+    OPENAI_RATE_LIMITS,
+    SEARCH_INDEX_GENERATION_PATH,
+)
+from core.ratelimit import OpenAIScheduler, parse_rate_limits
+from core.searchcache import bump_generation
+from ingestion.fakes import FakeOpenAI, FakeSearchClient
+from ingestion.index import ensure_index
+from ingestion.localindex import LocalIndexWriter, export_index
+from ingestion.pipeline import Checkpoint, IngestionPipeline, RetryPolicy
+from ingestion.sources import load_website, load_wikipedia
+
+DEFAULT_WEBSITE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "data", "softserve.json"
+)
+
+
+async def main(args: argparse.Namespace) -> None:
+    credential = AzureKeyCredential(COGNITIVE_SEARCH_API_KEY)
+    endpoint = f"https://{AZURE_SEARCH_SERVICE}.search.windows.net"
+    if args.export_local:
+        async with SearchClient(endpoint, AZURE_SEARCH_INDEX, credential) as search_client:
+            count = await export_index(search_client, args.export_local)
+        logging.info("Exported %d documents to %s", count, args.export_local)
+        bump_generation(SEARCH_INDEX_GENERATION_PATH)
+        return
+
+    sections = load_website(args.website)
+    if args.wikipedia:
+        sections += load_wikipedia()
+    logging.info("Loaded %d sections", len(sections))
+
+    # Each target has its own checkpoint, so a local or fake run doesn't mark sections
+    # as indexed in Cognitive Search
+    if args.local_index:
+        search_client = LocalIndexWriter(args.local_index)
+        checkpoint = args.checkpoint or f"{args.local_index}.ckpt"
+    elif args.fake:
+        search_client = FakeSearchClient(
+            args.fake_output, crash_after=args.fake_crash_after
+        )
+        checkpoint = args.checkpoint or "ingestion-fake.ckpt"
+    else:
+        checkpoint = args.checkpoint or "ingestion.ckpt"
+        if args.create_index:
+            async with SearchIndexClient(endpoint, credential) as index_client:
+                if await ensure_index(index_client, AZURE_SEARCH_INDEX):
+                    logging.info("Created the %s index", AZURE_SEARCH_INDEX)
+        search_client = SearchClient(endpoint, AZURE_SEARCH_INDEX, credential)
+    if args.fake:
+        openai_client = FakeOpenAI(rate_limit_rate=args.fake_rate_limit)
+        scheduler = OpenAIScheduler(
+            max_retries=args.max_retries, openai_client=openai_client
+        )
+        session = None
+    else:
+        openai_client = openai
+        openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+        openai.api_version = API_VERSION
+        openai.api_type = OPENAI_API_TYPE
+        openai.api_key = OPENAI_API_KEY
+        session = aiohttp.ClientSession()
+        openai.aiosession.set(session)
+        # Shares the app's quotas, behind its interactive calls
+        scheduler = OpenAIScheduler(
+            parse_rate_limits(OPENAI_RATE_LIMITS),
+            shared_dir=OPENAI_RATE_LIMIT_DIR or None,
+            max_retries=args.max_retries,
+        )
+
+    pipeline = IngestionPipeline(
+        search_client,
+        AZURE_OPENAI_GPT4_DEPLOYMENT,
+        AZURE_OPENAI_EMB_DEPLOYMENT,
+        Checkpoint(checkpoint),
+        openai_client=openai_client,
+        summary_workers=args.summary_workers,
+        embedding_batch_size=args.embedding_batch_size,
+        upload_batch_size=args.upload_batch_size,
+        retry_policy=RetryPolicy(max_retries=args.max_retries),
+        scheduler=scheduler,
+    )
+    try:
+        stats = await pipeline.run(sections)
+    finally:
+        await search_client.close()
+        if session is not None:
+            await session.close()
+        # Even a failed run may have changed the index
+        if pipeline.counts["uploaded"] and not args.fake:
+            bump_generation(SEARCH_INDEX_GENERATION_PATH)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index the workshop data into Azure Cognitive Search"
+    )
+    parser.add_argument("--website", default=DEFAULT_WEBSITE_PATH, help="Crawled website JSON file")
+    parser.add_argument("--no-wikipedia", dest="wikipedia", action="store_false", help="Don't index the Wikipedia page")
+    parser.add_argument("--checkpoint", default="", help="File the indexed sections are recorded in (default: ingestion.ckpt)")
+    parser.add_argument("--create-index", action="store_true", help="Create the index if it doesn't exist")
+    parser.add_argument("--summary-workers", type=int, default=8, help="Concurrent summary requests")
+    parser.add_argument("--embedding-batch-size", type=int, default=16, help="Texts per embedding request")
+    parser.add_argument("--upload-batch-size", type=int, default=100, help="Documents per upload")
+    parser.add_argument("--max-retries", type=int, default=6, help="Retries of a rate limited or failed request")
+    parser.add_argument("--local-index", default="", help="Index into a local index directory instead of Cognitive Search")
+    parser.add_argument("--export-local", default="", help="Copy the Cognitive Search index into a local index directory and exit")
+    parser.add_argument("--fake", action="store_true", help="Use local fakes of the OpenAI and Search clients")
+    parser.add_argument("--fake-output", default="", help="JSONL file the fake index writes documents to")
+    parser.add_argument("--fake-rate-limit", type=float, default=0.0, help="Fraction of fake OpenAI calls rate limited")
+    parser.add_argument("--fake-crash-after", type=int, default=None, help="Fail after this many fake uploads")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,132 @@
+"""
+Local stand-ins for the Azure OpenAI and Cognitive Search clients, so the ingestion
+pipeline can be run end to end without the services (python -m ingestion --fake).
+They simulate latency, and can inject rate limits and failures to exercise the retries
+and the checkpoint.
+"""
+import asyncio
+import hashlib
+import json
+import random
+from typing import Any, Optional
+
+import numpy as np
+import openai
+
+from .localindex import UploadResult
+
+
+class FakeOpenAI:
+    """
+    Has the ChatCompletion and Embedding `acreate` methods the pipeline uses. Summaries
+    are the first sentence of the text, and embeddings are deterministic pseudo-random
+    unit vectors seeded by the text. A `rate_limit_rate` fraction of the calls fails
+    with a 429 and a Retry-After of `retry_after` seconds.
+    """
+
+    def __init__(
+        self,
+        dimensions: int = 1536,
+        latency: float = 0.05,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 0.1,
+        max_inputs: int = 16,
+    ):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.max_inputs = max_inputs
+        self.calls = {"chat": 0, "embedding": 0, "rate_limited": 0}
+        self.ChatCompletion = FakeMethod(self.chat_completion)
+        self.Embedding = FakeMethod(self.embedding)
+
+    async def call(self, kind: str) -> None:
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        self.calls[kind] += 1
+        if random.random() < self.rate_limit_rate:
+            self.calls["rate_limited"] += 1
+            raise openai.error.RateLimitError(
+                "Requests to the deployment have exceeded the rate limit",
+                http_status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+    async def chat_completion(self, messages: list[dict[str, str]], **kwargs) -> dict:
+        await self.call("chat")
+        text = messages[-1]["content"].split('"', 1)[-1].rsplit('"', 1)[0].strip()
+        summary = text.split(". ", 1)[0][:200]
+        return {"choices": [{"message": {"role": "assistant", "content": summary}}]}
+
+    async def embedding(self, input: list[str], **kwargs) -> dict:
+        if len(input) > self.max_inputs:
+            raise openai.error.InvalidRequestError(
+                f"Too many inputs. The max number of inputs is {self.max_inputs}.",
+                param=None,
+                http_status=400,
+            )
+        await self.call("embedding")
+        return {
+            "data": [
+                {"index": i, "embedding": self.vector(text)}
+                for i, text in enumerate(input)
+            ]
+        }
+
+    def vector(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha1(text.encode()).digest()[:4], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+        return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+
+class FakeMethod:
+    def __init__(self, acreate):
+        self.acreate = acreate
+
+
+class FakeSearchClient:
+    """
+    Keeps uploaded documents in memory, and writes them to `path` as JSON lines if
+    given. A `throttle_rate` fraction of the documents is rejected with a 503, and
+    `crash_after` uploads, the next one raises, to simulate an interrupted run.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        latency: float = 0.1,
+        throttle_rate: float = 0.0,
+        crash_after: Optional[int] = None,
+    ):
+        self.path = path
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.crash_after = crash_after
+        self.documents: dict[str, dict[str, Any]] = {}
+        self.uploads = 0
+
+    async def upload_documents(
+        self, documents: list[dict[str, Any]]
+    ) -> list[UploadResult]:
+        await asyncio.sleep(self.latency)
+        if self.crash_after is not None and self.uploads >= self.crash_after:
+            raise RuntimeError("Simulated crash")
+        self.uploads += 1
+        results = []
+        for doc in documents:
+            if random.random() < self.throttle_rate:
+                results.append(
+                    UploadResult(doc["Id"], False, 503, "Simulated throttling")
+                )
+                continue
+            self.documents[doc["Id"]] = doc
+            results.append(UploadResult(doc["Id"], True, 201))
+        if self.path:
+            with open(self.path, "a") as f:
+                for doc, result in zip(documents, results):
+                    if result.succeeded:
+                        f.write(json.dumps(doc) + "\n")
+        return results
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,96 @@
+from azure.search.documents.indexes.aio import SearchIndexClient
+from azure.search.documents.indexes.models import (
+    HnswVectorSearchAlgorithmConfiguration,
+    PrioritizedFields,
+    SearchableField,
+    SearchField,
+    SearchFieldDataType,
+    SearchIndex,
+    SemanticConfiguration,
+    SemanticField,
+    SemanticSettings,
+    SimpleField,
+    VectorSearch,
+)
+
+EMBEDDING_DIMENSIONS = 1536
+EMBEDDING_FIELDS = ["content_embedding", "title_embedding", "summary_embedding"]
+
+
+def build_index(name: str) -> SearchIndex:
+    """The index schema the app queries, as created by the data preparation notebook."""
+    return SearchIndex(
+        name=name,
+        fields=[
+            # Filterable for the lookups by key of HybridRetriever.fetch_embeddings. An index
+            # created before has to be re-created (deleted, then --create-index) for it
+            SimpleField(name="Id", type="Edm.String", key=True, filterable=True),
+            SearchableField(
+                name="Content", type="Edm.String", analyzer_name="en.microsoft"
+            ),
+            SearchableField(
+                name="FileName", type="Edm.String", analyzer_name="en.microsoft"
+            ),
+            SearchableField(
+                name="Summary", type="Edm.String", analyzer_name="en.microsoft"
+            ),
+            *[
+                SearchField(
+                    name=field,
+                    type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                    hidden=False,
+                    searchable=True,
+                    filterable=False,
+                    sortable=False,
+                    facetable=False,
+                    vector_search_dimensions=EMBEDDING_DIMENSIONS,
+                    vector_search_configuration="default",
+                )
+                for field in EMBEDDING_FIELDS
+            ],
+            SimpleField(
+                name="Published",
+                type=SearchFieldDataType.DateTimeOffset,
+                facetable=True,
+                filterable=True,
+                sortable=True,
+            ),
+            *[
+                SimpleField(
+                    name=field, type="Edm.String", filterable=True, facetable=True
+                )
+                for field in ["FileType", "Category", "LocationURL", "Storage"]
+            ],
+        ],
+        semantic_settings=SemanticSettings(
+            configurations=[
+                SemanticConfiguration(
+                    name="default",
+                    prioritized_fields=PrioritizedFields(
+                        title_field=SemanticField(field_name="FileName"),
+                        prioritized_content_fields=[
+                            SemanticField(field_name="FileName"),
+                            SemanticField(field_name="Content"),
+                            SemanticField(field_name="Summary"),
+                        ],
+                    ),
+                )
+            ]
+        ),
+        vector_search=VectorSearch(
+            algorithm_configurations=[
+                HnswVectorSearchAlgorithmConfiguration(
+                    name="default", kind="hnsw", parameters={"metric": "cosine"}
+                )
+            ]
+        ),
+    )
+
+
+async def ensure_index(index_client: SearchIndexClient, name: str) -> bool:
+    """Creates the index if it doesn't exist yet, and returns whether it did."""
+    async for existing in index_client.list_index_names():
+        if existing == name:
+            return False
+    await index_client.create_index(build_index(name))
+    return True
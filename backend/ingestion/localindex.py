@@ -0,0 +1,78 @@
+import json
+import os
+from typing import Any, Optional
+
+from azure.search.documents.aio import SearchClient
+
+from core.localsearch import LocalIndex
+
+from .index import EMBEDDING_FIELDS
+
+
+class UploadResult:
+    """The fields of the SDK's IndexingResult that the pipeline reads."""
+
+    def __init__(
+        self,
+        key: str,
+        succeeded: bool,
+        status_code: int,
+        error_message: Optional[str] = None,
+    ):
+        self.key = key
+        self.succeeded = succeeded
+        self.status_code = status_code
+        self.error_message = error_message
+
+
+class LocalIndexWriter:
+    """
+    Takes the place of the SearchClient when the pipeline indexes into a LocalIndex at
+    `path`. Uploaded documents are appended to `{path}.spool.jsonl` and flushed with
+    every batch, like the checkpoint, so a resumed run still has the documents of the
+    crashed one. `close` writes the LocalIndex from the spool.
+    """
+
+    def __init__(self, path: str, vector_fields: list[str] = EMBEDDING_FIELDS):
+        self.path = path
+        self.spool_path = f"{path}.spool.jsonl"
+        self.vector_fields = vector_fields
+
+    async def upload_documents(
+        self, documents: list[dict[str, Any]]
+    ) -> list[UploadResult]:
+        with open(self.spool_path, "a") as f:
+            for doc in documents:
+                f.write(json.dumps(doc) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return [UploadResult(doc["Id"], True, 201) for doc in documents]
+
+    async def close(self) -> None:
+        documents: dict[str, dict[str, Any]] = {}
+        if os.path.exists(self.spool_path):
+            with open(self.spool_path) as f:
+                for line in f:
+                    try:
+                        doc = json.loads(line)
+                    except ValueError:
+                        continue
+                    # Later uploads of a document replace earlier ones
+                    documents[doc["Id"]] = doc
+        if documents:
+            LocalIndex.save(self.path, list(documents.values()), self.vector_fields)
+
+
+async def export_index(
+    search_client: SearchClient,
+    path: str,
+    vector_fields: list[str] = EMBEDDING_FIELDS,
+) -> int:
+    """Copies all the documents of a Cognitive Search index into a LocalIndex at `path`."""
+    r = await search_client.search("*", include_total_count=True)
+    documents = [
+        {k: v for k, v in doc.items() if not k.startswith("@search.")}
+        async for doc in r
+    ]
+    LocalIndex.save(path, documents, vector_fields)
+    return len(documents)
@@ -0,0 +1,366 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+import openai
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+from azure.search.documents.aio import SearchClient
+
+from core.ratelimit import OpenAIScheduler, Priority, retry_after, status_code
+
+from .sources import Section
+
+T = TypeVar("T")
+
+# The prompt of langchain's "stuff" summarize chain, which the notebook used
+SUMMARY_PROMPT = (
+    'Write a concise summary of the following:\n\n\n"{text}"\n\n\nCONCISE SUMMARY:'
+)
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    ServiceRequestError,
+    ServiceResponseError,
+)
+
+
+class RetryPolicy:
+    """
+    Retries transient failures (rate limits, timeouts, connection errors and 5xx
+    responses) with exponential backoff and full jitter, waiting for the Retry-After
+    the service sends instead when there is one. A rate limit pauses every caller
+    sharing the policy until the Retry-After has passed, so a worker pool backs off
+    together instead of each worker hitting the limit in turn.
+
+    OpenAI rate limits are left to the OpenAIScheduler, which already retried them
+    and paused the deployment's shared budget, so they are raised as they are.
+    """
+
+    def __init__(
+        self, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def call(self, fn: Callable[[], Awaitable[T]]) -> T:
+        attempt = 0
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            try:
+                return await fn()
+            except Exception as e:
+                status = status_code(e)
+                transient = (
+                    isinstance(e, RETRYABLE_ERRORS) or status in RETRYABLE_STATUS
+                ) and not isinstance(e, openai.error.RateLimitError)
+                if not transient or attempt >= self.max_retries:
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if status == 429:
+                    self.rate_limited += 1
+                    self.paused_until = max(
+                        self.paused_until, time.monotonic() + delay
+                    )
+                attempt += 1
+                self.retries += 1
+                logging.warning(
+                    "Retrying in %.1f s (attempt %d) after %r", delay, attempt, e
+                )
+                await asyncio.sleep(delay)
+
+
+class Checkpoint:
+    """
+    Append-only record of the sections the index accepted, one JSON line with the Id
+    and the source hash per section. Sections whose source didn't change since they
+    were recorded are skipped, so a crashed run resumes where it stopped. Every batch
+    is flushed to disk before the next one is uploaded, and a line cut short by a
+    crash is ignored.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.hashes: dict[str, str] = {}
+        self.ends_with_newline = True
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    self.ends_with_newline = line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.hashes[entry["id"]] = entry["hash"]
+
+    def done(self, section: Section) -> bool:
+        return self.hashes.get(section.id) == section.hash
+
+    def record(self, sections: list[Section]) -> None:
+        for section in sections:
+            self.hashes[section.id] = section.hash
+        if not self.path or not sections:
+            return
+        with open(self.path, "a") as f:
+            if not self.ends_with_newline:
+                f.write("\n")
+                self.ends_with_newline = True
+            for section in sections:
+                f.write(json.dumps({"id": section.id, "hash": section.hash}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class IngestionPipeline:
+    """
+    Summarizes, embeds and indexes sections. Summaries, the slow part, are written by a
+    pool of `summary_workers` concurrent workers, and summarized sections stream into a
+    single indexer that embeds their content, summary and title `embedding_batch_size`
+    texts per request (titles shared by sections are embedded once) and uploads
+    `upload_batch_size` documents at a time, with the next batch embedded while the
+    previous one uploads. All service calls go through the same RetryPolicy, and the
+    OpenAI calls are scheduled at the ingestion priority, behind interactive ones when
+    the scheduler shares the app's budgets (see OpenAIScheduler), which also retries
+    their rate limits.
+
+    `openai_client` is the openai module, or anything with the same ChatCompletion and
+    Embedding `acreate` methods (see ingestion/fakes.py), for a scheduler without
+    limits when no `scheduler` is given.
+    """
+
+    def __init__(
+        self,
+        search_client: SearchClient,
+        summary_deployment: str,
+        embedding_deployment: str,
+        checkpoint: Checkpoint,
+        openai_client: Any = openai,
+        summary_workers: int = 8,
+        embedding_batch_size: int = 16,
+        upload_batch_size: int = 100,
+        retry_policy: Optional[RetryPolicy] = None,
+        scheduler: Optional[OpenAIScheduler] = None,
+    ):
+        self.search_client = search_client
+        self.summary_deployment = summary_deployment
+        self.embedding_deployment = embedding_deployment
+        self.checkpoint = checkpoint
+        self.summary_workers = summary_workers
+        self.embedding_batch_size = embedding_batch_size
+        self.upload_batch_size = upload_batch_size
+        self.retry = retry_policy or RetryPolicy()
+        self.scheduler = scheduler or OpenAIScheduler(openai_client=openai_client)
+        self.title_embeddings: dict[str, list[float]] = {}
+        self.counts = {
+            "sections": 0,
+            "skipped": 0,
+            "summaries": 0,
+            "summary_errors": 0,
+            "embedding_requests": 0,
+            "embedded_texts": 0,
+            "uploaded": 0,
+            "upload_failed": 0,
+        }
+
+    async def run(self, sections: list[Section]) -> dict[str, Any]:
+        start = time.perf_counter()
+        pending = [s for s in sections if not self.checkpoint.done(s)]
+        self.counts["sections"] += len(sections)
+        self.counts["skipped"] += len(sections) - len(pending)
+        unsummarized: asyncio.Queue = asyncio.Queue()
+        for section in pending:
+            unsummarized.put_nowait(section)
+        summarized: asyncio.Queue = asyncio.Queue()
+
+        workers = [
+            asyncio.ensure_future(self.summarize_worker(unsummarized, summarized))
+            for _ in range(min(self.summary_workers, len(pending)))
+        ]
+        summaries = asyncio.gather(*workers)
+        indexer = asyncio.ensure_future(self.index(summarized))
+        try:
+            await asyncio.wait(
+                [summaries, indexer], return_when=asyncio.FIRST_COMPLETED
+            )
+            if indexer.done():
+                # The indexer only returns after the end marker, so it failed
+                await indexer
+            # A failed summary stops the other workers, but what was summarized
+            # before it is still indexed and checkpointed
+            for worker in workers:
+                worker.cancel()
+            summarized.put_nowait(None)
+            await indexer
+            await summaries
+        finally:
+            for worker in workers:
+                worker.cancel()
+            indexer.cancel()
+            await asyncio.gather(summaries, indexer, return_exceptions=True)
+        return self.stats(time.perf_counter() - start)
+
+    async def summarize_worker(
+        self, unsummarized: asyncio.Queue, summarized: asyncio.Queue
+    ) -> None:
+        while not unsummarized.empty():
+            section = unsummarized.get_nowait()
+            section.fields["Summary"] = await self.summarize(section.content)
+            summarized.put_nowait(section)
+
+    async def summarize(self, content: str) -> str:
+        try:
+            completion = await self.retry.call(
+                lambda: self.scheduler.chat_completion(
+                    Priority.INGESTION,
+                    deployment_id=self.summary_deployment,
+                    messages=[
+                        {"role": "user", "content": SUMMARY_PROMPT.format(text=content)}
+                    ],
+                    temperature=0.0,
+                    n=1,
+                )
+            )
+        except openai.error.InvalidRequestError as e:
+            # e.g. the content filter, the section is indexed without a summary
+            logging.warning("Failed to summarize a section: %s", e)
+            self.counts["summary_errors"] += 1
+            return ""
+        self.counts["summaries"] += 1
+        return completion["choices"][0]["message"]["content"]
+
+    async def index(self, summarized: asyncio.Queue) -> None:
+        batch: list[Section] = []
+        embedded: list[Section] = []
+        upload: Optional[asyncio.Future] = None
+        try:
+            while True:
+                section = await summarized.get()
+                finished = section is None
+                if not finished:
+                    batch.append(section)
+                if batch and (
+                    finished or self.texts_to_embed(batch) >= self.embedding_batch_size
+                ):
+                    embedded.extend(await self.embed(batch))
+                    batch = []
+                while embedded and (
+                    finished or len(embedded) >= self.upload_batch_size
+                ):
+                    if upload is not None:
+                        await upload
+                    upload = asyncio.ensure_future(
+                        self.upload(embedded[: self.upload_batch_size])
+                    )
+                    embedded = embedded[self.upload_batch_size :]
+                if finished:
+                    break
+        finally:
+            if upload is not None:
+                await upload
+
+    def texts_to_embed(self, sections: list[Section]) -> int:
+        titles = {s.title for s in sections} - self.title_embeddings.keys()
+        return len(titles) + sum(1 + bool(s.fields["Summary"]) for s in sections)
+
+    async def embed(self, sections: list[Section]) -> list[Section]:
+        titles = [
+            title
+            for title in dict.fromkeys(s.title for s in sections)
+            if title not in self.title_embeddings
+        ]
+        texts = list(titles)
+        for section in sections:
+            texts.append(section.content)
+            if section.fields["Summary"]:
+                texts.append(section.fields["Summary"])
+        requests = [
+            texts[i : i + self.embedding_batch_size]
+            for i in range(0, len(texts), self.embedding_batch_size)
+        ]
+        vectors = {}
+        for inputs, response in zip(
+            requests, await asyncio.gather(*[self.embed_texts(r) for r in requests])
+        ):
+            for item in response["data"]:
+                vectors[inputs[item["index"]]] = item["embedding"]
+
+        for title in titles:
+            self.title_embeddings[title] = vectors[title]
+        for section in sections:
+            section.fields["title_embedding"] = self.title_embeddings[section.title]
+            section.fields["content_embedding"] = vectors[section.content]
+            if section.fields["Summary"]:
+                section.fields["summary_embedding"] = vectors[
+                    section.fields["Summary"]
+                ]
+        return sections
+
+    async def embed_texts(self, texts: list[str]) -> dict[str, Any]:
+        self.counts["embedding_requests"] += 1
+        self.counts["embedded_texts"] += len(texts)
+        return await self.retry.call(
+            lambda: self.scheduler.embedding(
+                Priority.INGESTION, engine=self.embedding_deployment, input=texts
+            )
+        )
+
+    async def upload(self, sections: list[Section]) -> None:
+        """Uploads the sections, retrying the documents the index rejected with a transient status."""
+        by_id = {s.id: s for s in sections}
+        pending = list(by_id)
+        attempt = 0
+        while pending:
+            results = await self.retry.call(
+                lambda: self.search_client.upload_documents(
+                    documents=[by_id[id].fields for id in pending]
+                )
+            )
+            self.checkpoint.record([by_id[r.key] for r in results if r.succeeded])
+            self.counts["uploaded"] += sum(1 for r in results if r.succeeded)
+            retryable = [
+                r.key
+                for r in results
+                if not r.succeeded and r.status_code in RETRYABLE_STATUS
+            ]
+            for r in results:
+                if not r.succeeded and (
+                    r.key not in retryable or attempt >= self.retry.max_retries
+                ):
+                    logging.error("Failed to index %s: %s", r.key, r.error_message)
+                    self.counts["upload_failed"] += 1
+            if not retryable or attempt >= self.retry.max_retries:
+                break
+            pending = retryable
+            await asyncio.sleep(self.retry.backoff(attempt))
+            attempt += 1
+        logging.info(
+            "Indexed %d sections, %d in total", len(sections), self.counts["uploaded"]
+        )
+
+    def stats(self, seconds: float) -> dict[str, Any]:
+        return {
+            **self.counts,
+            "retries": self.retry.retries,
+            "rate_limited": self.retry.rate_limited,
+            "openai": self.scheduler.stats(),
+            "seconds": round(seconds, 1),
+        }
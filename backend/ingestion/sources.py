@@ -0,0 +1,96 @@
+import hashlib
+import json
+from typing import Any, Optional
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+try:
+    import wikipedia
+    from bs4 import BeautifulSoup
+except ImportError:  # only needed for load_wikipedia
+    wikipedia = None
+    BeautifulSoup = None
+
+WIKIPEDIA_URL = "https://en.wikipedia.org/wiki/SoftServe"
+
+
+class Section:
+    """
+    One chunk to index: its index fields, without the summary and the embeddings, and
+    the text its title embedding is computed from. `hash` identifies the chunk's
+    source, so a checkpointed chunk is indexed again if its source changed.
+    """
+
+    def __init__(self, fields: dict[str, Any], title: str):
+        self.fields = fields
+        self.title = title
+        self.hash = hashlib.sha1(
+            json.dumps([title, fields], sort_keys=True).encode()
+        ).hexdigest()
+
+    @property
+    def id(self) -> str:
+        return self.fields["Id"]
+
+    @property
+    def content(self) -> str:
+        return self.fields["Content"]
+
+
+def load_website(
+    path: str, chunk_size: int = 2000, chunk_overlap: int = 0
+) -> list[Section]:
+    """Splits the crawled website documents (data/softserve.json) into sections."""
+    with open(path) as f:
+        documents = json.load(f)
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    sections = []
+    for doc in documents:
+        for i, content in enumerate(splitter.split_text(doc["content"])):
+            fields = {
+                "Id": f"{doc['id']}-page-{i}",
+                "Content": content,
+                "LocationURL": doc["LocationURL"],
+                "Published": doc["Published"],
+                "FileName": doc["FileName"],
+                "FileType": doc["FileType"],
+                "Category": doc["Category"],
+                "Storage": doc["Storage"],
+            }
+            sections.append(Section(fields, doc["FileName"]))
+    return sections
+
+
+def load_wikipedia(
+    page: str = "SoftServe company",
+    chunk_size: int = 1000,
+    chunk_overlap: int = 700,
+    html: Optional[str] = None,
+) -> list[Section]:
+    """Splits the text of the SoftServe Wikipedia page (or of the given `html`) into sections."""
+    if BeautifulSoup is None:
+        raise ValueError(
+            "load_wikipedia requires the wikipedia and beautifulsoup4 packages"
+        )
+    if html is None:
+        html = wikipedia.page(page).html()
+    text = BeautifulSoup(html, "html.parser").get_text()
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    return [
+        Section(
+            {
+                "Id": f"Wiki-page-{i}",
+                "Content": content,
+                "LocationURL": WIKIPEDIA_URL,
+                "FileType": ".html",
+                "Storage": "Wikipedia",
+                "FileName": "Wikipedia",
+            },
+            "About SoftServe",
+        )
+        for i, content in enumerate(splitter.split_text(text))
+    ]
@@ -1,4 +1,9 @@
 import csv
+import difflib
+import os
+import sys
+import threading
+from bisect import bisect_left
 from pathlib import Path
 from typing import Union
 
@@ -6,17 +11,114 @@ from langchain.agents import Tool
 from langchain.callbacks.manager import Callbacks
 
 
+class CsvTable:
+    """
+    An immutable, indexed snapshot of a CSV file. Values are stored column by column as interned
+    strings, so repeated values are kept once, and rows are found through a case-insensitive key
+    index and a sorted list of keys for prefix and fuzzy matching.
+    """
+
+    def __init__(self, filename: str, key_field: str):
+        self.mtime = os.stat(filename).st_mtime_ns
+        with open(filename, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            self.fields = tuple(sys.intern(f) for f in next(reader, []))
+            key_column = self.fields.index(key_field)
+            self.columns: list[list[str]] = [[] for _ in self.fields]
+            self.index: dict[str, int] = {}
+            for values in reader:
+                if not values:
+                    continue
+                # Like DictReader, short rows are padded with "" and extra values dropped,
+                # so every column keeps one value per row
+                values = (values + [""] * len(self.fields))[:len(self.fields)]
+                row = len(self.columns[0])
+                for column, value in zip(self.columns, values):
+                    column.append(sys.intern(value))
+                # Keep the first row for duplicate keys
+                self.index.setdefault(self.normalize(values[key_column]), row)
+        self.keys = sorted(self.index)
+
+    @staticmethod
+    def normalize(key: str) -> str:
+        return " ".join(key.split()).casefold()
+
+    def format_row(self, row: int) -> str:
+        return "\n".join([f"{field}:{column[row]}" for field, column in zip(self.fields, self.columns)])
+
+    def find(self, key: str, max_matches: int = 5) -> list[int]:
+        """
+        Returns the rows for an exact (case-insensitive) key match, otherwise for the keys starting
+        with `key`, otherwise for the closest fuzzy matches.
+        """
+        key = self.normalize(key)
+        if not key:
+            return []
+        row = self.index.get(key)
+        if row is not None:
+            return [row]
+        matches = []
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i].startswith(key) and len(matches) < max_matches:
+            matches.append(self.keys[i])
+            i += 1
+        if not matches:
+            matches = difflib.get_close_matches(key, self.keys, n=max_matches, cutoff=0.8)
+        return [self.index[k] for k in matches]
+
+    def lookup(self, key: str) -> str:
+        return "\n\n".join(self.format_row(row) for row in self.find(key))
+
+
+class CsvTables:
+    """
+    Loads each CSV file once per process and shares it between all lookup tools. A table is
+    reloaded when its file's mtime changes; the new snapshot replaces the old one in a single
+    assignment, so concurrent lookups always see a complete table.
+    """
+
+    def __init__(self):
+        self.tables: dict[tuple[str, str], CsvTable] = {}
+        self.lock = threading.Lock()
+
+    def get(self, filename: str, key_field: str) -> CsvTable:
+        key = (filename, key_field)
+        table = self.tables.get(key)
+        if table is not None and not self.changed(table, filename):
+            return table
+        with self.lock:
+            # Another thread may have loaded it while we waited
+            table = self.tables.get(key)
+            if table is None or self.changed(table, filename):
+                table = self.tables[key] = CsvTable(filename, key_field)
+            return table
+
+    def changed(self, table: CsvTable, filename: str) -> bool:
+        try:
+            return table.mtime != os.stat(filename).st_mtime_ns
+        except FileNotFoundError:
+            # Keep serving the last snapshot while the file is being replaced
+            return False
+
+
+csv_tables = CsvTables()
+
+
 class CsvLookupTool(Tool):
-    data: dict[str, str] = {}
+    filename: str = ""
+    key_field: str = ""
 
     def __init__(self, filename: Union[str, Path], key_field: str, name: str = "lookup",
                  description: str = "useful to look up details given an input key as opposite to searching data with an unstructured question",
                  callbacks: Callbacks = None):
         super().__init__(name, self.lookup, description, callbacks=callbacks)
-        with open(filename, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.data[row[key_field]] =  "\n".join([f"{i}:{row[i]}" for i in row])
+        self.filename = os.path.abspath(filename)
+        self.key_field = key_field
+        # Load eagerly so a missing or malformed file fails when the tool is built
+        self.table()
+
+    def table(self) -> CsvTable:
+        return csv_tables.get(self.filename, self.key_field)
 
     def lookup(self, key: str) -> str:
-        return self.data.get(key, "")
+        return self.table().lookup(key)
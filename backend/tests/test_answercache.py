@@ -0,0 +1,158 @@
+import asyncio
+
+import numpy as np
+
+from approaches.approach import AskApproach, ChatApproach
+from approaches.cachedapproach import CachedAskApproach, CachedChatApproach
+from core.answercache import AnswerCache, InMemoryCacheBackend, normalize_question
+
+
+def unit(angle):
+    """A 2-d unit vector; two of them have a cosine similarity of cos(a - b)."""
+    return np.array([np.cos(angle), np.sin(angle)], dtype=np.float32)
+
+
+def make_cache(**kwargs):
+    return AnswerCache(InMemoryCacheBackend(), **kwargs)
+
+
+class CountingAskApproach(AskApproach):
+    def __init__(self):
+        self.runs = 0
+
+    async def run(self, q, overrides):
+        self.runs += 1
+        return {"answer": f"{q} ({self.runs})"}
+
+
+class CountingChatApproach(ChatApproach):
+    def __init__(self):
+        self.runs = 0
+
+    async def run(self, history, overrides):
+        self.runs += 1
+        return {"answer": f"{history[-1]['user']} ({self.runs})"}
+
+
+def test_normalize_question():
+    assert normalize_question("  What is   the deductible? ") == "what is the deductible"
+    assert normalize_question("Deductible!") == "deductible"
+
+
+def test_exact_keys():
+    overrides = {"top": 3}
+    key = AnswerCache.make_ask_key("rtr", "What is the deductible?", overrides)
+    assert key == AnswerCache.make_ask_key("rtr", "what is the deductible", overrides)
+    assert key != AnswerCache.make_ask_key("rrr", "what is the deductible", overrides)
+    assert key != AnswerCache.make_ask_key("rtr", "what is the deductible", {"top": 5})
+    history = [{"user": "Hi", "bot": "Hello"}, {"user": "Deductible?"}]
+    assert AnswerCache.make_chat_key("rrr", history, {}) != AnswerCache.make_chat_key(
+        "rrr", history[1:], {}
+    )
+
+
+def test_exact_hits_and_stats():
+    async def main():
+        cache = make_cache()
+        assert await cache.get("key") is None
+        await cache.set("key", {"answer": "a"})
+        return await cache.get("key"), cache.stats()
+
+    value, stats = asyncio.run(main())
+    assert value == {"answer": "a"}
+    assert stats["lookups"] == 2
+    assert stats["exact_hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
+
+
+def test_rephrased_question_hits():
+    async def main():
+        cache = make_cache()
+        scope = AnswerCache.make_scope("rtr", {})
+        await cache.set_similar(scope, unit(0.0), {"answer": "a"})
+        # cos(0.1) = 0.995
+        return await cache.get_similar(scope, unit(0.1)), cache.stats()
+
+    value, stats = asyncio.run(main())
+    assert value == {"answer": "a"}
+    assert stats["semantic_hits"] == 1
+    assert stats["semantic_entries"] == 1
+
+
+def test_related_question_does_not_hit():
+    # Like "deductible for employee" and "deductible for family": close, but about
+    # something else. cos(0.28) = 0.961
+    async def main():
+        cache = make_cache()
+        scope = AnswerCache.make_scope("rtr", {})
+        await cache.set_similar(scope, unit(0.0), {"answer": "employee"})
+        return await cache.get_similar(scope, unit(0.28)), cache.stats()
+
+    value, stats = asyncio.run(main())
+    assert value is None
+    assert stats["semantic_hits"] == 0
+
+
+def test_similarity_threshold_is_configurable():
+    async def main():
+        cache = make_cache(similarity_threshold=0.9)
+        scope = AnswerCache.make_scope("rtr", {})
+        await cache.set_similar(scope, unit(0.0), {"answer": "a"})
+        return await cache.get_similar(scope, unit(0.28))
+
+    assert asyncio.run(main()) == {"answer": "a"}
+
+
+def test_matches_are_scoped_to_approach_and_overrides():
+    async def main():
+        cache = make_cache()
+        await cache.set_similar(
+            AnswerCache.make_scope("rtr", {"top": 3}), unit(0.0), {"answer": "a"}
+        )
+        return [
+            await cache.get_similar(AnswerCache.make_scope(approach, overrides), unit(0.0))
+            for approach, overrides in [
+                ("rtr", {"top": 3}),
+                ("rtr", {"top": 5}),
+                ("chat", {"top": 3}),
+            ]
+        ]
+
+    assert asyncio.run(main()) == [{"answer": "a"}, None, None]
+
+
+def test_expired_answer_drops_its_vector():
+    async def main():
+        backend = InMemoryCacheBackend()
+        cache = AnswerCache(backend)
+        scope = AnswerCache.make_scope("rtr", {})
+        await cache.set_similar(scope, unit(0.0), {"answer": "a"})
+        backend.entries.clear()
+        return await cache.get_similar(scope, unit(0.0)), len(cache.vectors)
+
+    assert asyncio.run(main()) == (None, 0)
+
+
+def test_cached_approaches_run_once_per_question():
+    async def main():
+        cache = make_cache()
+        ask = CountingAskApproach()
+        cached_ask = CachedAskApproach("rtr", ask, cache)
+        first = await cached_ask.run("Deductible?", {})
+        second = await cached_ask.run("deductible", {})
+        frames = [frame async for frame in cached_ask.run_stream("Deductible", {})]
+        other = await cached_ask.run("Deductible?", {"top": 5})
+
+        chat = CountingChatApproach()
+        cached_chat = CachedChatApproach("rrr", chat, cache)
+        await cached_chat.run([{"user": "Deductible?"}], {})
+        await cached_chat.run([{"user": "deductible"}], {})
+        return first, second, frames, other, ask.runs, chat.runs
+
+    first, second, frames, other, ask_runs, chat_runs = asyncio.run(main())
+    assert first == second == {"answer": "Deductible? (1)"}
+    assert frames == [{"type": "result", "result": first}]
+    assert other == {"answer": "Deductible? (2)"}
+    assert ask_runs == 2
+    assert chat_runs == 1
@@ -0,0 +1,183 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from core.blobcache import BlobDiskCache
+
+DATA = bytes(range(256)) * 40
+
+
+class Downloads:
+    """Downloads of `data` in 1000 byte chunks, counted per blob."""
+
+    def __init__(self, data=DATA):
+        self.data = data
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return self.chunks()
+
+    async def chunks(self):
+        for i in range(0, len(self.data), 1000):
+            await asyncio.sleep(0)
+            yield self.data[i : i + 1000]
+
+
+async def read(cache, path, offset=0, length=len(DATA)):
+    chunks = await cache.open(path, offset, length)
+    return b"".join([bytes(chunk) async for chunk in chunks])
+
+
+def test_miss_downloads_then_hits(tmp_path):
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), 10**6, chunk_size=4096)
+        download = Downloads()
+        path = await cache.fetch("a.pdf", '"1"', download)
+        again = await cache.fetch("a.pdf", '"1"', download)
+        return cache, download, path, again, await read(cache, path)
+
+    cache, download, path, again, data = asyncio.run(main())
+    assert path == again
+    assert download.count == 1
+    assert data == DATA
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["files"]) == (1, 1, 1)
+    assert stats["bytes"] == len(DATA)
+
+
+def test_concurrent_misses_share_one_download(tmp_path):
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), 10**6)
+        download = Downloads()
+        paths = await asyncio.gather(
+            *[cache.fetch("a.pdf", '"1"', download) for _ in range(5)]
+        )
+        return download, paths
+
+    download, paths = asyncio.run(main())
+    assert download.count == 1
+    assert len(set(paths)) == 1
+
+
+def test_changed_etag_is_downloaded_again(tmp_path):
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), 10**6)
+        old = await cache.fetch("a.pdf", '"1"', Downloads())
+        new_download = Downloads(b"new content")
+        new = await cache.fetch("a.pdf", '"2"', new_download)
+        return cache, old, new, new_download, await read(cache, new, 0, 11)
+
+    cache, old, new, download, data = asyncio.run(main())
+    assert old != new
+    assert download.count == 1
+    assert data == b"new content"
+    assert cache.stats()["misses"] == 2
+
+
+def test_ranges_are_read_in_chunks(tmp_path):
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), 10**6, chunk_size=1000)
+        path = await cache.fetch("a.pdf", '"1"', Downloads())
+        chunks = [chunk async for chunk in await cache.open(path, 500, 2100)]
+        return [len(chunk) for chunk in chunks], b"".join(bytes(c) for c in chunks)
+
+    sizes, data = asyncio.run(main())
+    assert sizes == [1000, 1000, 100]
+    assert data == DATA[500:2600]
+
+
+def test_empty_range(tmp_path):
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), 10**6)
+        return await read(cache, str(tmp_path / "missing"), 0, 0)
+
+    assert asyncio.run(main()) == b""
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), 2 * len(DATA))
+        a = await cache.fetch("a.pdf", '"1"', Downloads())
+        b = await cache.fetch("b.pdf", '"1"', Downloads())
+        await cache.fetch("a.pdf", '"1"', Downloads())
+        c = await cache.fetch("c.pdf", '"1"', Downloads())
+        return cache, a, b, c
+
+    cache, a, b, c = asyncio.run(main())
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
+    assert os.path.exists(c)
+    assert cache.stats()["bytes"] == 2 * len(DATA)
+
+
+def test_evicted_file_is_still_served_to_its_readers(tmp_path):
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), len(DATA), chunk_size=1000)
+        a = await cache.fetch("a.pdf", '"1"', Downloads())
+        chunks = await cache.open(a, 0, len(DATA))
+        first = await chunks.__anext__()
+        # Evicts a while a chunk of it is held
+        await cache.fetch("b.pdf", '"1"', Downloads())
+        assert not os.path.exists(a)
+        # The stream ends while the first chunk still holds the map open
+        rest = [bytes(chunk) async for chunk in chunks]
+        data = bytes(first) + b"".join(rest)
+        first.release()
+        with pytest.raises(FileNotFoundError):
+            await cache.open(a, 0, len(DATA))
+        return data
+
+    assert asyncio.run(main()) == DATA
+
+
+def test_closing_a_stream_while_a_chunk_is_held(tmp_path):
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), 10**6, chunk_size=1000)
+        a = await cache.fetch("a.pdf", '"1"', Downloads())
+        chunks = await cache.open(a, 0, len(DATA))
+        first = await chunks.__anext__()
+        await chunks.aclose()
+        return bytes(first)
+
+    assert asyncio.run(main()) == DATA[:1000]
+
+
+def test_failed_download_leaves_no_file(tmp_path):
+    async def failing():
+        yield b"partial"
+        raise ConnectionError("Download failed")
+
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), 10**6)
+        with pytest.raises(ConnectionError):
+            await cache.fetch("a.pdf", '"1"', failing)
+        return cache
+
+    cache = asyncio.run(main())
+    assert os.listdir(tmp_path) == []
+    assert cache.stats()["files"] == 0
+
+
+def test_existing_files_are_reused_and_stale_downloads_removed(tmp_path):
+    async def main():
+        cache = BlobDiskCache(str(tmp_path), 10**6)
+        return await cache.fetch("a.pdf", '"1"', Downloads())
+
+    path = asyncio.run(main())
+    stale = tmp_path / "abc.123.tmp"
+    stale.write_bytes(b"partial")
+    os.utime(stale, (time.time() - 7200, time.time() - 7200))
+
+    async def restart():
+        cache = BlobDiskCache(str(tmp_path), 10**6)
+        download = Downloads()
+        return cache, download, await cache.fetch("a.pdf", '"1"', download)
+
+    cache, download, again = asyncio.run(restart())
+    assert again == path
+    assert download.count == 0
+    assert not stale.exists()
+    assert cache.stats()["bytes"] == len(DATA)
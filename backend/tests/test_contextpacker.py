@@ -0,0 +1,90 @@
+import pytest
+
+import core.contextpacker
+from core.contextpacker import ContextPacker
+
+
+class WordEncoding:
+    """Counts words as tokens, so budgets are easy to follow."""
+
+    name = "words"
+
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def word_encoding(monkeypatch):
+    monkeypatch.setattr(
+        core.contextpacker, "get_encoding", lambda model: WordEncoding()
+    )
+
+
+def sentence(words, word="word"):
+    return " ".join([word] * (words - 1) + [word + "."])
+
+
+def chunk(url, content, summary="", score=None):
+    res = {"url": url, "content": content, "summary": summary}
+    if score is not None:
+        res["score"] = score
+    return res
+
+
+def pack(results, budget, **kwargs):
+    return ContextPacker("gpt-4", **kwargs).pack(results, budget)
+
+
+def test_chunks_that_fit_are_packed_by_score():
+    lines, used = pack(
+        [chunk("a", sentence(3), score=0.1), chunk("b", sentence(4), score=0.9)], 100
+    )
+    assert lines == ["b: " + sentence(4), "a: " + sentence(3)]
+    # Each line is its prefix, content and a newline
+    assert used == (1 + 4 + 1) + (1 + 3 + 1)
+
+
+def test_chunks_without_scores_keep_the_retrieval_order():
+    lines, _ = pack([chunk("a", sentence(3)), chunk("b", sentence(3))], 100)
+    assert [line[0] for line in lines] == ["a", "b"]
+
+
+def test_chunk_is_cut_at_a_sentence_boundary():
+    content = " ".join(
+        [sentence(10, "one"), sentence(10, "two"), sentence(10, "three")]
+    )
+    lines, used = pack([chunk("a", content)], 25, min_trimmed_tokens=5)
+    assert lines == ["a: " + sentence(10, "one") + " " + sentence(10, "two")]
+    assert used == 1 + 20 + 1
+
+
+def test_summary_replaces_a_sentence_over_budget():
+    lines, used = pack([chunk("a", sentence(100), summary="A short summary.")], 50)
+    assert lines == ["a: A short summary."]
+    assert used == 1 + 3 + 1
+
+
+def test_summary_replaces_less_than_half_of_a_chunk():
+    content = " ".join([sentence(10, "one"), sentence(30, "two")])
+    lines, _ = pack(
+        [chunk("a", content, summary="A short summary.")], 25, min_trimmed_tokens=5
+    )
+    assert lines == ["a: A short summary."]
+
+
+def test_too_short_a_cut_is_skipped_without_a_summary():
+    content = " ".join([sentence(10, "one"), sentence(30, "two")])
+    lines, used = pack(
+        [chunk("a", content, score=0.9), chunk("b", sentence(5), score=0.1)], 25
+    )
+    # a would keep 10 tokens, under min_trimmed_tokens, and is skipped for b
+    assert lines == ["b: " + sentence(5)]
+    assert used == 1 + 5 + 1
+
+
+def test_packing_stops_when_the_budget_is_spent():
+    lines, used = pack(
+        [chunk("a", sentence(8), score=0.9), chunk("b", sentence(1), score=0.1)], 10
+    )
+    assert lines == ["a: " + sentence(8)]
+    assert used == 10
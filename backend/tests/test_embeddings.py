@@ -0,0 +1,137 @@
+import asyncio
+import gc
+
+import numpy as np
+
+from core.embeddings import EmbeddingService
+from core.ratelimit import OpenAIScheduler
+
+
+class FakeEmbedding:
+    """Embeds a text as [len(text), 1], and returns the items in reverse order."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.inputs = []
+
+    async def acreate(self, engine, input):
+        self.inputs.append(list(input))
+        await asyncio.sleep(0.01)
+        if self.error:
+            raise self.error
+        return {
+            "data": [
+                {"index": i, "embedding": [float(len(text)), 1.0]}
+                for i, text in reversed(list(enumerate(input)))
+            ]
+        }
+
+
+class FakeOpenAI:
+    def __init__(self, error=None):
+        self.Embedding = FakeEmbedding(error)
+
+
+def service(client, **kwargs):
+    return EmbeddingService(
+        "ada", scheduler=OpenAIScheduler(openai_client=client), **kwargs
+    )
+
+
+def test_concurrent_misses_share_one_batch():
+    async def main():
+        client = FakeOpenAI()
+        embeddings = service(client, batch_window=0.01)
+        vectors = await asyncio.gather(
+            *[embeddings.embed(text) for text in ["a", "bb", "a", "ccc"]]
+        )
+        return client, embeddings, vectors
+
+    client, embeddings, vectors = asyncio.run(main())
+    assert client.Embedding.inputs == [["a", "bb", "ccc"]]
+    assert [v.tolist() for v in vectors] == [[1, 1], [2, 1], [1, 1], [3, 1]]
+    assert vectors[0].dtype == np.float32
+    assert embeddings.stats()["batches"] == 1
+
+
+def test_cached_vectors_are_not_embedded_again():
+    async def main():
+        client = FakeOpenAI()
+        embeddings = service(client)
+        await embeddings.embed("a")
+        await embeddings.embed("a")
+        return client, embeddings.stats()
+
+    client, stats = asyncio.run(main())
+    assert client.Embedding.inputs == [["a"]]
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["cached_vectors"] == 1
+
+
+def test_full_batch_is_sent_before_the_window_closes():
+    async def main():
+        client = FakeOpenAI()
+        embeddings = service(client, batch_window=10, max_batch_size=2)
+        await asyncio.wait_for(
+            asyncio.gather(embeddings.embed("a"), embeddings.embed("b")), 1
+        )
+        return client
+
+    assert asyncio.run(main()).Embedding.inputs == [["a", "b"]]
+
+
+def test_batch_error_is_raised_to_every_waiter():
+    async def main():
+        client = FakeOpenAI(ValueError("Embedding failed"))
+        embeddings = service(client, batch_window=0.01)
+        results = await asyncio.gather(
+            embeddings.embed("a"),
+            embeddings.embed("b"),
+            embeddings.embed("a"),
+            return_exceptions=True,
+        )
+        # Failures aren't cached, the next call embeds again
+        client.Embedding.error = None
+        vector = await embeddings.embed("a")
+        return client, results, vector
+
+    client, results, vector = asyncio.run(main())
+    assert all(isinstance(e, ValueError) for e in results)
+    assert vector.tolist() == [1, 1]
+    assert client.Embedding.inputs == [["a", "b"], ["a"]]
+
+
+def test_cancelled_caller_does_not_cancel_the_batch():
+    async def main():
+        client = FakeOpenAI()
+        embeddings = service(client, batch_window=0.01)
+        cancelled = asyncio.ensure_future(embeddings.embed("a"))
+        other = asyncio.ensure_future(embeddings.embed("a"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return cancelled, await other
+
+    cancelled, vector = asyncio.run(main())
+    assert cancelled.cancelled()
+    assert vector.tolist() == [1, 1]
+
+
+def test_batch_error_without_waiters_is_not_logged_as_unretrieved():
+    errors = []
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: errors.append(context)
+        )
+        client = FakeOpenAI(ValueError("Embedding failed"))
+        embeddings = service(client, batch_window=0)
+        caller = asyncio.ensure_future(embeddings.embed("a"))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.sleep(0.05)
+        del caller, embeddings
+        gc.collect()
+
+    asyncio.run(main())
+    assert errors == []
@@ -0,0 +1,245 @@
+import asyncio
+import os
+
+import numpy as np
+import pytest
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.models import Vector
+
+from core.localsearch import (
+    DEFAULT_TOP,
+    FallbackSearchClient,
+    LocalIndex,
+    LocalSearchClient,
+    LocalSearchResults,
+    read_search,
+)
+
+DOCUMENTS = [
+    {
+        "Id": "a",
+        "Category": "benefits",
+        "Storage": "blob",
+        "FileName": "a.pdf",
+        "Content": "The deductible for the employee plan is $500. Dental is included.",
+        "content_embedding": [1.0, 0.0, 0.0],
+    },
+    {
+        "Id": "b",
+        "Category": "handbook",
+        "Storage": "blob",
+        "FileName": "b.pdf",
+        "Content": "Vacation days are accrued monthly.",
+        "content_embedding": [0.8, 0.6, 0.0],
+    },
+    {
+        "Id": "c",
+        "Category": "benefits",
+        "Storage": "wiki",
+        "FileName": "c.pdf",
+        "Content": "Vision coverage for the family plan, with a family deductible.",
+        "content_embedding": [0.0, 0.0, 1.0],
+    },
+    {
+        "Id": "d",
+        "Category": "it's complicated",
+        "Storage": "wiki",
+        "FileName": "d.pdf",
+        "Content": "Laptops are replaced every three years.",
+    },
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = str(tmp_path / "index")
+    LocalIndex.save(path, DOCUMENTS, ["content_embedding"])
+    return LocalIndex(path)
+
+
+def ids(results):
+    return [doc["Id"] for doc in results.results]
+
+
+def search(index, *args, **kwargs):
+    return asyncio.run(LocalSearchClient(index).search(*args, **kwargs))
+
+
+def test_save_and_reload(tmp_path, index):
+    assert len(index) == 4
+    assert index.documents[0]["FileName"] == "a.pdf"
+    # Vectors are stored normalized, apart from the documents
+    assert "content_embedding" not in index.documents[0]
+    assert np.allclose(index.vectors["content_embedding"][1], [0.8, 0.6, 0.0])
+    assert index.has_vector["content_embedding"].tolist() == [True, True, True, False]
+    # Saving again replaces the index
+    path = str(tmp_path / "index")
+    LocalIndex.save(path, DOCUMENTS[:2], ["content_embedding"])
+    assert len(LocalIndex(path)) == 2
+    assert sorted(os.listdir(tmp_path)) == ["index"]
+
+
+def test_filters(index):
+    def rows(filter):
+        return np.flatnonzero(index.filter_mask(filter)).tolist()
+
+    assert index.filter_mask(None) is None
+    assert rows("Category eq 'benefits'") == [0, 2]
+    assert rows("Category ne 'benefits'") == [1, 3]
+    assert rows("Category eq 'it''s complicated'") == [3]
+    assert rows("search.in(Id, 'a,d', ',')") == [0, 3]
+    # Values are separated by spaces and commas by default
+    assert rows("search.in(Id, 'a b')") == [0, 1]
+    assert rows("Category eq 'benefits' and Storage eq 'wiki' or Id eq 'b'") == [1, 2]
+    for filter in ["Category gt 'a'", "Category eq 'a' and", "and Id eq 'a'"]:
+        with pytest.raises(ValueError):
+            index.filter_mask(filter)
+
+
+def test_filter_field_names_are_case_insensitive(index):
+    # The approaches exclude categories with "category ne '...'"
+    results = search(index, "*", filter="category ne 'benefits'")
+    assert ids(results) == ["b", "d"]
+    with pytest.raises(ValueError):
+        index.filter_mask("color eq 'red'")
+
+
+def test_vector_search(index):
+    results = search(
+        index,
+        None,
+        vectors=[Vector(value=[1.0, 0.1, 0.0], k=2, fields="content_embedding")],
+        select=["Id", "content_embedding"],
+    )
+    assert ids(results) == ["a", "b"]
+    assert results.results[0]["content_embedding"] == [1.0, 0.0, 0.0]
+    # Scored 1 / (2 - cosine), like the service
+    assert results.results[0]["@search.score"] == pytest.approx(
+        1 / (2 - 1 / np.sqrt(1.01))
+    )
+
+
+def test_vector_search_with_filter(index):
+    results = search(
+        index,
+        None,
+        filter="category eq 'benefits'",
+        vectors=[Vector(value=[0.8, 0.6, 0.0], k=3, fields="content_embedding")],
+    )
+    assert ids(results) == ["a", "c"]
+
+
+def test_text_search_with_captions(index):
+    results = search(index, "deductible", query_caption="extractive")
+    assert set(ids(results)) == {"a", "c"}
+    captions = [doc["@search.captions"][0].text for doc in results.results]
+    assert all("deductible" in caption for caption in captions)
+
+
+def test_hybrid_search_fuses_with_reciprocal_rank(index):
+    results = search(
+        index,
+        "family deductible",
+        vectors=[Vector(value=[1.0, 0.0, 0.0], k=3, fields="content_embedding")],
+    )
+    # c ranks first for the text and third for the vector, a second and first
+    assert ids(results)[:2] == ["a", "c"]
+    assert results.results[0]["@search.score"] == pytest.approx(1 / 61 + 1 / 62)
+    assert results.count == 3
+
+
+def test_top_and_skip(index):
+    assert ids(search(index, "*")) == ["a", "b", "c", "d"]
+    assert ids(search(index, "*", top=2, skip=1)) == ["b", "c"]
+
+
+class Pager:
+    """Pages through `total` documents, like the SDK's pager without `top`."""
+
+    def __init__(self, total):
+        self.total = total
+        self.read = 0
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for i in range(self.total):
+            self.read += 1
+            yield {"Id": str(i)}
+
+    async def get_count(self):
+        return self.total
+
+    async def get_answers(self):
+        return None
+
+
+class PagingSearchClient:
+    def __init__(self, total=100000):
+        self.total = total
+        self.calls = []
+        self.pagers = []
+
+    async def search(self, *args, **kwargs):
+        self.calls.append(kwargs)
+        top = kwargs.get("top")
+        pager = Pager(self.total if top is None else min(top, self.total))
+        self.pagers.append(pager)
+        return pager
+
+
+class FailingSearchClient:
+    async def search(self, *args, **kwargs):
+        raise HttpResponseError("Service unavailable")
+
+
+class FakeLocalSearchClient:
+    async def search(self, *args, **kwargs):
+        return LocalSearchResults([{"Id": "local"}], 1)
+
+
+def test_read_search_reads_up_to_top():
+    async def main():
+        client = PagingSearchClient()
+        results = await read_search(client, "q")
+        limited = await read_search(client, "q", top=3)
+        return client, results, limited
+
+    client, results, limited = asyncio.run(main())
+    assert len(results.results) == DEFAULT_TOP
+    assert client.calls[0]["top"] == DEFAULT_TOP
+    assert [doc["Id"] for doc in limited.results] == ["0", "1", "2"]
+    assert results.count == DEFAULT_TOP
+    assert not results.degraded
+
+
+def test_read_search_stops_when_the_service_ignores_top():
+    class IgnoringSearchClient(PagingSearchClient):
+        async def search(self, *args, **kwargs):
+            pager = Pager(self.total)
+            self.pagers.append(pager)
+            return pager
+
+    client = IgnoringSearchClient()
+    results = asyncio.run(read_search(client, "q", top=5))
+    assert len(results.results) == 5
+    assert client.pagers[0].read == 5
+
+
+def test_fallback_serves_the_service_results():
+    client = FallbackSearchClient(PagingSearchClient(), FakeLocalSearchClient())
+    results = asyncio.run(client.search("q"))
+    assert len(results.results) == DEFAULT_TOP
+    assert not results.degraded
+    assert client.stats()["primary"] == 1
+
+
+def test_fallback_serves_the_local_index_when_the_service_fails():
+    client = FallbackSearchClient(FailingSearchClient(), FakeLocalSearchClient())
+    results = asyncio.run(client.search("q"))
+    assert results.results == [{"Id": "local"}]
+    assert results.degraded
+    stats = client.stats()
+    assert stats["errors"] == 1
+    assert stats["fallback_rate"] == 1.0
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from lookuptool import CsvTable, CsvTables
+
+
+@pytest.fixture
+def write_csv(tmp_path):
+    def write(content: str) -> str:
+        path = tmp_path / "table.csv"
+        path.write_text(content)
+        return str(path)
+
+    return write
+
+
+def test_lookup_exact_prefix_and_fuzzy(write_csv):
+    table = CsvTable(write_csv("name,city\nAlice Smith,Kyiv\nBob Jones,Lviv\n"), "name")
+    assert table.lookup("alice  smith") == "name:Alice Smith\ncity:Kyiv"
+    assert table.lookup("Bob") == "name:Bob Jones\ncity:Lviv"
+    assert table.lookup("Alise Smith") == "name:Alice Smith\ncity:Kyiv"
+    assert table.lookup("Nobody") == ""
+    assert table.lookup("  ") == ""
+
+
+def test_duplicate_keys_keep_the_first_row(write_csv):
+    table = CsvTable(write_csv("name,city\nA,Kyiv\na,Lviv\n"), "name")
+    assert table.lookup("A") == "name:A\ncity:Kyiv"
+
+
+def test_blank_lines_are_skipped(write_csv):
+    table = CsvTable(write_csv("name,city\nA,Kyiv\n\nB,Lviv\n"), "name")
+    assert table.lookup("A") == "name:A\ncity:Kyiv"
+    assert table.lookup("B") == "name:B\ncity:Lviv"
+
+
+def test_short_and_long_rows_stay_aligned(write_csv):
+    table = CsvTable(write_csv("name,city,role\nA\nB,Lviv,Dev,extra\nC,Odesa,QA\n"), "name")
+    assert table.lookup("A") == "name:A\ncity:\nrole:"
+    assert table.lookup("B") == "name:B\ncity:Lviv\nrole:Dev"
+    assert table.lookup("C") == "name:C\ncity:Odesa\nrole:QA"
+
+
+def test_unknown_key_field(write_csv):
+    with pytest.raises(ValueError):
+        CsvTable(write_csv("name,city\nA,Kyiv\n"), "id")
+
+
+def test_tables_reload_when_the_file_changes(write_csv):
+    path = write_csv("name,city\nA,Kyiv\n")
+    tables = CsvTables()
+    table = tables.get(path, "name")
+    assert tables.get(path, "name") is table
+    with open(path, "w") as f:
+        f.write("name,city\nA,Lviv\n")
+    os.utime(path, ns=(table.mtime + 10**9, table.mtime + 10**9))
+    assert tables.get(path, "name").lookup("A") == "name:A\ncity:Lviv"
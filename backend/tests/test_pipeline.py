@@ -0,0 +1,84 @@
+import asyncio
+
+import openai
+import pytest
+
+from ingestion.pipeline import Checkpoint, RetryPolicy
+from ingestion.sources import Section
+
+
+def section(id: str, content: str = "text") -> Section:
+    return Section({"Id": id, "Content": content}, "title")
+
+
+def test_checkpoint_skips_recorded_sections(tmp_path):
+    path = str(tmp_path / "ingestion.ckpt")
+    checkpoint = Checkpoint(path)
+    checkpoint.record([section("a"), section("b")])
+    assert checkpoint.done(section("a"))
+
+    resumed = Checkpoint(path)
+    assert resumed.done(section("a"))
+    assert resumed.done(section("b"))
+    assert not resumed.done(section("c"))
+
+
+def test_checkpoint_reindexes_changed_sections(tmp_path):
+    path = str(tmp_path / "ingestion.ckpt")
+    Checkpoint(path).record([section("a", "old text")])
+    assert not Checkpoint(path).done(section("a", "new text"))
+
+
+def test_checkpoint_ignores_a_line_cut_short(tmp_path):
+    path = tmp_path / "ingestion.ckpt"
+    Checkpoint(str(path)).record([section("a")])
+    with open(path, "a") as f:
+        f.write('{"id": "b", "ha')
+
+    checkpoint = Checkpoint(str(path))
+    assert checkpoint.done(section("a"))
+    assert not checkpoint.done(section("b"))
+    # The next record starts on a new line, so it can be read back
+    checkpoint.record([section("c")])
+    resumed = Checkpoint(str(path))
+    assert resumed.done(section("a"))
+    assert resumed.done(section("c"))
+
+
+def test_checkpoint_without_path_is_in_memory(tmp_path):
+    checkpoint = Checkpoint(None)
+    checkpoint.record([section("a")])
+    assert checkpoint.done(section("a"))
+
+
+class Unavailable(Exception):
+    status_code = 503
+
+
+def test_retry_policy_retries_transient_errors():
+    policy = RetryPolicy(max_retries=3, base_delay=0)
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        if len(calls) < 3:
+            raise Unavailable()
+        return "ok"
+
+    assert asyncio.run(policy.call(fn)) == "ok"
+    assert len(calls) == 3
+    assert policy.retries == 2
+
+
+def test_retry_policy_leaves_openai_rate_limits_to_the_scheduler():
+    policy = RetryPolicy(max_retries=3, base_delay=0)
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        raise openai.error.RateLimitError("slow down", http_status=429)
+
+    with pytest.raises(openai.error.RateLimitError):
+        asyncio.run(policy.call(fn))
+    assert len(calls) == 1
+    assert policy.rate_limited == 0
@@ -0,0 +1,207 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+from core.ratelimit import (
+    BucketState,
+    DeploymentQueue,
+    OpenAIScheduler,
+    Priority,
+    RateLimit,
+    SharedBucketState,
+    TokenBucket,
+    parse_rate_limits,
+    retry_after,
+    status_code,
+)
+
+
+def rate_limit_error(headers=None):
+    return openai.error.RateLimitError(
+        "Rate limit reached", http_status=429, headers=headers or {}
+    )
+
+
+class FakeChatCompletion:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = []
+
+    async def acreate(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.failures:
+            raise self.failures.pop(0)
+        return {"choices": [{"message": {"content": "answer"}}]}
+
+
+class FakeOpenAI:
+    def __init__(self, failures=()):
+        self.ChatCompletion = FakeChatCompletion(list(failures))
+
+
+def test_parse_rate_limits():
+    limits = parse_rate_limits("gpt=60000, ada = 1000/30,")
+    assert sorted(limits) == ["ada", "gpt"]
+    assert limits["gpt"].tokens_per_minute == 60000
+    # Azure's 6 requests per minute per 1000 tokens
+    assert limits["gpt"].requests_per_minute == 360
+    assert limits["ada"].tokens_per_minute == 1000
+    assert limits["ada"].requests_per_minute == 30
+    assert parse_rate_limits("") == {}
+
+
+def test_retry_after_and_status_code():
+    assert retry_after(rate_limit_error({"Retry-After-Ms": "250"})) == 0.25
+    assert retry_after(rate_limit_error({"x-ms-retry-after-ms": "100"})) == 0.1
+    assert retry_after(rate_limit_error({"Retry-After": "2"})) == 2.0
+    assert retry_after(rate_limit_error({"Retry-After": "soon"})) is None
+    assert retry_after(rate_limit_error()) is None
+    assert status_code(rate_limit_error()) == 429
+    assert status_code(ValueError()) is None
+
+
+def test_bucket_charges_tokens_and_refills():
+    # 1000 tokens per second, with 1 second of quota as the capacity
+    bucket = TokenBucket(RateLimit(60000, 60000), burst=1.0)
+    assert bucket.acquire(600, Priority.INTERACTIVE) == 0.0
+    wait = bucket.acquire(600, Priority.INTERACTIVE)
+    assert 0.15 < wait <= 0.2
+    time.sleep(wait)
+    assert bucket.acquire(600, Priority.INTERACTIVE) == 0.0
+
+
+def test_default_capacity_fits_the_largest_chat_call():
+    # The gpt-4 deployment's 30000 tokens per minute, and 8000 prompt plus 1024
+    # completion tokens
+    bucket = TokenBucket(RateLimit(30000))
+    assert bucket.acquire(9024, Priority.INTERACTIVE) == 0.0
+    assert bucket.acquire(9024, Priority.INTERACTIVE) == 0.0
+
+
+def test_bucket_keeps_reserve_for_interactive_calls():
+    bucket = TokenBucket(RateLimit(60000, 60000), burst=1.0, reserve=0.2)
+    assert bucket.acquire(500, Priority.BATCH) == 0.0
+    # Batch calls leave 200 of the 1000 tokens
+    assert bucket.acquire(400, Priority.BATCH) > 0
+    assert bucket.acquire(400, Priority.INTERACTIVE) == 0.0
+
+
+def test_bucket_holds_lower_priorities_while_higher_ones_wait():
+    bucket = TokenBucket(RateLimit(60000, 60000), burst=1.0)
+    assert bucket.acquire(1000, Priority.INTERACTIVE) == 0.0
+    assert bucket.acquire(500, Priority.INTERACTIVE) > 0
+    time.sleep(0.2)
+    # There are tokens for a small ingestion call, but an interactive call is waiting
+    assert bucket.acquire(10, Priority.INGESTION) > 0
+
+
+def test_pause_stops_calls_without_a_limit():
+    bucket = TokenBucket(None)
+    assert bucket.acquire(10**9, Priority.INTERACTIVE) == 0.0
+    bucket.pause(0.5)
+    assert 0.4 < bucket.acquire(0, Priority.INTERACTIVE) <= 0.5
+
+
+def test_shared_state_splits_the_budget(tmp_path):
+    path = str(tmp_path / "gpt")
+    limit = RateLimit(60000, 60000)
+    first = TokenBucket(limit, SharedBucketState(path), burst=1.0)
+    second = TokenBucket(limit, SharedBucketState(path), burst=1.0)
+    assert first.acquire(1000, Priority.INTERACTIVE) == 0.0
+    assert second.acquire(500, Priority.INTERACTIVE) > 0
+    # An in-process state has its own budget
+    assert TokenBucket(limit, BucketState(), burst=1.0).acquire(
+        1000, Priority.INTERACTIVE
+    ) == 0.0
+
+
+def test_queue_paces_calls_to_the_limit():
+    async def main():
+        # A capacity of 100 tokens, refilled at 1000 tokens per second
+        queue = DeploymentQueue(TokenBucket(RateLimit(60000, 60000), burst=0.1))
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[queue.acquire(100, Priority.INTERACTIVE) for _ in range(5)]
+        )
+        return time.perf_counter() - start, queue.stats()
+
+    elapsed, stats = asyncio.run(main())
+    assert 0.35 < elapsed < 1.0
+    assert stats["requests"] == 5
+    assert stats["estimated_tokens"] == 500
+    assert stats["queued"] == 4
+    assert stats["waiting"] == 0
+
+
+def test_queue_serves_higher_priorities_first():
+    async def main():
+        queue = DeploymentQueue(TokenBucket(None))
+        queue.pause(0.05)
+        order = []
+
+        async def call(priority):
+            await queue.acquire(0, priority)
+            order.append(priority)
+
+        await asyncio.gather(
+            call(Priority.INGESTION),
+            call(Priority.BATCH),
+            call(Priority.INGESTION),
+            call(Priority.INTERACTIVE),
+        )
+        return order, queue.stats()
+
+    order, stats = asyncio.run(main())
+    assert order == [
+        Priority.INTERACTIVE,
+        Priority.BATCH,
+        Priority.INGESTION,
+        Priority.INGESTION,
+    ]
+    assert stats["rate_limited"] == 1
+
+
+def test_scheduler_retries_after_rate_limits():
+    client = FakeOpenAI(
+        [rate_limit_error({"retry-after-ms": "10"}), rate_limit_error()]
+    )
+    scheduler = OpenAIScheduler(max_retries=3, max_backoff=0.01, openai_client=client)
+    response = asyncio.run(
+        scheduler.chat_completion(deployment_id="gpt", messages=[])
+    )
+    assert response["choices"][0]["message"]["content"] == "answer"
+    assert len(client.ChatCompletion.calls) == 3
+    stats = scheduler.stats()
+    assert stats["retries"] == 2
+    assert stats["shared"] is False
+    assert stats["deployments"]["gpt"]["rate_limited"] == 2
+    assert stats["deployments"]["gpt"]["requests"] == 3
+
+
+def test_scheduler_gives_up_after_max_retries():
+    client = FakeOpenAI([rate_limit_error({"retry-after-ms": "1"})] * 3)
+    scheduler = OpenAIScheduler(max_retries=2, openai_client=client)
+    with pytest.raises(openai.error.RateLimitError):
+        asyncio.run(scheduler.chat_completion(deployment_id="gpt", messages=[]))
+    assert len(client.ChatCompletion.calls) == 3
+    assert scheduler.retries == 2
+
+
+def test_scheduler_estimates_prompt_and_completion_tokens():
+    scheduler = OpenAIScheduler(
+        {"gpt": RateLimit(60000)}, openai_client=FakeOpenAI()
+    )
+
+    async def main():
+        await scheduler.chat_completion(
+            prompt_tokens=100, deployment_id="gpt", messages=[], max_tokens=50, n=2
+        )
+        await scheduler.chat_completion(
+            Priority.BATCH, prompt_tokens=100, engine="gpt", messages=[]
+        )
+
+    asyncio.run(main())
+    # 100 + 2 * 50, then 100 + the default 256 completion tokens
+    assert scheduler.stats()["deployments"]["gpt"]["estimated_tokens"] == 556
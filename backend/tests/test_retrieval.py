@@ -0,0 +1,161 @@
+import asyncio
+import re
+
+import numpy as np
+from azure.core.exceptions import HttpResponseError
+
+from core.retrieval import HybridRetriever, parent_id
+
+SELECT = ["Id", "Content"]
+VECTOR_FIELDS = ["title_embedding", "content_embedding"]
+EMBEDDINGS = {
+    "a-page-0": [1.0, 0.0, 0.0],
+    "a-page-1": [1.0, 0.0, 0.0],
+    "b-page-0": [0.99, 0.1, 0.0],
+    "c-page-0": [0.0, 1.0, 0.0],
+    "d-page-0": [0.0, 0.0, 1.0],
+}
+RANKED = {
+    "text": ["a-page-0", "a-page-1", "b-page-0", "c-page-0"],
+    "title_embedding": ["b-page-0", "a-page-0", "d-page-0"],
+    "content_embedding": ["a-page-0", "b-page-0", "c-page-0"],
+}
+
+
+class Results:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __aiter__(self):
+        async def iterate():
+            for doc in self.docs:
+                yield doc
+
+        return iterate()
+
+
+class FakeSearchClient:
+    """Returns the RANKED lists, and EMBEDDINGS for lookups by key."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def search(self, search_text, **kwargs):
+        self.calls.append((search_text, kwargs))
+        select = kwargs["select"]
+        filter = kwargs.get("filter") or ""
+        lookup = re.match(r"search\.in\(Id, '([^']*)', ','\)", filter)
+        if lookup:
+            ids = lookup[1].split(",")
+        elif kwargs.get("vectors"):
+            ids = RANKED[kwargs["vectors"][0].fields]
+        else:
+            ids = RANKED["text"]
+        docs = [
+            {"Id": id, "Content": "content " + id, "content_embedding": EMBEDDINGS[id]}
+            for id in ids
+        ]
+        return Results([{k: v for k, v in doc.items() if k in select} for doc in docs])
+
+
+def retriever(client, **kwargs):
+    return HybridRetriever(
+        client, SELECT, VECTOR_FIELDS, mmr_field="content_embedding", **kwargs
+    )
+
+
+def test_parent_id():
+    assert parent_id("doc-page-3") == "doc"
+    assert parent_id("my-page-name-page-0") == "my-page-name"
+    assert parent_id("doc") == "doc"
+
+
+def test_fuse_ranks_by_weighted_reciprocal_rank():
+    r = retriever(None, rrf_k=60, weights={"text": 2.0})
+    fused = r.fuse(
+        {
+            "text": [{"Id": "a"}, {"Id": "b"}],
+            "content_embedding": [{"Id": "b"}, {"Id": "c"}],
+        }
+    )
+    assert [doc["Id"] for doc in fused] == ["b", "a", "c"]
+    assert fused[0]["@search.fused_score"] == 2 / 62 + 1 / 61
+    assert fused[1]["@search.fused_score"] == 2 / 61
+
+
+def test_fuse_keeps_the_fields_of_the_first_list():
+    r = retriever(None)
+    fused = r.fuse(
+        {
+            "text": [{"Id": "a", "@search.captions": ["caption"]}],
+            "content_embedding": [{"Id": "a", "@search.captions": None}],
+        }
+    )
+    assert fused[0]["@search.captions"] == ["caption"]
+
+
+def test_dedupe_keeps_the_best_chunks_per_document():
+    docs = [{"Id": id} for id in ["a-page-0", "a-page-1", "b-page-0", "a-page-2"]]
+    assert [d["Id"] for d in retriever(None).dedupe(docs)] == ["a-page-0", "b-page-0"]
+    deduped = retriever(None, max_chunks_per_doc=2).dedupe(docs)
+    assert [d["Id"] for d in deduped] == ["a-page-0", "a-page-1", "b-page-0"]
+
+
+def test_mmr_skips_near_duplicates():
+    docs = [
+        {"Id": "a", "@search.fused_score": 1.0, "content_embedding": [1.0, 0.0]},
+        {"Id": "b", "@search.fused_score": 0.95, "content_embedding": [1.0, 0.01]},
+        {"Id": "c", "@search.fused_score": 0.8, "content_embedding": [0.0, 1.0]},
+    ]
+    assert [d["Id"] for d in retriever(None, mmr_lambda=0.5).mmr(docs, 2)] == ["a", "c"]
+    assert [d["Id"] for d in retriever(None, mmr_lambda=1.0).mmr(docs, 2)] == ["a", "b"]
+
+
+def test_mmr_accepts_cached_float32_embeddings():
+    docs = [
+        {"Id": "a", "@search.fused_score": 1.0, "content_embedding": np.array([1.0, 0.0], dtype=np.float32)},
+        {"Id": "b", "@search.fused_score": 0.95, "content_embedding": np.array([1.0, 0.01], dtype=np.float32)},
+        {"Id": "c", "@search.fused_score": 0.8, "content_embedding": None},
+    ]
+    assert [d["Id"] for d in retriever(None, mmr_lambda=0.5).mmr(docs, 2)] == ["a", "c"]
+
+
+def test_search_fetches_embeddings_only_for_the_mmr_candidates():
+    client = FakeSearchClient()
+    r = retriever(client, mmr_lambda=0.5, mmr_candidates=3)
+    docs = asyncio.run(r.search("query", np.array([1.0, 0.0, 0.0]), 2))
+
+    assert [doc["Id"] for doc in docs] == ["a-page-0", "c-page-0"]
+    legs, lookups = client.calls[:3], client.calls[3:]
+    assert all("content_embedding" not in kwargs["select"] for _, kwargs in legs)
+    assert len(lookups) == 1
+    _, kwargs = lookups[0]
+    assert kwargs["filter"] == "search.in(Id, 'a-page-0,b-page-0,c-page-0', ',')"
+    assert kwargs["select"] == ["Id", "content_embedding"]
+
+
+def test_search_keeps_the_fused_order_when_the_lookup_is_rejected():
+    class NotFilterableSearchClient(FakeSearchClient):
+        async def search(self, search_text, **kwargs):
+            if "search.in" in (kwargs.get("filter") or ""):
+                raise HttpResponseError("Invalid expression: Id is not filterable")
+            return await super().search(search_text, **kwargs)
+
+    r = retriever(NotFilterableSearchClient(), mmr_lambda=0.5, mmr_candidates=3)
+    docs = asyncio.run(r.search("query", np.array([1.0, 0.0, 0.0]), 2))
+    assert [doc["Id"] for doc in docs] == ["a-page-0", "b-page-0"]
+
+
+def test_search_without_mmr_doesnt_fetch_embeddings():
+    client = FakeSearchClient()
+    r = retriever(client, mmr_lambda=1.0)
+    docs = asyncio.run(r.search("query", np.array([1.0, 0.0, 0.0]), 2))
+    assert [doc["Id"] for doc in docs] == ["a-page-0", "b-page-0"]
+    assert len(client.calls) == 3
+
+
+def test_search_text_only():
+    client = FakeSearchClient()
+    docs = asyncio.run(retriever(client, mmr_lambda=1.0).search("query", None, 3))
+    assert [doc["Id"] for doc in docs] == ["a-page-0", "b-page-0", "c-page-0"]
+    assert len(client.calls) == 1
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+
+import numpy as np
+from azure.search.documents.models import Vector
+
+from core.localsearch import DEFAULT_TOP, LocalSearchResults
+from core.searchcache import (
+    CachedSearchClient,
+    IndexGeneration,
+    bump_generation,
+    freeze,
+)
+
+VECTOR = [0.5] * 128
+
+
+class FakeSearchClient:
+    def __init__(self, degraded=False):
+        self.calls = 0
+        self.degraded = degraded
+
+    async def search(self, search_text=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        results = LocalSearchResults(
+            [{"Id": "a", "Content": search_text, "content_embedding": VECTOR}],
+            1,
+            [],
+        )
+        results.degraded = self.degraded
+        return results
+
+
+async def documents(client, *args, **kwargs):
+    return [doc async for doc in await client.search(*args, **kwargs)]
+
+
+def test_index_generation_reads_the_marker(tmp_path):
+    path = str(tmp_path / "generation")
+    generation = IndexGeneration(path, check_interval=0)
+    assert generation.current() == ""
+    written = bump_generation(path)
+    assert generation.current() == written
+    assert bump_generation(path) != written
+
+
+def test_index_generation_warns_once_while_the_marker_is_missing(tmp_path, caplog):
+    path = str(tmp_path / "generation")
+    generation = IndexGeneration(path, check_interval=0)
+    with caplog.at_level(logging.WARNING):
+        generation.current()
+        generation.current()
+    assert len(caplog.records) == 1
+    assert path in caplog.records[0].getMessage()
+
+
+def test_index_generation_checks_at_most_every_interval(tmp_path):
+    path = str(tmp_path / "generation")
+    first = bump_generation(path)
+    generation = IndexGeneration(path, check_interval=3600)
+    assert generation.current() == first
+    bump_generation(path)
+    assert generation.current() == first
+
+
+def test_freeze_replaces_vectors_with_a_digest():
+    vector = Vector(value=VECTOR, k=3, fields="content_embedding")
+    frozen = freeze({"vectors": [vector], "top": 3})
+    hash(frozen)
+    copy = Vector(value=list(VECTOR), k=3, fields="content_embedding")
+    assert frozen == freeze({"top": 3, "vectors": [copy]})
+    assert freeze(np.asarray(VECTOR)) == freeze(VECTOR)
+
+
+def test_identical_searches_are_cached():
+    async def main():
+        inner = FakeSearchClient()
+        client = CachedSearchClient(inner)
+        first = await documents(client, "Cloud  migration", top=3)
+        second = await documents(client, search_text="cloud migration ", top=3)
+        other = await documents(client, "cloud migration", top=5)
+        return inner.calls, client.stats(), first, second, other
+
+    calls, stats, first, second, other = asyncio.run(main())
+    assert calls == 2
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert first == second
+    # Embeddings are stored as float32 arrays and returned as lists
+    assert first[0]["content_embedding"] == VECTOR
+
+
+def test_callers_get_their_own_documents():
+    async def main():
+        client = CachedSearchClient(FakeSearchClient())
+        first = await documents(client, "q")
+        first[0]["Id"] = "changed"
+        return await documents(client, "q")
+
+    assert asyncio.run(main())[0]["Id"] == "a"
+
+
+def test_concurrent_identical_searches_are_sent_once():
+    async def main():
+        inner = FakeSearchClient()
+        client = CachedSearchClient(inner)
+        await asyncio.gather(*[documents(client, "q") for _ in range(5)])
+        return inner.calls, client.stats()
+
+    calls, stats = asyncio.run(main())
+    assert calls == 1
+    assert stats["coalesced"] == 4
+
+
+def test_a_new_generation_clears_the_cache(tmp_path):
+    path = str(tmp_path / "generation")
+
+    async def main():
+        inner = FakeSearchClient()
+        client = CachedSearchClient(
+            inner, generation=IndexGeneration(path, check_interval=0)
+        )
+        await documents(client, "q")
+        bump_generation(path)
+        await documents(client, "q")
+        await documents(client, "q")
+        return inner.calls, client.stats()
+
+    calls, stats = asyncio.run(main())
+    assert calls == 2
+    assert stats["invalidations"] == 1
+    assert stats["entries"] == 1
+
+
+def test_degraded_responses_are_not_cached():
+    async def main():
+        inner = FakeSearchClient(degraded=True)
+        client = CachedSearchClient(inner)
+        await documents(client, "q")
+        await documents(client, "q")
+        return inner.calls
+
+    assert asyncio.run(main()) == 2
+
+
+def test_searches_without_top_are_read_up_to_the_default():
+    class PagingSearchClient:
+        def __init__(self):
+            self.kwargs = None
+
+        async def search(self, search_text=None, **kwargs):
+            self.kwargs = kwargs
+            return LocalSearchResults([{"Id": str(i)} for i in range(1000)], 1000)
+
+    async def main():
+        inner = PagingSearchClient()
+        client = CachedSearchClient(inner)
+        return inner, await documents(client, "q")
+
+    inner, docs = asyncio.run(main())
+    assert inner.kwargs["top"] == DEFAULT_TOP
+    assert len(docs) == DEFAULT_TOP
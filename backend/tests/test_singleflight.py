@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from core.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_run():
+    async def main():
+        flights = SingleFlight()
+        runs = []
+
+        async def fn():
+            runs.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*[flights.do("key", fn) for _ in range(5)])
+        return results, runs, len(flights)
+
+    results, runs, in_flight = asyncio.run(main())
+    assert results == ["result"] * 5
+    assert runs == [1]
+    assert in_flight == 0
+
+
+def test_cancelled_caller_does_not_cancel_the_call_by_default():
+    async def main():
+        flights = SingleFlight()
+        done = asyncio.Event()
+
+        async def fn():
+            await asyncio.sleep(0.01)
+            done.set()
+
+        caller = asyncio.ensure_future(flights.do("key", fn))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.wait_for(done.wait(), 1)
+        return flights.cancelled
+
+    assert asyncio.run(main()) == 0
+
+
+def test_abandoned_call_is_cancelled_after_the_last_waiter():
+    async def main():
+        flights = SingleFlight(cancel_abandoned=True)
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def fn():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        first = asyncio.ensure_future(flights.do("key", fn))
+        second = asyncio.ensure_future(flights.do("key", fn))
+        await started.wait()
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled.is_set()
+        assert "key" in flights
+        second.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        return flights.cancelled, len(flights)
+
+    assert asyncio.run(main()) == (1, 0)
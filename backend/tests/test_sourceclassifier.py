@@ -0,0 +1,143 @@
+import asyncio
+import re
+
+import numpy as np
+from azure.core.exceptions import HttpResponseError
+
+from core.localsearch import LocalSearchResults
+from core.sourceclassifier import GENERATION_KEY, SourceClassifier
+
+CENTROIDS = {
+    "SoftServe Website": np.array([1.0, 0.0, 0.0]),
+    "Wikipedia": np.array([0.0, 1.0, 0.0]),
+}
+# Equally close to both centroids
+BETWEEN = np.array([1.0, 1.0, 0.1])
+
+
+class FakeSearchClient:
+    """Returns, per Storage value, documents with the given embeddings."""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.calls = 0
+
+    async def search(self, search_text, filter, select, top):
+        self.calls += 1
+        source = re.match(r"Storage eq '(.*)'", filter)[1]
+        return LocalSearchResults(
+            [{"content_embedding": v} for v in self.embeddings.get(source, [])], None
+        )
+
+
+class FailingSearchClient:
+    async def search(self, *args, **kwargs):
+        raise HttpResponseError("Service unavailable")
+
+
+def classifier(**kwargs):
+    return SourceClassifier(CENTROIDS, **{"min_similarity": 0.6, **kwargs})
+
+
+def test_nearest_centroid_wins():
+    clf = classifier()
+    assert clf.classify("anything", np.array([0.9, 0.2, 0.0])) == ["SoftServe Website"]
+    assert clf.classify("anything", np.array([0.1, 2.0, 0.0])) == ["Wikipedia"]
+    assert clf.stats()["centroid"] == 2
+
+
+def test_dissimilar_question_is_left_to_the_llm():
+    clf = classifier()
+    assert clf.classify("founded", np.array([0.1, 0.1, 1.0])) is None
+    assert clf.stats()["low_confidence"] == 1
+
+
+def test_keywords_break_ties_between_close_centroids():
+    clf = classifier()
+    assert clf.classify("When was it founded?", BETWEEN) == ["Wikipedia"]
+    assert clf.classify("Open jobs in Lviv", BETWEEN) == ["SoftServe Website"]
+    assert clf.stats()["keyword"] == 2
+
+
+def test_tie_without_a_single_keyword_match_is_left_to_the_llm():
+    clf = classifier()
+    assert clf.classify("Tell me about it", BETWEEN) is None
+    # Keywords of both sources
+    assert clf.classify("Jobs since it was founded", BETWEEN) is None
+    assert clf.stats()["low_confidence"] == 2
+
+
+def test_keywords_dont_override_a_clear_winner():
+    clf = classifier()
+    assert clf.classify("founded", np.array([0.9, 0.2, 0.0])) == ["SoftServe Website"]
+
+
+def test_margin_decides_what_is_a_tie():
+    vector = np.array([1.0, 0.9, 0.0])
+    assert classifier(min_margin=0.02).classify("founded", vector) == [
+        "SoftServe Website"
+    ]
+    assert classifier(min_margin=0.1).classify("founded", vector) == ["Wikipedia"]
+
+
+def test_without_centroids_or_vector():
+    assert SourceClassifier({}).classify("founded", BETWEEN) is None
+    assert classifier().classify("founded", None) is None
+
+
+def test_build_centroids_averages_normalized_embeddings():
+    client = FakeSearchClient(
+        {"Wikipedia": [[2.0, 0.0], [0.0, 1.0]], "SoftServe Website": []}
+    )
+    centroids = asyncio.run(
+        SourceClassifier.build_centroids(client, ["Wikipedia", "SoftServe Website"])
+    )
+    assert list(centroids) == ["Wikipedia"]
+    assert np.allclose(centroids["Wikipedia"], [0.5, 0.5])
+
+
+def test_load_or_build_saves_and_reuses_the_centroids(tmp_path):
+    path = str(tmp_path / "centroids.npz")
+    client = FakeSearchClient(
+        {"Wikipedia": [[0.0, 1.0]], "SoftServe Website": [[1.0, 0.0]]}
+    )
+
+    async def main():
+        built = await SourceClassifier.load_or_build(
+            path, client, list(CENTROIDS), generation="1"
+        )
+        loaded = await SourceClassifier.load_or_build(
+            path, client, list(CENTROIDS), generation="1"
+        )
+        return built, loaded
+
+    built, loaded = asyncio.run(main())
+    assert client.calls == 2
+    assert built.sources == loaded.sources == list(CENTROIDS)
+    assert np.allclose(built.centroids, loaded.centroids)
+    with np.load(path) as saved:
+        assert str(saved[GENERATION_KEY]) == "1"
+
+
+def test_load_or_build_rebuilds_centroids_of_another_generation(tmp_path):
+    path = str(tmp_path / "centroids.npz")
+    np.savez(path, **{"Wikipedia": np.array([1.0, 0.0]), GENERATION_KEY: "1"})
+    client = FakeSearchClient({"Wikipedia": [[0.0, 1.0]]})
+
+    clf = asyncio.run(
+        SourceClassifier.load_or_build(path, client, ["Wikipedia"], generation="2")
+    )
+    assert client.calls == 1
+    assert np.allclose(clf.centroids, [[0.0, 1.0]])
+    with np.load(path) as saved:
+        assert str(saved[GENERATION_KEY]) == "2"
+
+
+def test_load_or_build_without_the_index_falls_back_to_the_llm(tmp_path):
+    clf = asyncio.run(
+        SourceClassifier.load_or_build(
+            str(tmp_path / "centroids.npz"), FailingSearchClient(), ["Wikipedia"]
+        )
+    )
+    assert clf.centroids is None
+    assert not (tmp_path / "centroids.npz").exists()
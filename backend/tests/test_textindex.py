@@ -0,0 +1,74 @@
+import math
+
+import numpy as np
+
+from core.textindex import TextIndex, stem, tokenize
+
+TEXTS = [
+    "SoftServe builds cloud platforms for healthcare companies.",
+    "The company was founded in Lviv in 1993.",
+    "Cloud migration and cloud security services.",
+    "Careers: open vacancies in data engineering.",
+]
+
+
+def test_stem_conflates_plurals():
+    assert stem("companies") == "company"
+    assert stem("services") == "service"
+    assert stem("platforms") == "platform"
+    assert stem("business") == "business"
+    assert stem("status") == "status"
+    assert stem("gas") == "gas"
+
+
+def test_tokenize_drops_stopwords_and_case():
+    assert tokenize("What are the Cloud Services of SoftServe?") == [
+        "cloud",
+        "service",
+        "softserve",
+    ]
+
+
+def test_search_ranks_by_bm25():
+    index = TextIndex.build(TEXTS)
+    rows = [row for row, _ in index.search("cloud", 10)]
+    # More occurrences in a document of similar length rank it higher
+    assert rows == [2, 0]
+    assert index.search("quantum", 10) == []
+    assert index.search("the of and", 10) == []
+
+
+def test_bm25_score_matches_the_formula():
+    index = TextIndex.build(TEXTS, k1=1.2, b=0.75)
+    lengths = [len(tokenize(text)) for text in TEXTS]
+    average = sum(lengths) / len(lengths)
+    idf = math.log1p((4 - 1 + 0.5) / (1 + 0.5))
+    expected = idf * 1 * 2.2 / (1 + 1.2 * (1 - 0.75 + 0.75 * lengths[1] / average))
+    [(row, score)] = index.search("founded", 10)
+    assert row == 1
+    assert math.isclose(score, expected, rel_tol=1e-5)
+
+
+def test_search_sums_query_terms_and_honors_k_and_mask():
+    index = TextIndex.build(TEXTS)
+    rows = [row for row, _ in index.search("cloud healthcare", 10)]
+    assert rows == [0, 2]
+    assert [row for row, _ in index.search("cloud healthcare", 1)] == [0]
+    mask = np.array([False, True, True, True])
+    assert [row for row, _ in index.search("cloud healthcare", 10, mask)] == [2]
+
+
+def test_save_and_load(tmp_path):
+    index = TextIndex.build(TEXTS)
+    assert TextIndex.load(str(tmp_path)) is None
+    index.save(str(tmp_path))
+    loaded = TextIndex.load(str(tmp_path))
+    assert len(loaded) == len(TEXTS)
+    assert loaded.search("cloud services", 10) == index.search("cloud services", 10)
+
+
+def test_caption_picks_the_sentence_with_most_query_terms():
+    index = TextIndex.build(TEXTS)
+    text = "SoftServe is a company. It offers cloud migration services. It was founded in 1993."
+    assert index.caption("cloud migration", text, 100) == "It offers cloud migration services."
+    assert index.caption("cloud migration", text, 9) == "It offers"
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from core.validation import FIXED, INCONCLUSIVE, PASS, ResponseValidator, check_locally
+
+SOURCES = ["https://x/1", "https://x/2"]
+
+
+def test_clean_answer_passes():
+    check = check_locally("We deliver cloud projects ((https://x/1)).", SOURCES)
+    assert check.verdict == PASS
+    assert check.reasons == []
+
+
+def test_citation_formatting_is_fixed():
+    check = check_locally(
+        "We build apps (source: ((https://x/1))) and ((https://x/1), (https://x/2)).",
+        SOURCES,
+    )
+    assert check.verdict == FIXED
+    assert check.answer == "We build apps ((https://x/1)) and ((https://x/1)) ((https://x/2))."
+
+
+@pytest.mark.parametrize(
+    "answer",
+    [
+        "We build apps ((https://x/3)).",
+        "We build apps ((source)).",
+        "| a | b |\n|---|---|\n| 1 | 2 |",
+        "Write to jane.doe@softserveinc.com.",
+        "Call +38 032 240 9090.",
+        "SoftServe says they are growing.",
+        "Please contact Taras Kytsmey.",
+        "Ask John F. Smith about it.",
+        "Our CEO presented the plan.",
+        "The Head of Delivery approved it.",
+        "She is a co-founder of the lab.",
+    ],
+)
+def test_judgment_calls_are_inconclusive(answer):
+    assert check_locally(answer, SOURCES).verdict == INCONCLUSIVE
+
+
+def test_softserve_is_not_a_name():
+    assert check_locally("SoftServe was founded in 1993.", SOURCES).verdict == PASS
+
+
+def validate(validator, answer, mode=None, llm_answer="LLM answer"):
+    calls = []
+
+    async def llm_validate(text):
+        calls.append(text)
+        return llm_answer
+
+    result = asyncio.run(validator.validate(answer, SOURCES, llm_validate, mode))
+    return result, calls
+
+
+def test_full_mode_always_asks_the_llm():
+    result, calls = validate(ResponseValidator("full"), "We build apps ((https://x/1)).")
+    assert result == "LLM answer"
+    assert len(calls) == 1
+
+
+def test_local_mode_never_asks_the_llm():
+    result, calls = validate(ResponseValidator("local"), "Please contact Taras Kytsmey.")
+    assert result == "Please contact Taras Kytsmey."
+    assert calls == []
+
+
+def test_sampled_mode_sends_inconclusive_answers_to_the_llm():
+    validator = ResponseValidator("sampled", sample_rate=0.0)
+    result, calls = validate(validator, "Please contact Taras Kytsmey.")
+    assert result == "LLM answer"
+    assert calls == ["Please contact Taras Kytsmey."]
+    result, calls = validate(validator, "We build apps ((https://x/1)).")
+    assert result == "We build apps ((https://x/1))."
+    assert calls == []
+    stats = validator.stats()["modes"]["sampled"]
+    assert stats["requests"] == 2
+    assert stats["llm_calls"] == 1
+    assert stats["local_inconclusive"] == 1
+
+
+def test_sampled_mode_samples_passed_answers():
+    validator = ResponseValidator("sampled", sample_rate=1.0)
+    _, calls = validate(validator, "We build apps ((https://x/1)).")
+    assert len(calls) == 1
+    assert validator.stats()["modes"]["sampled"]["sampled_changed"] == 1
+
+
+def test_per_request_mode_overrides_the_default():
+    _, calls = validate(ResponseValidator("local"), "We build apps.", mode="full")
+    assert len(calls) == 1
+
+
+def test_unknown_default_mode():
+    with pytest.raises(ValueError):
+        ResponseValidator("strict")
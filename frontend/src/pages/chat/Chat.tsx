@@ -41,7 +41,8 @@ const Chat = () => {
         error && setError(undefined);
         setIsLoading(true);
         setActiveCitation(undefined);
-        setActiveAnalysisPanelTab(undefined);
+        // An open Analysis panel stays open for the new answer, which then comes with its thought process
+        activeAnalysisPanelTab === AnalysisPanelTabs.CitationTab && setActiveAnalysisPanelTab(AnalysisPanelTabs.ThoughtProcessTab);
 
         try {
             const history: ChatTurn[] = answers.map(a => ({ user: a[0], bot: a[1].answer }));
@@ -55,11 +56,13 @@ const Chat = () => {
                     retrievalMode: retrievalMode,
                     semanticRanker: useSemanticRanker,
                     semanticCaptions: useSemanticCaptions,
-                    suggestFollowupQuestions: useSuggestFollowupQuestions
+                    suggestFollowupQuestions: useSuggestFollowupQuestions,
+                    includeThoughts: activeAnalysisPanelTab !== undefined
                 }
             };
             const result = await chatApi(request);
             setAnswers([...answers, [question, result]]);
+            setSelectedAnswer(answers.length);
         } catch (e) {
             setError(e);
         } finally {
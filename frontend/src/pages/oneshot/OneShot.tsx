@@ -37,7 +37,8 @@ export function Component(): JSX.Element {
         error && setError(undefined);
         setIsLoading(true);
         setActiveCitation(undefined);
-        setActiveAnalysisPanelTab(undefined);
+        // An open Analysis panel stays open for the new answer, which then comes with its thought process
+        activeAnalysisPanelTab === AnalysisPanelTabs.CitationTab && setActiveAnalysisPanelTab(AnalysisPanelTabs.ThoughtProcessTab);
 
         try {
             const request: AskRequest = {
@@ -51,7 +52,8 @@ export function Component(): JSX.Element {
                     top: retrieveCount,
                     retrievalMode: retrievalMode,
                     semanticRanker: useSemanticRanker,
-                    semanticCaptions: useSemanticCaptions
+                    semanticCaptions: useSemanticCaptions,
+                    includeThoughts: activeAnalysisPanelTab !== undefined
                 }
             };
             const result = await askApi(request);